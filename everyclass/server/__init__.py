@@ -80,6 +80,13 @@ try:
         init_mongo(__app)
         init_pg(__app)
 
+    @uwsgidecorators.postfork
+    def init_privacy_cache():
+        """订阅隐私级别变化的通知，之后才会在进程内缓存隐私级别"""
+        from everyclass.server.db.dao import PrivacySettings
+
+        PrivacySettings.start_invalidation_listener()
+
     @uwsgidecorators.postfork
     def init_session():
         """初始化服务器端 session"""
@@ -99,12 +106,36 @@ try:
         """每天凌晨更新数据最后更新时间"""
         cron_update_remote_manifest()
 
+    @uwsgidecorators.cron(30, 3, -1, -1, -1)
+    def daily_build_indexes(signum):
+        """每天凌晨数据更新后重建本地索引"""
+        cron_build_indexes()
+
+    @uwsgidecorators.cron(-1, -1, -1, -1, -1)
+    def flush_calendar_token_usage(signum):
+        """每分钟将日历令牌的最后使用时间批量写入数据库"""
+        from everyclass.server.db.dao import CalendarToken
+
+        with __app.app_context():
+            CalendarToken.flush_last_used_time()
+
+    @uwsgidecorators.cron(0, 4, -1, -1, -1)
+    def daily_gc_calendar_files(signum):
+        """每天凌晨清理已重置或长期未使用的令牌生成的 ics 文件"""
+        cron_gc_calendar_files()
+
+    @uwsgidecorators.cron(30, 4, -1, -1, -1)
+    def daily_prune_visit_tracks(signum):
+        """每天凌晨删除超出保留数量的访客记录"""
+        cron_prune_visit_tracks()
+
 except ModuleNotFoundError:
     pass
 
 
 def cron_update_remote_manifest():
     """更新数据最后更新时间"""
+    from everyclass.server.db.dao import Redis
     from everyclass.server.rpc.http import HttpRpc
 
     # 获取安卓客户端下载链接
@@ -120,6 +151,36 @@ def cron_update_remote_manifest():
                                       retry=True,
                                       headers={'X-Auth-Token': __app.config['API_SERVER_TOKEN']})
     __app.config['DATA_LAST_UPDATE_TIME'] = _api_server_status["data_time"]
+    # 定时任务只在一个 worker 中执行，其他进程通过 Redis 得到新的数据版本（见 calendar.cache.data_version）
+    Redis.set_data_version(str(_api_server_status["data_time"]))
+
+
+def cron_build_indexes():
+    """重建本地搜索索引和最新学期的教室占用索引"""
+    from everyclass.server.classroom.occupancy import build_index as build_occupancy_index
+    from everyclass.server.search.index import build_index as build_search_index
+    from everyclass.server.models import Semester
+
+    with __app.app_context():
+        build_search_index()
+        build_occupancy_index(Semester(max(__app.config['AVAILABLE_SEMESTERS'])).to_str())
+
+
+def cron_gc_calendar_files():
+    """清理 ics 文件存储"""
+    from everyclass.server.calendar.storage import collect_garbage
+
+    with __app.app_context():
+        collect_garbage()
+
+
+def cron_prune_visit_tracks():
+    """每个人只保留最近的若干位访客"""
+    from everyclass.server.db.dao import VisitTrack
+
+    with __app.app_context():
+        deleted = VisitTrack.prune(__app.config['VISIT_TRACK_MAX_PER_HOST'], __app.config['VISIT_TRACK_PRUNE_BATCH'])
+    logger.info("Visit tracks pruned", {"deleted": deleted})
 
 
 def create_app() -> Flask:
@@ -189,10 +250,16 @@ def create_app() -> Flask:
     from everyclass.server.views import main_blueprint as main_blueprint
     from everyclass.server.user.views import user_bp
     from everyclass.server.course_review.views import cr_blueprint
+    from everyclass.server.classroom.views import classroom_bp
+    from everyclass.server.free_time.views import free_time_bp
+    from everyclass.server.search.views import search_bp
     app.register_blueprint(cal_blueprint)
     app.register_blueprint(query_blueprint)
     app.register_blueprint(main_blueprint)
     app.register_blueprint(user_bp, url_prefix='/user')
+    app.register_blueprint(classroom_bp)
+    app.register_blueprint(free_time_bp)
+    app.register_blueprint(search_bp)
 
     # course review feature gating
     if app.config['FEATURE_GATING']['course_review']:
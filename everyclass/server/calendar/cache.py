@@ -0,0 +1,143 @@
+"""
+ics 文件缓存
+
+同一个日历令牌在同一个数据版本下生成的 ics 文件是完全相同的，因此可以用（令牌, 数据版本, 输出格式版本）计算强 ETag，
+在客户端带着 `If-None-Match` 轮询时直接返回 304，而不用获取课表或生成文件。生成的文件以 gzip 压缩后的形式缓存。
+
+数据每天只更新一次，所以 ics 中会写入按客户端类型配置的建议刷新间隔，HTTP 缓存头则以距离下次数据更新的时间为上限。
+"""
+import gzip
+import hashlib
+import io
+import time
+from datetime import datetime, timedelta
+from typing import BinaryIO, Dict, Optional
+
+from flask import current_app as app
+
+from everyclass.server.calendar import ics_generator
+from everyclass.server.calendar.ics_generator import FORMAT_VERSION
+from everyclass.server.models import Semester
+
+
+_version: Optional[str] = None
+_version_expires = 0.0
+
+
+def data_version(fresh: bool = False) -> str:
+    """
+    当前数据版本，即 api-server 报告的数据更新时间
+
+    数据更新后只有执行了定时任务的那个进程的配置会更新，所以版本以 Redis 中共享的值为准（由 `cron_update_remote_manifest`
+    写入），各进程只缓存 `DATA_VERSION_CACHE_SECONDS` 秒，不会长时间各自使用不同的版本。Redis 中还没有值或无法访问时
+    使用本进程的配置。
+
+    :param fresh: 不使用进程内的缓存
+    """
+    from everyclass.server import logger
+    from everyclass.server.db.dao import Redis
+
+    global _version, _version_expires
+    now = time.monotonic()
+    if fresh or _version is None or now >= _version_expires:
+        try:
+            version = Redis.get_data_version()
+        except Exception as e:
+            logger.warning("Failed to read shared data version", {"error": repr(e)})
+            version = None
+        _version = version or str(app.config['DATA_LAST_UPDATE_TIME'])
+        _version_expires = now + app.config['DATA_VERSION_CACHE_SECONDS']
+    return _version
+
+
+def data_version_time(semester: Semester) -> datetime:
+    """
+    数据版本对应的时间，用作 ics 中事件的最后修改时间。无法解析时使用学期开始日期，保证同一数据版本下输出不变
+    """
+    version = data_version()
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d', '%Y 年 %m 月 %d 日'):
+        try:
+            return datetime.strptime(version, fmt)
+        except ValueError:
+            continue
+    return datetime(*app.config['AVAILABLE_SEMESTERS'][semester.to_tuple()]['start'])
+
+
+def make_etag(token: str, compact: bool = False, refresh_interval: Optional[int] = None) -> str:
+    """计算某令牌在当前数据版本下的 ETag，输出选项（紧凑模式、刷新间隔）不同时 ETag 也不同"""
+    key = '{}:{}:{}'.format(token, data_version(), FORMAT_VERSION)
+    if compact:
+        key += ':compact'
+    if refresh_interval:
+        key += ':refresh={}'.format(refresh_interval)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def client_type(user_agent: str) -> str:
+    """根据 User-Agent 判断日历客户端类型，未知的客户端为 default"""
+    for typ, keywords in app.config['ICS_CLIENT_USER_AGENTS'].items():
+        if any(keyword in user_agent for keyword in keywords):
+            return typ
+    return 'default'
+
+
+def client_refresh_interval(client: str) -> int:
+    """某类客户端的建议刷新间隔（秒）"""
+    intervals = app.config['ICS_REFRESH_INTERVALS']
+    return intervals.get(client, intervals['default'])
+
+
+def next_data_refresh(now: datetime) -> datetime:
+    """下一次数据更新（以及随后的 ics 预生成）完成的时间"""
+    hour, minute = app.config['DATA_REFRESH_TIME']
+    refresh = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return refresh if refresh > now else refresh + timedelta(days=1)
+
+
+def cache_max_age(interval: int, now: datetime) -> int:
+    """HTTP 缓存时间：建议刷新间隔，但不超过距离下次数据更新的时间"""
+    return max(min(interval, int((next_data_refresh(now) - now).total_seconds())), 60)
+
+
+def open_gzip(fileobj: BinaryIO) -> gzip.GzipFile:
+    """打开一个写入 `fileobj` 的 gzip 流。mtime 固定为 0，相同的输入得到相同的输出"""
+    return gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0)
+
+
+def gzip_compress(data: bytes) -> bytes:
+    """gzip 压缩，输出是确定的"""
+    buffer = io.BytesIO()
+    with open_gzip(buffer) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def render_ics(token_doc: Dict, compact: bool, refresh_interval: Optional[int] = None) -> bytes:
+    """
+    获取令牌对应的课表并生成 gzip 压缩后的 ics 文件（需要在 app context 中调用）
+
+    :param token_doc: `CalendarToken.find_calendar_token` 返回的令牌文档
+    :param compact: 是否使用紧凑模式
+    :param refresh_interval: 建议客户端刷新的间隔（秒）
+    """
+    from everyclass.server.rpc.api_server import APIServer
+
+    # 获得原始学号或教工号
+    if token_doc['type'] == 'student':
+        rpc_result = APIServer.get_student_timetable(token_doc['identifier'], token_doc['semester'])
+    else:
+        # teacher
+        rpc_result = APIServer.get_teacher_timetable(token_doc['identifier'], token_doc['semester'])
+
+    semester = Semester(token_doc['semester'])
+    # 生成的内容直接流式写入 gzip，不在内存中保留未压缩的完整文件
+    buffer = io.BytesIO()
+    with open_gzip(buffer) as f:
+        ics_generator.write(f,
+                            name=rpc_result.name,
+                            cards=rpc_result.grid,
+                            semester=semester,
+                            last_modified=data_version_time(semester),
+                            compact=compact,
+                            refresh_interval=refresh_interval)
+    return buffer.getvalue()
@@ -1,98 +1,207 @@
 """
-This is module to generate .ics file. Should follow RFC2445 standard.
-https://tools.ietf.org/html/rfc2445
+This is module to generate .ics file. Should follow RFC5545 standard.
+https://tools.ietf.org/html/rfc5545
+
+为了减少内存分配，这里不构建 icalendar 的对象树，而是把内容行直接写入输出流（BytesIO、文件或 GzipFile），
+每个事件的各行拼接好后只调用一次 write。
+
+紧凑模式下，一门课的连续周（每周或单双周）合并为一个带 RRULE 的重复事件，放假冲掉的课用 EXDATE 排除，
+调到其他日期的课用 EXDATE 排除原日期并用 RDATE 加上新日期。重复事件的 UID 与逐周模式下第一周事件的 UID 相同，
+客户端切换模式时不会出现重复的事件。
 """
 import hashlib
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
-
-import pytz
-from icalendar import Alarm, Calendar, Event, Timezone, TimezoneStandard
+from io import BytesIO
+from typing import BinaryIO, List, Optional, Tuple
 
 from everyclass.server.config import get_config
 from everyclass.server.models import Semester
+from everyclass.server.rpc.api_server import TimetableGrid, teacher_list_to_name_str
 from everyclass.server.utils import get_time
 
-tzc = Timezone()
-tzc.add('tzid', 'Asia/Shanghai')
-tzc.add('x-lic-location', 'Asia/Shanghai')
-tzs = TimezoneStandard()
-tzs.add('tzname', 'CST')
-tzs.add('dtstart', datetime(1970, 1, 1, 0, 0, 0))
-tzs.add('TZOFFSETFROM', timedelta(hours=8))
-tzs.add('TZOFFSETTO', timedelta(hours=8))
+FORMAT_VERSION = 3  # 输出格式版本，生成逻辑变化导致输出不同时需要增加，使旧的缓存和 ETag 失效
+
+CRLF = b'\r\n'
+_FOLD_LIMIT = 75  # 每个物理行最多 75 个字节（不含换行符）
+
+VTIMEZONE = b'BEGIN:VTIMEZONE\r\n' \
+            b'TZID:Asia/Shanghai\r\n' \
+            b'X-LIC-LOCATION:Asia/Shanghai\r\n' \
+            b'BEGIN:STANDARD\r\n' \
+            b'DTSTART:19700101T000000\r\n' \
+            b'TZNAME:CST\r\n' \
+            b'TZOFFSETFROM:+0800\r\n' \
+            b'TZOFFSETTO:+0800\r\n' \
+            b'END:STANDARD\r\n' \
+            b'END:VTIMEZONE\r\n'
+
+VALARM = b'BEGIN:VALARM\r\n' \
+         b'ACTION:none\r\n' \
+         b'TRIGGER:19800101T030500\r\n' \
+         b'END:VALARM\r\n'
+
+
+def escape_text(text: str) -> str:
+    """按 RFC 5545 3.3.11 转义 TEXT 类型的值。内容行中不能出现 CR，CRLF 和单独的 CR 都按换行处理"""
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def fold_line(line: str) -> bytes:
+    """
+    将一个内容行编码为 UTF-8 并按 RFC 5545 3.1 折行：每个物理行不超过 75 个字节，续行以一个空格开头，
+    不会在多字节字符中间断开
+
+    :param line: 不含换行符的内容行
+    :return: 以 CRLF 结尾的字节串
+    """
+    data = line.encode('utf-8')
+    if len(data) <= _FOLD_LIMIT:
+        return data + CRLF
+
+    parts = []
+    start = 0
+    limit = _FOLD_LIMIT
+    while start < len(data):
+        end = min(start + limit, len(data))
+        while end < len(data) and (data[end] & 0xC0) == 0x80:  # 不在 UTF-8 续字节处断开
+            end -= 1
+        parts.append(data[start:end])
+        start = end
+        limit = _FOLD_LIMIT - 1  # 续行开头的空格占一个字节
+    return b'\r\n '.join(parts) + CRLF
+
+
+def _format_datetime(dt: datetime) -> str:
+    return dt.strftime('%Y%m%dT%H%M%S')
+
+
+def week_runs(weeks: List[int]) -> List[Tuple[int, int, int]]:
+    """
+    将周次列表拆分为尽量长的等间隔序列，间隔为 1（每周）或 2（单双周）
+
+    :param weeks: 升序的周次列表
+    :return: (起始周, 间隔, 次数) 的列表，不能合并的周次数为 1
+    """
+    runs = []
+    i = 0
+    while i < len(weeks):
+        count = 1
+        step = weeks[i + 1] - weeks[i] if i + 1 < len(weeks) else 1
+        if step in (1, 2):
+            while i + count < len(weeks) and weeks[i + count] - weeks[i + count - 1] == step:
+                count += 1
+        else:
+            step = 1
+        runs.append((weeks[i], step, count))
+        i += count
+    return runs
 
 
-def generate(name: str, cards: Dict[Tuple[int, int], List[Dict]], semester: Semester, ics_token: str):
+def write(out: BinaryIO, name: str, cards: TimetableGrid, semester: Semester, last_modified: datetime,
+          compact: bool = False, refresh_interval: Optional[int] = None) -> None:
     """
-    生成 ics 文件并保存到目录
+    生成 ics 文件内容并写入 `out`。相同的输入总是得到完全相同的输出
 
+    :param out: 任何带有 write(bytes) 方法的对象
     :param name: 姓名
-    :param cards: 参与的课程
+    :param cards: 参与的课程（课表网格）
     :param semester: 当前导出的学期
-    :param ics_token: ics 令牌
-    :return: None
+    :param last_modified: 事件的最后修改时间，应由数据版本得出而不是使用当前时间
+    :param compact: 是否使用 RRULE 合并每周重复的课程
+    :param refresh_interval: 建议客户端刷新的间隔（秒），写入 REFRESH-INTERVAL 和 X-PUBLISHED-TTL
     """
     semester_string = semester.to_str(simplify=True)
     semester = semester.to_tuple()
 
-    # 创建 calender 对象
-    cal = Calendar()
-    cal.add('prodid', '-//Admirable//EveryClass//EN')
-    cal.add('version', '2.0')
-    cal.add('calscale', 'GREGORIAN')
-    cal.add('method', 'PUBLISH')
-    cal.add('X-WR-CALNAME', name + '的' + semester_string + '课表')
-    cal.add('X-WR-TIMEZONE', 'Asia/Shanghai')
-
-    # 时区
-    tzc.add_component(tzs)
-    cal.add_component(tzc)
-
-    # 创建 events
-    for time in range(1, 7):
-        for day in range(1, 8):
-            if (day, time) in cards:
-                for card in cards[(day, time)]:
-                    for week in card['week']:
-                        dtstart = _get_datetime(week, day, get_time(time)[0], semester)
-                        dtend = _get_datetime(week, day, get_time(time)[1], semester)
-
-                        if dtstart.year == 1984:
-                            continue
-
-                        cal.add_component(_build_event(card_name=card['name'],
-                                                       times=(dtstart, dtend),
-                                                       classroom=card['classroom'],
-                                                       teacher=card['teacher'],
-                                                       week_string=card['week_string'],
-                                                       current_week=week,
-                                                       cid=card['cid']))
-
-    # 写入文件
-    import os
-
-    with open(os.path.join(os.path.dirname(__file__),
-                           '../../../calendar_files/{}.ics'.format(ics_token)),
-              'w') as f:
-        f.write(cal.to_ical().decode(encoding='utf-8'))
-
-
-def _get_datetime(week: int, day: int, time: Tuple[int, int], semester: Tuple[int, int, int]) -> datetime:
+    out.write(b'BEGIN:VCALENDAR\r\n'
+              b'VERSION:2.0\r\n'
+              b'PRODID:-//Admirable//EveryClass//EN\r\n'
+              b'CALSCALE:GREGORIAN\r\n'
+              b'METHOD:PUBLISH\r\n' +
+              fold_line('X-WR-CALNAME:' + escape_text(name + '的' + semester_string + '课表')) +
+              b'X-WR-TIMEZONE:Asia/Shanghai\r\n' +
+              (_refresh_lines(refresh_interval) if refresh_interval else b'') +
+              VTIMEZONE)
+
+    # 所有事件的最后修改时间相同，只格式化一次
+    last_modified_line = fold_line('LAST-MODIFIED:' + _format_datetime(last_modified) + 'Z')
+
+    for (day, time), cards_in_slot in cards.items():
+        start_time, end_time = get_time(time)
+        for card in cards_in_slot:
+            teacher = teacher_list_to_name_str(card.teachers)
+            if compact:
+                for first_week, step, count in week_runs(sorted(card.weeks)):
+                    recurrence = _build_recurrence(first_week, step, count, day, start_time, semester)
+                    if recurrence is None:
+                        continue
+                    dtstart, recurrence_lines = recurrence
+                    out.write(_build_event(card_name=card.name,
+                                           times=(dtstart, dtstart.replace(hour=end_time[0], minute=end_time[1])),
+                                           classroom=card.room,
+                                           teacher=teacher,
+                                           week_string=card.week_string,
+                                           current_week=first_week,
+                                           cid=card.card_id_encoded,
+                                           last_modified_line=last_modified_line,
+                                           recurrence_lines=recurrence_lines))
+                continue
+
+            for week in card.weeks:
+                dtstart = _get_datetime(week, day, start_time, semester)
+                if dtstart is None:
+                    continue
+                dtend = dtstart.replace(hour=end_time[0], minute=end_time[1])
+
+                out.write(_build_event(card_name=card.name,
+                                       times=(dtstart, dtend),
+                                       classroom=card.room,
+                                       teacher=teacher,
+                                       week_string=card.week_string,
+                                       current_week=week,
+                                       cid=card.card_id_encoded,
+                                       last_modified_line=last_modified_line))
+
+    out.write(b'END:VCALENDAR\r\n')
+
+
+def generate(name: str, cards: TimetableGrid, semester: Semester, last_modified: datetime,
+             compact: bool = False, refresh_interval: Optional[int] = None) -> bytes:
+    """生成 ics 文件内容，参数同 `write`"""
+    buffer = BytesIO()
+    write(buffer, name, cards, semester, last_modified, compact, refresh_interval)
+    return buffer.getvalue()
+
+
+def _refresh_lines(seconds: int) -> bytes:
+    """REFRESH-INTERVAL（RFC 7986）和 X-PUBLISHED-TTL（Outlook、Google 等使用）"""
+    duration = 'PT{}M'.format(max(seconds // 60, 1))
+    return 'REFRESH-INTERVAL;VALUE=DURATION:{0}\r\nX-PUBLISHED-TTL:{0}\r\n'.format(duration).encode()
+
+
+def _get_base_datetime(week: int, day: int, time: Tuple[int, int], semester: Tuple[int, int, int]) -> datetime:
+    """根据学期、周次、时间，生成不考虑调课和放假的 `datetime` 类型的时间（东八区本地时间）"""
+    dt = datetime(*(get_config().AVAILABLE_SEMESTERS[semester]['start'] + time))  # noqa: T484
+    return dt + timedelta(days=(week - 1) * 7 + (day - 1))  # 调整到当前周
+
+
+def _get_datetime(week: int, day: int, time: Tuple[int, int], semester: Tuple[int, int, int]) -> Optional[datetime]:
     """
-    根据学期、周次、时间，生成 `datetime` 类型的时间
+    根据学期、周次、时间，生成 `datetime` 类型的时间（东八区本地时间）
 
     :param week: 周次
     :param day: 星期
     :param time: 时间tuple（时,分）
     :param semester: 学期
-    :return: datetime 类型的时间
+    :return: datetime 类型的时间，这天放假、课被冲掉时返回 None
     """
-    config = get_config()
-    tz = pytz.timezone("Asia/Shanghai")
-    dt = datetime(*(config.AVAILABLE_SEMESTERS[semester]['start'] + time), tzinfo=tz)  # noqa: T484
-    dt += timedelta(days=(week - 1) * 7 + (day - 1))  # 调整到当前周
+    return _adjust(_get_base_datetime(week, day, time, semester), semester)
+
 
+def _adjust(dt: datetime, semester: Tuple[int, int, int]) -> Optional[datetime]:
+    """按照学期的调课安排调整时间，这天放假时返回 None"""
+    config = get_config()
     if 'adjustments' in config.AVAILABLE_SEMESTERS[semester]:
         ymd = (dt.year, dt.month, dt.day)
         adjustments = config.AVAILABLE_SEMESTERS[semester]['adjustments']
@@ -103,47 +212,80 @@ def _get_datetime(week: int, day: int, time: Tuple[int, int], semester: Tuple[in
                                 month=adjustments[ymd]['to'][1],
                                 day=adjustments[ymd]['to'][2])
             else:
-                # 冲掉的课年份设置为1984，返回之后被抹去
-                dt = dt.replace(year=1984)
+                # 放假，课被冲掉
+                return None
 
     return dt
 
 
+def _build_recurrence(first_week: int, step: int, count: int, day: int, time: Tuple[int, int],
+                      semester: Tuple[int, int, int]) -> Optional[Tuple[datetime, List[bytes]]]:
+    """
+    生成一段等间隔周次的重复规则
+
+    :return: (DTSTART, RRULE/EXDATE/RDATE 内容行)，所有课都被冲掉时返回 None
+    """
+    dtstart = _get_base_datetime(first_week, day, time, semester)
+    if count == 1:
+        adjusted = _adjust(dtstart, semester)
+        return (adjusted, []) if adjusted else None
+
+    exdates: List[datetime] = []
+    rdates: List[datetime] = []
+    for i in range(count):
+        base = dtstart + timedelta(weeks=i * step)
+        adjusted = _adjust(base, semester)
+        if adjusted != base:
+            exdates.append(base)
+            if adjusted:
+                rdates.append(adjusted)
+    if len(exdates) == count and not rdates:
+        return None
+
+    lines = [fold_line('RRULE:FREQ=WEEKLY;INTERVAL={};COUNT={}'.format(step, count))]
+    lines.extend(fold_line('EXDATE;TZID=Asia/Shanghai:' + _format_datetime(dt)) for dt in exdates)
+    lines.extend(fold_line('RDATE;TZID=Asia/Shanghai:' + _format_datetime(dt)) for dt in rdates)
+    return dtstart, lines
+
+
 def _build_event(card_name: str, times: Tuple[datetime, datetime], classroom: str, teacher: str, current_week: int,
-                 week_string: str, cid: str) -> Event:
+                 week_string: str, cid: str, last_modified_line: bytes,
+                 recurrence_lines: Optional[List[bytes]] = None) -> bytes:
     """
-    生成 `Event` 对象
+    生成一个 VEVENT
 
     :param card_name: 课程名
     :param times: 开始和结束时间
     :param classroom: 课程地点
     :param teacher: 任课教师
-    :return: `Event` 对象
+    :param current_week: 周次，重复事件为第一次上课的周次
+    :param last_modified_line: 格式化好的 LAST-MODIFIED 内容行
+    :param recurrence_lines: 紧凑模式下的 RRULE、EXDATE、RDATE 内容行
+    :return: VEVENT 的字节串
     """
-
-    event = Event()
-    event.add('transp', 'TRANSPARENT')
     summary = card_name
     if classroom != 'None':
         summary = card_name + '@' + classroom
-        event.add('location', classroom)
 
     description = week_string
     if teacher != 'None':
         description += '\n教师：' + teacher
     description += '\n由 EveryClass 每课 (https://everyclass.xyz) 导入'
 
-    event.add('summary', summary)
-    event.add('description', description)
-    event.add('dtstart', times[0])
-    event.add('dtend', times[1])
-    event.add('last-modified', datetime.now())
-
     # 使用"cid-当前周"作为事件的超码
     event_sk = cid + '-' + str(current_week)
-    event['uid'] = hashlib.md5(event_sk.encode('utf-8')).hexdigest() + '@everyclass.xyz'
-    alarm = Alarm()
-    alarm.add('action', 'none')
-    alarm.add('trigger', datetime(1980, 1, 1, 3, 5, 0))
-    event.add_component(alarm)
-    return event
+
+    lines: List[bytes] = [b'BEGIN:VEVENT\r\n',
+                          fold_line('SUMMARY:' + escape_text(summary)),
+                          fold_line('DTSTART;TZID=Asia/Shanghai:' + _format_datetime(times[0])),
+                          fold_line('DTEND;TZID=Asia/Shanghai:' + _format_datetime(times[1])),
+                          *(recurrence_lines or ()),
+                          b'UID:' + hashlib.md5(event_sk.encode('utf-8')).hexdigest().encode() + b'@everyclass.xyz\r\n',
+                          fold_line('DESCRIPTION:' + escape_text(description)),
+                          last_modified_line]
+    if classroom != 'None':
+        lines.append(fold_line('LOCATION:' + escape_text(classroom)))
+    lines.append(b'TRANSP:TRANSPARENT\r\n')
+    lines.append(VALARM)
+    lines.append(b'END:VEVENT\r\n')
+    return b''.join(lines)
@@ -0,0 +1,98 @@
+"""
+ics 文件预生成
+
+每天数据更新后，日历客户端几乎同时开始轮询，每次轮询都要在 web worker 里同步生成 ics 文件。这里在数据更新后批量为最近活跃的
+令牌生成 ics 文件并写入存储，之后的轮询都可以直接命中缓存。
+
+生成在进程池中并行进行，所有进程共享一个限速器，控制对 api-server 的请求速率。文件的 ETag 使用 Redis 中共享的数据版本
+（`cache.data_version`）计算，与 web worker 相同。
+"""
+import datetime
+import multiprocessing
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from flask import Flask
+
+from everyclass.server import logger
+
+_app: Optional[Flask] = None
+_next_slot = None  # 共享的 multiprocessing.Value，下一次允许发出请求的时间（time.monotonic）
+_interval = 0.0
+
+
+def _init_worker(app: Flask, next_slot, interval: float) -> None:
+    global _app, _next_slot, _interval
+    _app, _next_slot, _interval = app, next_slot, interval
+
+
+def _wait_for_slot() -> None:
+    """限速：按 `_interval` 的间隔为各进程分配发出请求的时间"""
+    with _next_slot.get_lock():
+        now = time.monotonic()
+        slot = max(now, _next_slot.value)
+        _next_slot.value = slot + _interval
+    if slot > now:
+        time.sleep(slot - now)
+
+
+def _generate_one(token_doc: Dict) -> Tuple[str, bool]:
+    from everyclass.server.calendar.cache import client_refresh_interval, make_etag, render_ics
+    from everyclass.server.calendar.storage import get_storage
+
+    token = str(token_doc['token'])
+    with _app.app_context():
+        compact = _app.config['ICS_COMPACT_DEFAULT']
+        refresh_interval = client_refresh_interval('default')  # 其他客户端的刷新间隔与默认相同时共用同一份文件
+        etag = make_etag(token, compact, refresh_interval)
+        storage = get_storage()
+        if storage.get(token, etag):
+            return token, True
+
+        _wait_for_slot()
+        try:
+            storage.put(token, etag, render_ics(token_doc, compact, refresh_interval))
+        except Exception as e:
+            logger.warning("Failed to pre-generate calendar", {"token": token, "error": repr(e)})
+            return token, False
+    return token, True
+
+
+def pregenerate(app: Flask, days: int, processes: Optional[int] = None, rate: Optional[float] = None) -> Dict:
+    """
+    为最近使用过的令牌预生成 ics 文件（需要在 app context 中调用，使用的数据版本应该已经更新）
+
+    :param app: flask app，通过 fork 传给子进程
+    :param days: 选择最近多少天内使用过的令牌
+    :param processes: 进程数，默认为 CPU 核数
+    :param rate: 每秒最多向 api-server 发出的请求数
+    :return: 统计信息
+    """
+    from everyclass.server.calendar.cache import data_version
+    from everyclass.server.db.dao import CalendarToken
+
+    # ETag 由 Redis 中共享的数据版本计算，与 web worker 一致，生成的文件才会被轮询命中
+    version = data_version(fresh=True)
+    tokens = CalendarToken.get_recently_used_tokens(datetime.datetime.now() - datetime.timedelta(days=days))
+    processes = processes or os.cpu_count() or 1
+    rate = rate or app.config['ICS_PREGENERATE_RATE']
+
+    start = time.monotonic()
+    ctx = multiprocessing.get_context('fork')
+    next_slot = ctx.Value('d', 0.0)
+    succeeded = failed = 0
+    with ctx.Pool(processes, initializer=_init_worker, initargs=(app, next_slot, 1 / rate)) as pool:
+        for _, ok in pool.imap_unordered(_generate_one, tokens, chunksize=16):
+            if ok:
+                succeeded += 1
+            else:
+                failed += 1
+
+    stats = {"version"  : version,
+             "tokens"   : len(tokens),
+             "succeeded": succeeded,
+             "failed"   : failed,
+             "seconds"  : round(time.monotonic() - start, 1)}
+    logger.info("Calendars pre-generated", stats)
+    return stats
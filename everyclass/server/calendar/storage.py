@@ -0,0 +1,273 @@
+"""
+生成好的 ics 文件的存储
+
+ics 文件以 gzip 压缩后的形式按（令牌, ETag）存储，提供三种后端，通过配置项 `ICS_STORAGE` 选择：
+- disk：本地磁盘目录（默认为 calendar_files），先写临时文件再原子重命名，多个 worker 并发写入时读者不会读到写了一半的文件
+- shm：与 disk 相同，但目录位于 /dev/shm，读写都在内存中，重启机器后丢失
+- redis：存放在 Redis 中，依靠过期时间清理
+
+本地目录会一直增长，所以还提供了按大小和时间限制的垃圾回收，删除已被重置或长期未使用的令牌对应的文件。
+
+使用本地目录存储时，可以通过 `ICS_DELIVERY` 把文件的发送交给 Web 服务器，Python 线程不必等待慢速的客户端：
+- python：由 Python 读出文件内容后返回（默认）
+- sendfile：通过 wsgi.file_wrapper 交给 uWSGI，使用 sendfile 发送，配置了 offload-threads 时由 offload 线程完成
+- x-accel：返回 X-Accel-Redirect 头，由前端的 nginx 从 internal location 发送文件
+- x-sendfile：返回 X-Sendfile 头，由前端的 Apache/lighttpd 发送文件
+"""
+import abc
+import datetime
+import glob
+import hashlib
+import os
+import time
+from typing import Callable, Iterable, List, NamedTuple, Optional, Set
+
+from flask import Response, current_app as app, request
+from werkzeug.wsgi import wrap_file
+
+from everyclass.server import logger
+
+_SUFFIX = '.ics.gz'
+_TMP_SUFFIX = '.tmp'
+
+
+class ICSStorage(abc.ABC):
+    """ics 文件存储后端"""
+
+    @abc.abstractmethod
+    def get(self, token: str, etag: str) -> Optional[bytes]:
+        """获得某令牌在某 ETag 下的文件内容，无则返回 None"""
+        pass
+
+    @abc.abstractmethod
+    def put(self, token: str, etag: str, body: bytes) -> None:
+        """保存文件内容，同一令牌旧数据版本的内容随之失效"""
+        pass
+
+    @abc.abstractmethod
+    def delete(self, token: str) -> None:
+        """删除某令牌的所有文件"""
+        pass
+
+    def file_path(self, token: str, etag: str) -> Optional[str]:
+        """文件在本地的路径，用于把发送交给 Web 服务器。不是本地存储或文件不存在时返回 None"""
+        return None
+
+    def gc(self, keep: Callable[[Set[str]], Set[str]], max_age: int, max_bytes: int) -> int:
+        """
+        垃圾回收
+
+        :param keep: 传入存储中出现的令牌，返回其中仍然有效的令牌
+        :param max_age: 文件最长保留时间（秒）
+        :param max_bytes: 存储的总大小上限，超过时从最旧的文件开始删除
+        :return: 删除的文件数
+        """
+        return 0
+
+
+class _Entry(NamedTuple):
+    path: str
+    token: str
+    mtime: float
+    size: int
+
+
+class LocalDiskStorage(ICSStorage):
+    """
+    本地目录存储，文件名为 `<令牌>.<数据版本>.<ETag>.ics.gz`，数据版本为 `version` 返回值的摘要
+
+    同一令牌在同一数据版本下可能同时有多个有效的文件（紧凑/完整格式、不同客户端的刷新间隔），写入时只删除旧数据版本的文件，
+    不会互相挤掉，也不会删除刚通过 X-Accel-Redirect/X-Sendfile 交给 Web 服务器的文件。
+    """
+
+    def __init__(self, directory: str, version: Optional[Callable[[], str]] = None):
+        self.directory = directory
+        self.version = version
+        os.makedirs(directory, exist_ok=True)
+
+    def _version_key(self) -> str:
+        return hashlib.sha1((self.version() if self.version else '').encode('utf-8')).hexdigest()[:8]
+
+    def _path(self, token: str, etag: str) -> str:
+        return os.path.join(self.directory, '{}.{}.{}{}'.format(token, self._version_key(), etag, _SUFFIX))
+
+    @staticmethod
+    def _is_version(path: str, version_key: str) -> bool:
+        """文件是否属于某个数据版本（旧格式 `<令牌>.<ETag>.ics.gz` 的文件不属于任何版本）"""
+        parts = os.path.basename(path)[:-len(_SUFFIX)].split('.')
+        return len(parts) == 3 and parts[1] == version_key
+
+    def get(self, token: str, etag: str) -> Optional[bytes]:
+        try:
+            with open(self._path(token, etag), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def file_path(self, token: str, etag: str) -> Optional[str]:
+        path = self._path(token, etag)
+        return path if os.path.isfile(path) else None
+
+    def put(self, token: str, etag: str, body: bytes) -> None:
+        path = self._path(token, etag)
+        tmp_path = '{}.{}{}'.format(path, os.getpid(), _TMP_SUFFIX)
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+        version_key = self._version_key()
+        for old_path in glob.glob(os.path.join(self.directory, token + '.*' + _SUFFIX)):
+            if not self._is_version(old_path, version_key):
+                self._remove(old_path)
+
+    def delete(self, token: str) -> None:
+        for path in glob.glob(os.path.join(self.directory, token + '.*')):
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _entries(self) -> List[_Entry]:
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append(_Entry(entry.path, entry.name.split('.')[0], stat.st_mtime, stat.st_size))
+        return entries
+
+    def gc(self, keep: Callable[[Set[str]], Set[str]], max_age: int, max_bytes: int) -> int:
+        now = time.time()
+        removed = 0
+        entries = self._entries()
+        valid_tokens = keep({e.token for e in entries if e.path.endswith(_SUFFIX)})
+        version_key = self._version_key()
+
+        remaining = []
+        for e in entries:
+            if e.path.endswith(_SUFFIX):
+                # 过期的文件、旧数据版本的文件，以及已被重置或长期未使用的令牌的文件
+                stale = now - e.mtime > max_age or not self._is_version(e.path, version_key) \
+                        or e.token not in valid_tokens
+            else:
+                # 残留的临时文件和旧版本直接写入的 <令牌>.ics
+                stale = now - e.mtime > 3600
+            if stale:
+                removed += self._remove(e.path)
+            else:
+                remaining.append(e)
+
+        total = sum(e.size for e in remaining)
+        for e in sorted(remaining, key=lambda x: x.mtime):
+            if total <= max_bytes:
+                break
+            removed += self._remove(e.path)
+            total -= e.size
+        return removed
+
+
+class SharedMemoryStorage(LocalDiskStorage):
+    """共享内存存储，位于 /dev/shm 的目录"""
+
+    def __init__(self, directory: str = '/dev/shm/everyclass_ics', version: Optional[Callable[[], str]] = None):
+        super().__init__(directory, version)
+
+
+class RedisStorage(ICSStorage):
+    """Redis 存储，使用 `ICS_CACHE_EXPIRE` 作为过期时间，不需要垃圾回收"""
+
+    def get(self, token: str, etag: str) -> Optional[bytes]:
+        from everyclass.server.db.dao import Redis
+        return Redis.get_ics(token, etag)
+
+    def put(self, token: str, etag: str, body: bytes) -> None:
+        from everyclass.server.db.dao import Redis
+        Redis.set_ics(token, etag, body, app.config['ICS_CACHE_EXPIRE'])
+
+    def delete(self, token: str) -> None:
+        from everyclass.server.db.dao import Redis
+        Redis.delete_ics(token)
+
+
+def file_response(path: str, delivery: str) -> Response:
+    """
+    构造由 Web 服务器发送本地文件的响应，文件内容不经过 Python
+
+    :param path: 文件路径
+    :param delivery: sendfile、x-accel 或 x-sendfile
+    """
+    response = Response(mimetype='text/calendar')
+    if delivery == 'x-accel':
+        response.headers['X-Accel-Redirect'] = app.config['ICS_ACCEL_REDIRECT_PREFIX'] + os.path.basename(path)
+    elif delivery == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    elif delivery == 'sendfile':
+        f = open(path, 'rb')
+        response.response = wrap_file(request.environ, f)
+        response.direct_passthrough = True
+        response.content_length = os.fstat(f.fileno()).st_size
+    else:
+        raise ValueError("Unknown ICS delivery mode: {}".format(delivery))
+    return response
+
+
+_storage: Optional[ICSStorage] = None
+
+
+def get_storage() -> ICSStorage:
+    """根据配置获得存储后端（需要在 app context 中调用）"""
+    from everyclass.server.calendar.cache import data_version
+
+    global _storage
+    if _storage is None:
+        backend = app.config['ICS_STORAGE']
+        if backend == 'disk':
+            _storage = LocalDiskStorage(app.config['ICS_STORAGE_DIR'], data_version)
+        elif backend == 'shm':
+            _storage = SharedMemoryStorage(version=data_version)
+        elif backend == 'redis':
+            _storage = RedisStorage()
+        else:
+            raise ValueError("Unknown ICS storage backend: {}".format(backend))
+    return _storage
+
+
+def delete_tokens(tokens: Iterable[str]) -> None:
+    """删除令牌对应的文件，在令牌被重置后调用"""
+    storage = get_storage()
+    for token in tokens:
+        storage.delete(token)
+
+
+def collect_garbage() -> int:
+    """
+    清理存储（需要在 app context 中调用）。除了配置的后端，也清理旧版本在 calendar_files 目录中留下的文件
+
+    :return: 删除的文件数
+    """
+    from everyclass.server.calendar.cache import data_version
+    from everyclass.server.db.dao import CalendarToken
+
+    since = datetime.datetime.now() - datetime.timedelta(days=app.config['ICS_TOKEN_UNUSED_DAYS'])
+
+    def keep(tokens: Set[str]) -> Set[str]:
+        return CalendarToken.filter_active_tokens(tokens, since)
+
+    storages = [get_storage()]
+    if not (isinstance(storages[0], LocalDiskStorage) and
+            os.path.abspath(storages[0].directory) == os.path.abspath(app.config['ICS_STORAGE_DIR'])):
+        storages.append(LocalDiskStorage(app.config['ICS_STORAGE_DIR'], data_version))
+
+    removed = sum(s.gc(keep, app.config['ICS_STORAGE_MAX_AGE'], app.config['ICS_STORAGE_MAX_BYTES'])
+                  for s in storages)
+    logger.info("ICS storage garbage collected", {"removed": removed})
+    return removed
@@ -1,7 +1,7 @@
 """
 日历相关函数
 """
-from typing import Dict, List, Tuple
+from typing import Dict, List
 
 import elasticapm
 from flask import Blueprint
@@ -72,51 +72,80 @@ def ics_download(calendar_token: str):
     """
     iCalendar ics file download
 
-    因为课表会更新，所以 ics 文件只能在这里动态生成，不能在日历订阅页面就生成
-    """
-    from collections import defaultdict
+    因为课表会更新，所以 ics 文件只能在这里动态生成，不能在日历订阅页面就生成。同一数据版本下的输出是确定的，
+    所以使用强 ETag：客户端带着相同的 `If-None-Match` 轮询时直接返回 304，否则优先返回缓存中 gzip 压缩过的文件。
+
+    URL 参数 compact=1 时使用 RRULE 合并重复的课程，文件体积小得多。
 
-    from flask import send_from_directory
+    ics 中带有按客户端类型配置的建议刷新间隔，响应的 Cache-Control/Expires 则以距离下次数据更新的时间为上限，以减少轮询。
+
+    使用本地目录存储且客户端接受 gzip 时，可以按 `ICS_DELIVERY` 把文件的发送交给 uWSGI 或前端代理。
+    """
     from everyclass.server.db.dao import CalendarToken
-    from everyclass.server.models import Semester
-    from everyclass.server.calendar import ics_generator
-    from everyclass.server.rpc.api_server import APIServer, teacher_list_to_name_str
-    from everyclass.server.utils import lesson_string_to_tuple
 
     result = CalendarToken.find_calendar_token(token=calendar_token)
     if not result:
         return 'invalid calendar token', 404
 
-    CalendarToken.update_last_used_time(calendar_token)
-
-    # 获得原始学号或教工号
-    if result['type'] == 'student':
-        rpc_result = APIServer.get_student_timetable(result['identifier'], result['semester'])
-    else:
-        # teacher
-        rpc_result = APIServer.get_teacher_timetable(result['identifier'], result['semester'])
+    return _serve_ics(calendar_token, result)
 
-    with elasticapm.capture_span('process_rpc_result'):
-        semester = Semester(result['semester'])
 
-        cards: Dict[Tuple[int, int], List[Dict]] = defaultdict(list)
-        for card in rpc_result.cards:
-            day, time = lesson_string_to_tuple(card.lesson)
-            cards[(day, time)].append(dict(name=card.name,
-                                           teacher=teacher_list_to_name_str(card.teachers),
-                                           week=card.weeks,
-                                           week_string=card.week_string,
-                                           classroom=card.room,
-                                           cid=card.card_id_encoded))
+def _serve_ics(calendar_token: str, token_doc: Dict):
+    """返回令牌对应的 ics 文件，`token_doc` 为令牌文档（type、identifier、semester）"""
+    import datetime
+    import gzip
 
-    ics_generator.generate(name=rpc_result.name,
-                           cards=cards,
-                           semester=semester,
-                           ics_token=calendar_token)
+    from flask import Response, current_app as app, request
+    from everyclass.server.calendar.cache import cache_max_age, client_refresh_interval, client_type, make_etag, \
+        render_ics
+    from everyclass.server.calendar.storage import file_response, get_storage
+    from everyclass.server.db.dao import CalendarToken, Redis
 
-    return send_from_directory("../../calendar_files", calendar_token + ".ics",
-                               as_attachment=True,
-                               mimetype='text/calendar')
+    CalendarToken.update_last_used_time(calendar_token)
+    Redis.incr_calendar_poll_count(calendar_token)
+
+    compact = request.args.get('compact', '1' if app.config['ICS_COMPACT_DEFAULT'] else '0') == '1'
+    refresh_interval = client_refresh_interval(client_type(request.user_agent.string))
+    etag = make_etag(calendar_token, compact, refresh_interval)
+    # 存储按 etag 保存 gzip 后的内容；响应中的强校验值要区分内容编码（RFC 7232 2.3.3），否则缓存可能返回错误编码的内容
+    accept_gzip = 'gzip' in request.accept_encodings
+    response_etag = etag + '-gzip' if accept_gzip else etag
+
+    now = datetime.datetime.now()
+    max_age = cache_max_age(refresh_interval, now)
+
+    def set_cache_headers(resp: Response) -> Response:
+        resp.set_etag(response_etag)
+        resp.cache_control.private = True
+        resp.cache_control.max_age = max_age
+        resp.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=max_age)
+        return resp
+
+    if request.if_none_match.contains(response_etag):
+        return set_cache_headers(Response(status=304))
+
+    storage = get_storage()
+    offload = app.config['ICS_DELIVERY'] != 'python' and accept_gzip
+    path = storage.file_path(calendar_token, etag) if offload else None
+    if not path:
+        body = storage.get(calendar_token, etag)
+        if not body:
+            with elasticapm.capture_span('generate_ics'):
+                body = render_ics(token_doc, compact, refresh_interval)
+            storage.put(calendar_token, etag, body)
+            path = storage.file_path(calendar_token, etag) if offload else None
+
+    if path:
+        response = file_response(path, app.config['ICS_DELIVERY'])
+        response.headers['Content-Encoding'] = 'gzip'
+    elif accept_gzip:
+        response = Response(body, mimetype='text/calendar')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(gzip.decompress(body), mimetype='text/calendar')
+    response.headers['Content-Disposition'] = 'attachment; filename={}.ics'.format(calendar_token)
+    response.vary.add('Accept-Encoding')
+    return set_cache_headers(response)
 
 
 @cal_blueprint.route('/calendar/ics/_androidClient/<identifier>')
@@ -153,10 +182,10 @@ def android_client_get_ics(resource_type, identifier, semester):
     If the privacy mode is on and there is no HTTP basic authentication, return a 401(unauthorized)
     status code and the Android client ask user for password to try again.
     """
-    from flask import redirect, url_for, request
+    from flask import request
 
-    from everyclass.server.db.dao import PrivacySettings, CalendarToken, User
-    from everyclass.server.rpc.api_server import APIServer
+    from everyclass.server.db.dao import PrivacySettings, CalendarToken
+    from everyclass.server.utils.credential_cache import check_password
     from everyclass.server.utils.resource_identifier_encrypt import decrypt
 
     # 检查 URL 参数
@@ -167,39 +196,61 @@ def android_client_get_ics(resource_type, identifier, semester):
     if resource_type not in ('student', 'teacher') or resource_type != res_type:
         return "Unknown resource type", 400
 
-    if resource_type == 'teacher':
-        try:
-            teacher = APIServer.get_teacher_timetable(res_id, semester)
-        except Exception as e:
-            return handle_exception_with_error_page(e)
-
-        cal_token = CalendarToken.get_or_set_calendar_token(resource_type=resource_type,
-                                                            identifier=teacher.teacher_id,
-                                                            semester=semester)
-        return redirect(url_for('calendar.ics_download', calendar_token=cal_token))
-    else:  # student
-        try:
-            student = APIServer.get_student_timetable(res_id, semester)
-        except Exception as e:
-            return handle_exception_with_error_page(e)
+    # 只需要确认这个人在该学期有课表，使用缓存的学期列表，不获取完整课表
+    try:
+        semesters = _get_semesters(resource_type, res_id)
+    except Exception as e:
+        return handle_exception_with_error_page(e)
+    if semester not in semesters:
+        return "Semester not found", 404
 
+    if resource_type == 'student':
         with elasticapm.capture_span('get_privacy_settings'):
-            privacy_level = PrivacySettings.get_level(student.student_id)
+            privacy_level = PrivacySettings.get_level(res_id)
 
         # get authorization from HTTP header and verify password if privacy is on
         if privacy_level != 0:
             if not request.authorization:
                 return "Unauthorized (privacy on)", 401
             username, password = request.authorization
-            if not User.check_password(username, password):
+            try:
+                password_correct = check_password(username, password)
+            except ValueError:  # 用户未注册
+                password_correct = False
+            if not password_correct:
                 return "Unauthorized (password wrong)", 401
-            if student.student_id != username:
+            if res_id != username:
                 return "Unauthorized (username mismatch)", 401
 
-        cal_token = CalendarToken.get_or_set_calendar_token(resource_type=resource_type,
-                                                            identifier=student.student_id,
-                                                            semester=semester)
-        return redirect(url_for('calendar.ics_download', calendar_token=cal_token))
+    # 直接返回 ics 文件，不再重定向到 ics_download 再查询一次令牌、获取一次课表
+    cal_token = CalendarToken.get_or_set_calendar_token(resource_type=resource_type,
+                                                        identifier=res_id,
+                                                        semester=semester)
+    return _serve_ics(cal_token, {"type"      : resource_type,
+                                  "identifier": res_id,
+                                  "semester"  : semester,
+                                  "token"     : cal_token})
+
+
+def _get_semesters(resource_type: str, identifier: str) -> List[str]:
+    """
+    获得学生或老师有课表的学期列表，结果缓存在 Redis 中直到数据更新
+
+    缓存键中的数据版本是所有 worker 共享的版本（由刷新任务写入 Redis），各 worker 读写的是同一份缓存，数据更新后同时失效
+    """
+    from everyclass.server.calendar.cache import data_version
+    from everyclass.server.db.dao import Redis
+    from everyclass.server.rpc.api_server import APIServer
+
+    version = data_version()  # 读写使用同一个版本，不会把旧数据写到新版本的键下
+    semesters = Redis.get_semesters(resource_type, identifier, version)
+    if semesters is None:
+        if resource_type == 'student':
+            semesters = APIServer.get_student(identifier).semesters
+        else:
+            semesters = APIServer.get_teacher(identifier).semesters
+        Redis.set_semesters(resource_type, identifier, version, semesters)
+    return semesters
 
 
 @cal_blueprint.route('/<student_id>-<semester_str>.ics')
@@ -0,0 +1,167 @@
+"""
+教室占用位图索引
+
+每晚由定时任务从 api-server 拉取所有教室的课表，构建“时间格 × 教室”的占用位图并写入文件。文件通过 mmap 映射，同一台机器上的
+所有 worker 共享同一份页缓存。查询“第 W 周星期 D 第 S 节有哪些空教室”只需要读出对应时间格的一行位图，再与校区、楼栋掩码做
+按位运算，不再需要逐个教室调用 `get_classroom_timetable`。
+
+文件格式：
+- 4 字节 magic `ECOI`，4 字节小端无符号整数表示 header 长度
+- header：UTF-8 编码的 JSON，包含学期、周数和教室列表（教室在列表中的下标即其在位图中的位）
+- 位图矩阵：共 weeks * 42 行，行号为 `slot_index(week, day, time)`，每行 ceil(教室数 / 8) 字节，小端序，
+  第 i 位为 1 表示第 i 个教室在该时间格有课
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from everyclass.server import logger
+from everyclass.server.config import get_config
+from everyclass.server.utils import SLOTS_PER_WEEK, iter_bits, lesson_string_to_tuple, slot_index
+
+MAGIC = b'ECOI'
+_HEADER = struct.Struct('<4sI')
+
+
+def index_path(semester: str) -> str:
+    """某学期的教室占用索引文件路径"""
+    return os.path.join(get_config().INDEX_FILES_DIR, 'classroom_occupancy_{}.idx'.format(semester))
+
+
+def write_index(path: str, semester: str, rooms: List[Dict], rows: List[int]) -> None:
+    """
+    写入索引文件。先写临时文件再重命名，正在读取旧文件的 worker 不受影响
+
+    :param path: 文件路径
+    :param semester: 学期
+    :param rooms: 教室列表，每个元素包含 room_id、name、campus、building
+    :param rows: 按时间格编号排列的位图，长度为 SLOTS_PER_WEEK 的整数倍
+    """
+    row_bytes = (len(rooms) + 7) // 8
+    header = json.dumps({"semester": semester,
+                         "weeks"   : len(rows) // SLOTS_PER_WEEK,
+                         "rooms"   : rooms}, ensure_ascii=False).encode('utf-8')
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        for row in rows:
+            f.write(row.to_bytes(row_bytes, 'little'))
+    os.replace(tmp_path, path)
+
+
+def build_index(semester: str) -> None:
+    """从 api-server 拉取该学期所有教室的课表并生成索引文件（需要在 app context 中调用）"""
+    from everyclass.server.rpc.api_server import APIServer
+
+    rooms = APIServer.get_classroom_list(semester)
+    rows: List[int] = []
+    for room_index, room in enumerate(rooms):
+        timetable = APIServer.get_classroom_timetable(semester, room.room_id)
+        for card in timetable.cards:
+            day, time = lesson_string_to_tuple(card.lesson)
+            for week in card.weeks:
+                slot = slot_index(week, day, time)
+                if slot >= len(rows):
+                    rows.extend([0] * ((slot // SLOTS_PER_WEEK + 1) * SLOTS_PER_WEEK - len(rows)))
+                rows[slot] |= 1 << room_index
+
+    write_index(index_path(semester),
+                semester,
+                [{"room_id" : room.room_id,
+                  "name"    : room.name,
+                  "campus"  : room.campus,
+                  "building": room.building} for room in rooms],
+                rows)
+    logger.info("Classroom occupancy index built", {"semester": semester, "rooms": len(rooms)})
+
+
+class OccupancyIndex:
+    """只读的教室占用索引，底层为 mmap 映射的索引文件"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_len = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a classroom occupancy index file: {}".format(path))
+        header = json.loads(self._mm[_HEADER.size:_HEADER.size + header_len].decode('utf-8'))
+
+        self.semester: str = header['semester']
+        self.weeks: int = header['weeks']
+        self.rooms: List[Dict] = header['rooms']
+        self._offset = _HEADER.size + header_len
+        self._row_bytes = (len(self.rooms) + 7) // 8
+
+        # 校区、楼栋掩码在加载时一次算好
+        self._all_mask = (1 << len(self.rooms)) - 1
+        self._campus_masks: Dict[str, int] = {}
+        self._building_masks: Dict[str, int] = {}
+        for i, room in enumerate(self.rooms):
+            self._campus_masks[room['campus']] = self._campus_masks.get(room['campus'], 0) | (1 << i)
+            self._building_masks[room['building']] = self._building_masks.get(room['building'], 0) | (1 << i)
+
+    @property
+    def campuses(self) -> List[str]:
+        return sorted(self._campus_masks)
+
+    @property
+    def buildings(self) -> List[str]:
+        return sorted(self._building_masks)
+
+    def _row(self, slot: int) -> int:
+        start = self._offset + slot * self._row_bytes
+        return int.from_bytes(self._mm[start:start + self._row_bytes], 'little')
+
+    def free_rooms(self, week: int, day: int, times: Iterable[int], campus: Optional[str] = None,
+                   building: Optional[str] = None) -> List[Dict]:
+        """
+        查询空闲教室
+
+        :param week: 周次
+        :param day: 星期
+        :param times: 节次（1-6），传入多个时表示这些节次都需要空闲
+        :param campus: 限定校区
+        :param building: 限定楼栋
+        :return: 教室列表
+        """
+        busy = 0
+        if 1 <= week <= self.weeks:
+            for time in times:
+                busy |= self._row(slot_index(week, day, time))
+
+        mask = self._all_mask
+        if campus:
+            mask &= self._campus_masks.get(campus, 0)
+        if building:
+            mask &= self._building_masks.get(building, 0)
+        return [self.rooms[i] for i in iter_bits(~busy & mask)]
+
+
+_indexes: Dict[str, OccupancyIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(semester: str) -> Optional[OccupancyIndex]:
+    """
+    获得某学期的索引。索引文件被定时任务替换后会自动重新映射，文件不存在时返回 None
+
+    旧的映射可能仍在被其他线程读取，因此不主动 close，由垃圾回收释放
+    """
+    path = index_path(semester)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+    with _indexes_lock:
+        index = _indexes.get(semester)
+        if index is None or index.mtime != mtime:
+            index = OccupancyIndex(path)
+            _indexes[semester] = index
+    return index
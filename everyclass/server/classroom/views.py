@@ -0,0 +1,71 @@
+"""
+空教室查询
+"""
+import datetime
+
+import elasticapm
+from flask import Blueprint, render_template, request
+
+from everyclass.server.classroom.occupancy import get_index
+from everyclass.server.config import get_config
+from everyclass.server.consts import MSG_400, MSG_INDEX_NOT_READY
+from everyclass.server.models import Semester
+from everyclass.server.utils import get_time_chinese
+from everyclass.server.utils.decorators import disallow_in_maintenance
+from everyclass.server.utils.resource_identifier_encrypt import encrypt
+
+classroom_bp = Blueprint('classroom', __name__)
+
+
+def _current_week_and_day(semester: Semester):
+    """根据学期开始日期计算今天是第几周、星期几"""
+    start = datetime.date(*get_config().AVAILABLE_SEMESTERS[semester.to_tuple()]['start'])
+    today = datetime.date.today()
+    return max((today - start).days // 7 + 1, 1), today.isoweekday()
+
+
+@classroom_bp.route('/classroom/free')
+@disallow_in_maintenance
+def free_classroom():
+    """
+    空教室查询
+
+    参数均为可选：semester（默认最新学期）、week、day（默认今天）、time（可以传多个，要求这些节次都空闲）、campus、building
+    """
+    config = get_config()
+    semester = Semester(request.args.get('semester') or max(config.AVAILABLE_SEMESTERS))
+    if semester.to_tuple() not in config.AVAILABLE_SEMESTERS:
+        return render_template('common/error.html', message=MSG_400)
+
+    index = get_index(semester.to_str())
+    if not index:
+        return render_template('common/error.html', message=MSG_INDEX_NOT_READY)
+
+    current_week, current_day = _current_week_and_day(semester)
+    try:
+        week = int(request.args.get('week', current_week))
+        day = int(request.args.get('day', current_day))
+        times = [int(x) for x in request.args.getlist('time')] or [1]
+    except ValueError:
+        return render_template('common/error.html', message=MSG_400)
+    if not 1 <= day <= 7 or any(not 1 <= t <= 6 for t in times):
+        return render_template('common/error.html', message=MSG_400)
+
+    campus = request.args.get('campus') or None
+    building = request.args.get('building') or None
+
+    with elasticapm.capture_span('free_rooms'):
+        rooms = [dict(room, room_id_encoded=encrypt('room', room['room_id']))
+                 for room in index.free_rooms(week, day, times, campus=campus, building=building)]
+
+    return render_template('classroom/free.html',
+                           rooms=rooms,
+                           semester=semester.to_str(),
+                           week=week,
+                           day=day,
+                           times=times,
+                           time_names=[get_time_chinese(t) for t in times],
+                           campus=campus,
+                           building=building,
+                           campuses=index.campuses,
+                           buildings=index.buildings)
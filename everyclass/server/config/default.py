@@ -83,6 +83,13 @@ class Config(object):
         'port'    : 5432
     }
     POSTGRES_SCHEMA = 'everyclass_server'
+    POSTGRES_CHECKOUT_TIMEOUT = 5  # 从连接池取连接最多等待的时间（秒）
+    POSTGRES_HEALTH_CHECK_INTERVAL = 60  # 连接空闲超过这么多秒后，取出时先做一次健康检查
+    POSTGRES_LEAK_THRESHOLD = 10  # 连接被占用超过这么多秒时打出警告
+    POSTGRES_PREPARED_STATEMENTS = True  # 高频查询使用服务端预备语句（dao.PreparedStatement），不支持时会自动回退
+    USER_ID_BLOCK_SIZE = 100  # 匿名用户 ID 序列的步长，每个进程每次保留这么多个 ID（修改后需要重新执行 UserIdSequence.init）
+    MIGRATION_BATCH_SIZE = 5000  # 从 MongoDB 迁移数据时每批（每个事务）写入的行数
+    MIGRATION_PARALLELISM = 4  # 同时迁移的表数
 
     # server side session
     SESSION_TYPE = 'mongodb'
@@ -188,6 +195,71 @@ class Config(object):
         }
     }
 
+    # 教室占用索引等本地索引文件的存放目录
+    INDEX_FILES_DIR = os.path.join(os.getcwd(), 'index_files')
+
+    ICS_CACHE_EXPIRE = 86400 * 2  # 生成的 ics 文件缓存时间（秒），数据版本变化后旧缓存自然失效
+    ICS_COMPACT_DEFAULT = False  # ics 默认是否使用 RRULE 合并重复课程，可以通过 URL 参数 compact=0/1 覆盖
+
+    # 生成的 ics 文件存储：disk（本地目录）、shm（/dev/shm）或 redis
+    ICS_STORAGE = 'redis'
+    ICS_STORAGE_DIR = os.path.join(os.getcwd(), 'calendar_files')
+    ICS_STORAGE_MAX_AGE = 86400 * 7  # 本地文件最长保留时间（秒）
+    ICS_STORAGE_MAX_BYTES = 512 * 1024 * 1024  # 本地文件总大小上限
+    ICS_TOKEN_UNUSED_DAYS = 30  # 超过这么多天未被使用的令牌，清理其文件
+    # 本地存储的 ics 文件的发送方式：python、sendfile（uWSGI，配合 offload-threads）、x-accel（nginx）或 x-sendfile
+    ICS_DELIVERY = 'python'
+    # x-accel 模式下 nginx 中对应 ICS_STORAGE_DIR 的 internal location，例如：
+    # location /_calendar_files/ { internal; alias /var/app/calendar_files/; add_header Content-Encoding gzip; }
+    ICS_ACCEL_REDIRECT_PREFIX = '/_calendar_files/'
+    ICS_PREGENERATE_DAYS = 7  # 数据更新后为最近这么多天内使用过的令牌预生成 ics 文件
+    ICS_PREGENERATE_RATE = 20  # 预生成时每秒最多向 api-server 发出的请求数
+
+    # 数据每天更新、预生成完成的时间（时, 分），ics 响应的 HTTP 缓存时间不会超过这个时间点
+    DATA_REFRESH_TIME = (0, 30)
+    DATA_VERSION_CACHE_SECONDS = 5  # 各进程缓存 Redis 中共享的数据版本的时间（秒）
+    # 写入 ics 的建议刷新间隔（秒），按客户端类型配置。客户端类型根据 User-Agent 中的关键字判断
+    ICS_REFRESH_INTERVALS = {
+        'default': 3600 * 6,
+        'ios'    : 3600 * 6,
+        'google' : 3600 * 12,
+        'outlook': 3600 * 6,
+        'android': 3600 * 6,
+    }
+    ICS_CLIENT_USER_AGENTS = {
+        'android': ('EveryClass', 'okhttp'),
+        'ios'    : ('iOS', 'iPhone', 'dataaccessd', 'CalendarAgent', 'Mac OS X', 'macOS'),
+        'google' : ('Google-Calendar-Importer',),
+        'outlook': ('Microsoft Outlook', 'Microsoft Office', 'Exchange'),
+    }
+    ICS_POLL_COUNT_DAYS = 14  # 每个令牌每天的轮询次数保留天数
+
+    # 搜索时可以直接识别并跳转的学号、教工号格式
+    IDENTIFIER_PATTERNS = {
+        'student': r'^\d{10}$',
+        'teacher': r'^\d{6,8}$'
+    }
+
+    # 安卓客户端 HTTP Basic 认证中验证通过的凭据在进程内缓存的时间（秒）和最大条目数
+    CREDENTIAL_CACHE_TTL = 600
+    CREDENTIAL_CACHE_MAX_ENTRIES = 10000
+
+    # 隐私级别在进程内缓存的时间（秒）和最大条目数。级别变化时会通过 Redis 发布订阅立即失效，这里的时间只是兜底
+    PRIVACY_CACHE_TTL = 3600
+    PRIVACY_CACHE_MAX_ENTRIES = 50000
+
+    # 访客记录在进程内缓存，每隔这么多秒批量写入数据库；缓存的条数达到上限时立即写入
+    VISIT_TRACK_FLUSH_INTERVAL = 10
+    VISIT_TRACK_BUFFER_MAX = 5000
+    # 访客页面每页显示的访客数；每个人只保留最近这么多位访客，更早的记录每天凌晨分批删除
+    VISITORS_PER_PAGE = 20
+    VISIT_TRACK_MAX_PER_HOST = 1000
+    VISIT_TRACK_PRUNE_BATCH = 5000
+
+    # 多人共同空闲时间查询
+    FREE_TIME_MAX_MEMBERS = 50  # 一次最多查询的人数
+    FREE_TIME_CACHE_EXPIRE = 3600 * 6  # 结果缓存时间（秒）
+
     ANDROID_CLIENT_URL = ''  # apk file for android client, dynamically fetched when starting
 
     FEATURE_GATING = {
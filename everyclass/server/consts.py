@@ -26,6 +26,7 @@ MSG_TOKEN_INVALID = "令牌无效或已过期，请重新注册。"
 MSG_INVALID_IDENTIFIER = "无效的资源标识，请使用正常方法查询，不要拼接URL。"
 MSG_NOT_IN_COURSE = "您不是该门课程的学生，无法评价该门课程。"
 MSG_503 = "服务当前不可用，可能是程序员小哥哥正在更新数据哦，请稍后重试。"
+MSG_INDEX_NOT_READY = "数据正在生成中，请稍后再试。"
 
 """
 flash
@@ -15,17 +15,29 @@ CREATE EXTENSION hstore SCHEMA everyclass_server;
   Discourse 也有使用到此扩展。虽然 crate extension 语句看起来像是“创建扩展”，但实际上是在本模式下“启用扩展”
 """
 import abc
+import atexit
 import datetime
+import json
+import os
+import threading
+import time
 import uuid
-from typing import Dict, List, Optional, Union, overload
+import weakref
+from typing import Dict, List, Optional, Set, Tuple, Union, overload
 
+import psycopg2
 from flask import session
+from psycopg2 import errorcodes
+from psycopg2.extras import execute_values
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from everyclass.server import logger
 from everyclass.server.config import get_config
+from everyclass.server.db.migration import Migration, init_checkpoints, run_all as run_migrations, run_once
 from everyclass.server.db.mongodb import get_connection as get_mongodb
 from everyclass.server.db.postgres import pg_conn_context
 from everyclass.server.db.redis import redis
+from everyclass.server.exceptions import PoolTimeout
 from everyclass.server.models import StudentSession
 from everyclass.server.rpc.api_server import CardResult, teacher_list_to_tid_str
 
@@ -39,6 +51,78 @@ def new_user_id_sequence() -> int:
     return UserIdSequence.new()
 
 
+class PreparedStatement:
+    """
+    服务端预备语句
+
+    几条高频查询每分钟要执行成千上万次，每次 Postgres 都要重新解析、生成执行计划。这里在每个连接上第一次使用某条语句时
+    PREPARE，之后只发送 EXECUTE。语句仍然用 %s 占位符书写，PREPARE 时按顺序替换为 $1、$2……
+
+    连接断开重连后，或者在 PgBouncer 的事务池模式下，预备语句可能不存在或重名。遇到这类错误时回滚当前事务，忘记这个连接上
+    已经 PREPARE 的语句并改为普通执行，所以这些语句必须是所在事务中的第一条语句。同一进程中累计出错 `_MAX_FAILURES` 次后
+    认为环境不支持预备语句，之后直接普通执行。也可以通过 `POSTGRES_PREPARED_STATEMENTS` 关闭。
+    """
+    _registry: Dict[str, 'PreparedStatement'] = {}
+    _prepared = weakref.WeakKeyDictionary()  # psycopg2 原始连接 -> 已经 PREPARE 过的语句名集合
+    _lock = threading.Lock()
+    _failures = 0
+
+    _MAX_FAILURES = 3
+    _FALLBACK_ERRORS = (errorcodes.INVALID_SQL_STATEMENT_NAME, errorcodes.DUPLICATE_PREPARED_STATEMENT)
+
+    def __init__(self, name: str, sql: str):
+        if name in self._registry:
+            raise ValueError("prepared statement {} already registered".format(name))
+        self.name = name
+        self.sql = sql
+
+        parts = sql.split('%s')
+        body = parts[0]
+        for i, part in enumerate(parts[1:], start=1):
+            body += '${}{}'.format(i, part)
+        self.prepare_sql = "PREPARE {} AS {}".format(name, body)
+        self.execute_sql = "EXECUTE {}({})".format(name, ','.join(['%s'] * (len(parts) - 1))) if len(parts) > 1 \
+            else "EXECUTE {}".format(name)
+        self._registry[name] = self
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls._failures < cls._MAX_FAILURES and get_config().POSTGRES_PREPARED_STATEMENTS
+
+    def execute(self, conn, cursor, params: tuple = ()) -> None:
+        """在 `cursor` 上执行语句，`conn` 为 `pg_conn_context` 得到的连接"""
+        if not self.enabled():
+            cursor.execute(self.sql, params)
+            return
+
+        raw_conn = getattr(getattr(conn, '_con', None), '_con', conn)  # PooledDB 连接 -> SteadyDB -> psycopg2 连接
+        with self._lock:
+            prepared = self._prepared.setdefault(raw_conn, set())
+        try:
+            if self.name not in prepared:
+                cursor.execute(self.prepare_sql)
+                prepared.add(self.name)
+            cursor.execute(self.execute_sql, params)
+        except psycopg2.Error as e:
+            if e.pgcode not in self._FALLBACK_ERRORS:
+                raise
+            conn.rollback()
+            prepared.clear()
+            with self._lock:
+                PreparedStatement._failures += 1
+                if PreparedStatement._failures == self._MAX_FAILURES:
+                    logger.warning("Prepared statements disabled, falling back to plain queries",
+                                   {"statement": self.name, "error": repr(e)})
+            cursor.execute(self.sql, params)
+
+
+_STMT_PRIVACY_LEVEL = PreparedStatement("ec_privacy_level", "SELECT level FROM privacy_settings WHERE student_id=%s")
+_STMT_CALENDAR_TOKEN = PreparedStatement("ec_calendar_token", """
+    SELECT type, identifier, semester, token, create_time, last_used_time FROM calendar_tokens WHERE token=%s
+""")
+_STMT_USER_EXIST = PreparedStatement("ec_user_exist", "SELECT create_time FROM users WHERE student_id=%s")
+
+
 class MongoDAOBase(abc.ABC):
     collection_name: str = NotImplemented
 
@@ -49,22 +133,117 @@ class MongoDAOBase(abc.ABC):
 
 
 class PostgresBase(abc.ABC):
+    migration: Optional[Migration] = None  # 从 MongoDB 迁移数据的方式，没有需要迁移的数据时为 None
+
     @classmethod
     @abc.abstractmethod
     def init(cls) -> None:
         """建立表和索引"""
         pass
 
+    @classmethod
+    def after_migration(cls) -> None:
+        """从 MongoDB 迁移完成后执行，用于整理迁移进来的数据"""
+        pass
+
 
 class PrivacySettings(PostgresBase):
-    """隐私级别"""
+    """
+    隐私级别
+
+    学生页面、安卓客户端同步和用户主页每次都要读取隐私级别（权限检查时可能读取两次），而它几乎不会变化，所以在每个进程内
+    缓存（包括未设置、使用默认级别的情况）。`set_level` 通过 Redis 的发布订阅通知所有节点的所有进程删除对应的缓存。
+
+    只有订阅线程正常运行时才使用缓存；订阅断开期间可能错过通知，所以断开时清空缓存，重新订阅成功之后再启用。
+    """
+    migration = Migration(name="privacy_settings",
+                          collection="privacy_settings",
+                          table="privacy_settings",
+                          columns=("student_id", "level", "create_time"),
+                          transform=lambda each: (each['sid_orig'], each['level'], each['create_time']))
+
+    _cache: Dict[str, Tuple[Optional[int], float]] = {}  # 学号 -> (隐私级别，未设置时为 None；过期时间)
+    _cache_lock = threading.Lock()
+    _generation = 0  # 每次删除缓存时增加，避免把删除之前从数据库读到的旧值写入缓存
+    _listening = False
+
     @classmethod
     def get_level(cls, student_id: str) -> int:
-        with pg_conn_context() as conn, conn.cursor() as cursor:
-            select_query = "SELECT level FROM privacy_settings WHERE student_id=%s"
-            cursor.execute(select_query, (student_id,))
-            result = cursor.fetchone()
-        return result[0] if result is not None else get_config().DEFAULT_PRIVACY_LEVEL
+        return cls.get_levels([student_id])[student_id]
+
+    @classmethod
+    def get_levels(cls, student_ids: List[str]) -> Dict[str, int]:
+        """
+        批量获得隐私级别，未设置的返回默认级别
+
+        优先使用缓存，未命中的学生只用一次 `= ANY(%s)` 查询，列表页面不需要为每个人查询一次
+        """
+        config = get_config()
+        now = time.monotonic()
+        levels: Dict[str, Optional[int]] = {}
+        missing = []
+        for student_id in set(student_ids):
+            entry = cls._cache.get(student_id) if cls._listening else None
+            if entry and entry[1] > now:
+                levels[student_id] = entry[0]
+            else:
+                missing.append(student_id)
+
+        if missing:
+            generation = cls._generation
+            with pg_conn_context() as conn, conn.cursor() as cursor:
+                if len(missing) == 1:
+                    _STMT_PRIVACY_LEVEL.execute(conn, cursor, (missing[0],))
+                    result = cursor.fetchone()
+                    found = {missing[0]: result[0]} if result is not None else {}
+                else:
+                    select_query = "SELECT student_id, level FROM privacy_settings WHERE student_id = ANY(%s)"
+                    cursor.execute(select_query, (missing,))
+                    found = dict(cursor.fetchall())
+            for student_id in missing:
+                levels[student_id] = found.get(student_id)  # 未设置时为 None
+
+            if cls._listening:
+                with cls._cache_lock:
+                    if generation == cls._generation:
+                        if len(cls._cache) + len(missing) > config.PRIVACY_CACHE_MAX_ENTRIES:
+                            cls._cache.clear()
+                        for student_id in missing:
+                            cls._cache[student_id] = (levels[student_id], now + config.PRIVACY_CACHE_TTL)
+
+        return {student_id: level if level is not None else config.DEFAULT_PRIVACY_LEVEL
+                for student_id, level in levels.items()}
+
+    @classmethod
+    def invalidate(cls, student_id: Optional[str] = None) -> None:
+        """删除本进程中一个学生（不指定时为全部）的缓存"""
+        with cls._cache_lock:
+            cls._generation += 1
+            if student_id:
+                cls._cache.pop(student_id, None)
+            else:
+                cls._cache.clear()
+
+    @classmethod
+    def start_invalidation_listener(cls) -> None:
+        """启动订阅隐私级别变化的后台线程，需要在 fork 之后的每个进程中调用"""
+        threading.Thread(target=cls._listen, name="privacy-invalidation", daemon=True).start()
+
+    @classmethod
+    def _listen(cls) -> None:
+        while True:
+            try:
+                pubsub = Redis.subscribe_privacy_changes()
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        cls._listening = True
+                    elif message['type'] == 'message':
+                        cls.invalidate(message['data'].decode())
+            except Exception as e:
+                logger.warning("Privacy level invalidation listener disconnected", {"error": repr(e)})
+            cls._listening = False
+            cls.invalidate()
+            time.sleep(5)
 
     @classmethod
     def set_level(cls, student_id: str, new_level: int) -> None:
@@ -75,6 +254,9 @@ class PrivacySettings(PostgresBase):
             """
             cursor.execute(insert_query, (student_id, new_level, datetime.datetime.now()))
             conn.commit()
+        cls.invalidate(student_id)
+        Redis.publish_privacy_change(student_id)
+        Redis.incr_credential_version(student_id)  # 使缓存的已验证凭据失效
 
     @classmethod
     def init(cls) -> None:
@@ -94,43 +276,31 @@ class PrivacySettings(PostgresBase):
 
             conn.commit()
 
-    @classmethod
-    def migrate(cls) -> None:
-        """migrate data from mongodb"""
-        mongo = get_mongodb()
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("privacy_settings").find()
-            for each in results:
-                insert_query = "INSERT INTO privacy_settings (student_id, level, create_time) VALUES (%s,%s,%s)"
-                cursor.execute(insert_query, (each['sid_orig'], each['level'], each['create_time']))
-            pg_conn.commit()
-        print("Migration finished.")
-
 
 class CalendarToken(PostgresBase):
-    """日历订阅令牌
     """
+    日历订阅令牌
 
-    @classmethod
-    def insert_calendar_token(cls, resource_type: str, semester: str, identifier: str) -> str:
-        """
-        生成日历令牌，写入数据库并返回字符串类型的令牌。此时的 last_used_time 是 NULL。
+    早期的 get-or-set 不是原子操作，同一个人同一学期可能有多个令牌，而它们可能都已经被添加到了日历客户端中。这些重复的令牌
+    不删除，而是作为别名保留（`alias_of` 指向同组中最近使用的那个令牌），通过令牌查询时仍然有效；按人和学期查询、
+    get-or-set 只使用 `alias_of` 为空的那一个，(type, identifier, semester) 上的唯一索引也只约束这些行。
 
-        :param resource_type: student/teacher
-        :param semester: 学期字符串
-        :param identifier: 学号或教工号
-        :return: token 字符串
-        """
-        token = uuid.uuid4()
-
-        with pg_conn_context() as conn, conn.cursor() as cursor:
-            insert_query = """
-            INSERT INTO calendar_tokens (type, identifier, semester, token, create_time)
-                VALUES (%s,%s,%s,%s,%s);
-            """
-            cursor.execute(insert_query, (resource_type, identifier, semester, token, datetime.datetime.now()))
-            conn.commit()
-        return str(token)
+    MongoDB 中同样有重复的令牌，迁移时先把每个令牌写成自己的别名（不受唯一索引约束，不会被 ON CONFLICT 丢弃），
+    迁移完成后再与表中已有的令牌一起按最近使用时间选出正式令牌。
+    """
+    migration = Migration(name="calendar_tokens",
+                          collection="calendar_token",
+                          table="calendar_tokens",
+                          columns=("type", "identifier", "semester", "token", "create_time", "last_used_time",
+                                   "alias_of"),
+                          transform=lambda each: (each['type'],
+                                                  each['identifier'],
+                                                  each['semester'],
+                                                  each['token'],
+                                                  each['create_time'],
+                                                  each['last_used'] if 'last_used' in each else None,
+                                                  each['token']),
+                          on_conflict="(token) DO NOTHING")
 
     @classmethod
     def _parse(cls, result):
@@ -157,21 +327,27 @@ class CalendarToken(PostgresBase):
     @classmethod  # noqa: F811
     def find_calendar_token(cls, tid=None, sid=None, semester=None, token=None):
         """通过 token 或者 sid/tid + 学期获得 token 文档"""
+        if token:
+            # 令牌一经创建就不会改变，只会被删除，所以可以缓存，删除时（`reset_tokens`）使缓存失效
+            cached = Redis.get_calendar_token(token)
+            if cached:
+                return cached
+
         with pg_conn_context() as conn, conn.cursor() as cursor:
             if token:
-                select_query = """
-                SELECT type, identifier, semester, token, create_time, last_used_time FROM calendar_tokens
-                    WHERE token=%s
-                """
-                cursor.execute(select_query, (uuid.UUID(token),))
+                _STMT_CALENDAR_TOKEN.execute(conn, cursor, (uuid.UUID(token),))
                 result = cursor.fetchall()
-                return cls._parse(result[0]) if result else None
+                if not result:
+                    return None
+                doc = cls._parse(result[0])
+                Redis.set_calendar_token(token, doc)
+                return doc
             elif (tid or sid) and semester:
                 select_query = """
                 SELECT type, identifier, semester, token, create_time, last_used_time FROM calendar_tokens
-                    WHERE type=%s AND identifier=%s AND semester=%s;
+                    WHERE type=%s AND identifier=%s AND semester=%s AND alias_of IS NULL;
                 """
-                cursor.execute(select_query, ("teacher" if tid else "student", tid, semester))
+                cursor.execute(select_query, ("teacher" if tid else "student", tid or sid, semester))
                 result = cursor.fetchall()
                 return cls._parse(result[0]) if result else None
             else:
@@ -179,47 +355,141 @@ class CalendarToken(PostgresBase):
 
     @classmethod
     def get_or_set_calendar_token(cls, resource_type: str, identifier: str, semester: str) -> str:
-        """寻找 token，如果找到了则直接返回 token。找不到则生成一个再返回 token"""
-        if resource_type == "student":
-            token_doc = cls.find_calendar_token(sid=identifier, semester=semester)
-        else:
-            token_doc = cls.find_calendar_token(tid=identifier, semester=semester)
+        """
+        寻找 token，如果找到了则直接返回 token。找不到则生成一个再返回 token
 
-        if not token_doc:
-            if resource_type == "student":
-                token = cls.insert_calendar_token(resource_type="student",
-                                                  identifier=identifier,
-                                                  semester=semester)
-            else:
-                token = cls.insert_calendar_token(resource_type="teacher",
-                                                  identifier=identifier,
-                                                  semester=semester)
-        else:
-            token = token_doc['token']
-        return token
+        一条语句完成：INSERT ... ON CONFLICT DO NOTHING RETURNING 返回新插入的令牌，UNION ALL 已有的正式令牌，
+        依赖唯一索引保证并发的首次访问也只会得到同一个 token。
+
+        语句中的 SELECT 使用语句开始时的快照，如果令牌恰好由并发的请求在这之后创建，插入被跳过而 SELECT 也看不到它，
+        此时没有返回行，再执行一次即可（READ COMMITTED 下新的语句会看到已经提交的令牌）
+        """
+        upsert_query = """
+        WITH inserted AS (
+            INSERT INTO calendar_tokens (type, identifier, semester, token, create_time)
+                VALUES (%(type)s, %(identifier)s, %(semester)s, %(token)s, %(now)s)
+                ON CONFLICT (type, identifier, semester) WHERE alias_of IS NULL DO NOTHING
+                RETURNING token
+        )
+        SELECT token FROM inserted
+        UNION ALL
+        SELECT token FROM calendar_tokens
+            WHERE type=%(type)s AND identifier=%(identifier)s AND semester=%(semester)s AND alias_of IS NULL
+        LIMIT 1;
+        """
+        with pg_conn_context() as conn, conn.cursor() as cursor:
+            result = None
+            while not result:
+                cursor.execute(upsert_query, {"type"      : resource_type,
+                                              "identifier": identifier,
+                                              "semester"  : semester,
+                                              "token"     : uuid.uuid4(),
+                                              "now"       : datetime.datetime.now()})
+                result = cursor.fetchone()
+                conn.commit()
+        return str(result[0])
 
     @classmethod
     def update_last_used_time(cls, token: str):
-        """更新token最后使用时间"""
+        """
+        更新token最后使用时间
+
+        每次轮询都写一次数据库代价太高，这里只记录到 Redis（同一令牌只保留最新的时间），由 `flush_last_used_time` 定期批量写入
+        """
+        Redis.record_calendar_token_usage(token, datetime.datetime.now())
+
+    @classmethod
+    def flush_last_used_time(cls) -> int:
+        """将 Redis 中记录的令牌最后使用时间批量写入数据库，返回更新的令牌数"""
+        usage = Redis.pop_calendar_token_usage()
+        if usage:
+            with pg_conn_context() as conn, conn.cursor() as cursor:
+                update_query = """
+                UPDATE calendar_tokens AS t SET last_used_time = v.last_used_time
+                    FROM (VALUES %s) AS v(token, last_used_time)
+                    WHERE t.token = v.token AND (t.last_used_time IS NULL OR t.last_used_time < v.last_used_time);
+                """
+                execute_values(cursor, update_query, [(uuid.UUID(token), time) for token, time in usage.items()],
+                               template="(%s::uuid, %s::timestamptz)")
+                conn.commit()
+        Redis.ack_calendar_token_usage()
+        return len(usage)
+
+    @classmethod
+    def reset_tokens(cls, student_id: str, typ: Optional[str] = "student") -> List[str]:
+        """删除某用户所有的 token，默认为学生。返回被删除的 token，用于清理这些 token 生成的文件"""
         with pg_conn_context() as conn, conn.cursor() as cursor:
             insert_query = """
-            UPDATE calendar_tokens SET last_used_time = %s WHERE token = %s;
+            DELETE FROM calendar_tokens WHERE identifier = %s AND type = %s RETURNING token;
             """
-            cursor.execute(insert_query, (datetime.datetime.now(), uuid.UUID(token)))
+            cursor.execute(insert_query, (student_id, typ))
+            tokens = [str(row[0]) for row in cursor.fetchall()]
             conn.commit()
+        Redis.delete_calendar_tokens(tokens)
+        return tokens
 
     @classmethod
-    def reset_tokens(cls, student_id: str, typ: Optional[str] = "student") -> None:
-        """删除某用户所有的 token，默认为学生"""
+    def _resolve_aliases(cls, cursor, pending_only: bool = False) -> None:
+        """
+        每组 (type, identifier, semester) 中最近使用的令牌作为正式令牌，其余的令牌标记为它的别名
+
+        先把别名指向新的正式令牌，再清除正式令牌的标记，任何时候同一组中都最多只有一个 `alias_of` 为空的行
+
+        :param pending_only: 只处理含有待定令牌（迁移写入的、`alias_of` 指向自己的令牌）的组，不扫描整张表
+        """
+        ranked_query = """
+        SELECT token, first_value(token) OVER (
+            PARTITION BY "type", identifier, semester
+            ORDER BY COALESCE(last_used_time, create_time) DESC, create_time DESC, token) AS canonical
+        FROM calendar_tokens
+        """
+        if pending_only:
+            ranked_query += """
+            WHERE ("type", identifier, semester) IN
+                (SELECT "type", identifier, semester FROM calendar_tokens WHERE alias_of = token)
+            """
+        cursor.execute("""
+        UPDATE calendar_tokens AS t SET alias_of = r.canonical FROM ({}) AS r
+            WHERE t.token = r.token AND r.token <> r.canonical AND t.alias_of IS DISTINCT FROM r.canonical;
+        """.format(ranked_query))
+        cursor.execute("""
+        UPDATE calendar_tokens AS t SET alias_of = NULL FROM ({}) AS r
+            WHERE t.token = r.token AND r.token = r.canonical AND t.alias_of IS NOT NULL;
+        """.format(ranked_query))
+
+    @classmethod
+    def get_recently_used_tokens(cls, since: datetime.datetime) -> List[Dict]:
+        """获得在 `since` 之后使用过的所有 token 文档"""
         with pg_conn_context() as conn, conn.cursor() as cursor:
-            insert_query = """
-            DELETE FROM calendar_tokens WHERE identifier = %s AND type = %s;
+            select_query = """
+            SELECT type, identifier, semester, token FROM calendar_tokens WHERE last_used_time >= %s;
             """
-            cursor.execute(insert_query, (student_id, typ))
-            conn.commit()
+            cursor.execute(select_query, (since,))
+            return [cls._parse(row) for row in cursor.fetchall()]
+
+    @classmethod
+    def filter_active_tokens(cls, tokens: Set[str], since: datetime.datetime) -> Set[str]:
+        """从给定的 token 中筛选出仍然存在，且在 `since` 之后使用过（从未使用过的按创建时间算）的 token"""
+        uuids = []
+        for token in tokens:
+            try:
+                uuids.append(uuid.UUID(token))
+            except ValueError:
+                continue
+        if not uuids:
+            return set()
+
+        with pg_conn_context() as conn, conn.cursor() as cursor:
+            select_query = """
+            SELECT token FROM calendar_tokens
+                WHERE token = ANY(%s) AND COALESCE(last_used_time, create_time) >= %s;
+            """
+            cursor.execute(select_query, (uuids, since))
+            return {str(row[0]) for row in cursor.fetchall()}
 
     @classmethod
     def init(cls) -> None:
+        init_checkpoints()
         with pg_conn_context() as conn, conn.cursor() as cursor:
             create_type_query = """
             DO $$ BEGIN
@@ -252,46 +522,47 @@ class CalendarToken(PostgresBase):
             """
             cursor.execute(create_index_query)
 
+            cursor.execute("ALTER TABLE calendar_tokens ADD COLUMN IF NOT EXISTS alias_of uuid;")
+            create_index_query_pending = """
+            CREATE INDEX IF NOT EXISTS idx_pending_alias
+                ON calendar_tokens USING btree(token) WHERE alias_of = token;
+            """
+            cursor.execute(create_index_query_pending)  # 迁移完成后只查找待定的令牌，平时是空索引
+
+            # 重复的令牌标记为别名后，再建立只约束非别名行的唯一索引。需要扫描整张表，只在第一次初始化时执行
+            run_once(cursor, "calendar_tokens_aliases", cls._resolve_aliases)
             create_index_query2 = """
-            CREATE INDEX IF NOT EXISTS idx_type_idt_sem
-                ON calendar_tokens USING btree("type", identifier, semester);
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_type_idt_sem_canonical
+                ON calendar_tokens USING btree("type", identifier, semester) WHERE alias_of IS NULL;
             """
             cursor.execute(create_index_query2)
 
+            cursor.execute("DROP INDEX IF EXISTS idx_type_idt_sem_unique;")
+            cursor.execute("DROP INDEX IF EXISTS idx_type_idt_sem;")
+
             conn.commit()
 
     @classmethod
-    def migrate(cls) -> None:
-        """migrate data from mongodb"""
-        mongo = get_mongodb()
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("calendar_token").find()
-            for each in results:
-                insert_query = """
-                INSERT INTO calendar_tokens (type, identifier, semester, token, create_time, last_used_time)
-                    VALUES (%s,%s,%s,%s,%s,%s)
-                """
-
-                cursor.execute(insert_query, (each['type'],
-                                              each['identifier'],
-                                              each['semester'],
-                                              each['token'],
-                                              each['create_time'],
-                                              each['last_used'] if 'last_used' in each else None))
-            pg_conn.commit()
-        print("Migration finished.")
+    def after_migration(cls) -> None:
+        with pg_conn_context() as conn, conn.cursor() as cursor:
+            cls._resolve_aliases(cursor, pending_only=True)
+            conn.commit()
 
 
 class User(PostgresBase):
     """用户表
     """
+    migration = Migration(name="users",
+                          collection="user",
+                          table="users",
+                          columns=("student_id", "password", "create_time"),
+                          transform=lambda each: (each['sid_orig'], each["password"], each['create_time']))
 
     @classmethod
     def exist(cls, student_id: str) -> bool:
         """check if a student has registered"""
         with pg_conn_context() as conn, conn.cursor() as cursor:
-            select_query = "SELECT create_time FROM users WHERE student_id=%s"
-            cursor.execute(select_query, (student_id,))
+            _STMT_USER_EXIST.execute(conn, cursor, (student_id,))
             result = cursor.fetchone()
         return result is not None
 
@@ -328,6 +599,7 @@ class User(PostgresBase):
                 conn.commit()
             except psycopg2.errors.UniqueViolation as e:
                 raise ValueError("Student already exists in database") from e
+        Redis.incr_credential_version(sid_orig)  # 使缓存的已验证凭据失效
 
     @classmethod
     def init(cls) -> None:
@@ -348,19 +620,6 @@ class User(PostgresBase):
 
             conn.commit()
 
-    @classmethod
-    def migrate(cls) -> None:
-        """migrate data from mongodb"""
-        mongo = get_mongodb()
-
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("user").find()
-            for each in results:
-                insert_query = "INSERT INTO users (student_id, password, create_time) VALUES (%s,%s,%s)"
-                cursor.execute(insert_query, (each['sid_orig'], each["password"], each['create_time']))
-            pg_conn.commit()
-        print("Migration finished.")
-
 
 ID_STATUS_TKN_PASSED = "EMAIL_TOKEN_PASSED"  # email verification passed but password may not set
 ID_STATUS_SENT = "EMAIL_SENT"  # email request sent to everyclass-auth(cannot make sure the email is really sent)
@@ -378,6 +637,16 @@ class IdentityVerification(PostgresBase):
     """
     身份验证请求
     """
+    migration = Migration(name="identity_verify_requests",
+                          collection="verification_requests",
+                          table="identity_verify_requests",
+                          columns=("request_id", "identifier", "method", "status", "create_time", "extra"),
+                          transform=lambda each: (each['request_id'],
+                                                  each['sid_orig'],
+                                                  each['verification_method'],
+                                                  each['status'],
+                                                  each['create_time'],
+                                                  {'password': each['password']} if 'password' in each else None))
 
     @classmethod
     def get_request_by_id(cls, req_id: str) -> Optional[Dict]:
@@ -490,34 +759,17 @@ class IdentityVerification(PostgresBase):
 
             conn.commit()
 
-    @classmethod
-    def migrate(cls):
-        """migrate data from mongodb"""
-        mongo = get_mongodb()
-
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("verification_requests").find()
-            for each in results:
-                insert_query = """
-                INSERT INTO identity_verify_requests (request_id, identifier, method, status, create_time, extra)
-                    VALUES (%s,%s,%s,%s,%s,%s)
-                """
-
-                cursor.execute(insert_query, (each['request_id'],
-                                              each['sid_orig'],
-                                              each['verification_method'],
-                                              each['status'],
-                                              each['create_time'],
-                                              {'password': each['password']} if 'password' in each else None))
-            pg_conn.commit()
-        print("Migration finished.")
-
 
 class SimplePassword(PostgresBase):
     """
     Simple passwords will be rejected when registering. However, it's fun to know what kind of simple passwords are
     being used.
     """
+    migration = Migration(name="simple_passwords",
+                          collection="simple_passwords",
+                          table="simple_passwords",
+                          columns=("student_id", "time", "password"),
+                          transform=lambda each: (each['sid_orig'], each['time'], each['password']))
 
     @classmethod
     def new(cls, password: str, sid_orig: str) -> None:
@@ -551,29 +803,48 @@ class SimplePassword(PostgresBase):
             cursor.execute(create_index_query)
             conn.commit()
 
-    @classmethod
-    def migrate(cls):
-        """migrate data from mongodb"""
-        mongo = get_mongodb()
 
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("simple_passwords").find()
-            for each in results:
-                insert_query = "INSERT INTO simple_passwords (student_id, time, password) VALUES (%s,%s,%s)"
-                cursor.execute(insert_query, (each['sid_orig'], each['time'], each['password']))
-            pg_conn.commit()
-        print("Migration finished.")
+class UserIdSequence(PostgresBase):
+    """
+    匿名用户流水 ID
 
+    没有 session 的访问（包括爬虫和订阅客户端的首次请求）都需要一个新 ID，如果每次都 nextval() 就是每个请求一次数据库往返。
+    这里使用 hi/lo 分配：序列的步长为 `USER_ID_BLOCK_SIZE`，每次 nextval() 得到的值 v 为本进程保留 (v, v + 步长)
+    这一段，之后在内存中依次分配。各段互不重叠，所以各节点之间不会重复，同一进程内分配的 ID 单调递增。
+
+    v 本身不分配：旧版本直接把 nextval() 的值当作 ID 使用，这样在滚动更新期间与旧进程共存也不会重复。
+    """
+    _lock = threading.Lock()
+    _next = 0
+    _end = 0  # 当前段的结束值（不含）
+    _pid = None
+    _increment = None
+
+    @classmethod
+    def new(cls) -> int:
+        with cls._lock:
+            if cls._pid != os.getpid():  # fork 之前保留的段不能在多个子进程中使用
+                cls._pid, cls._next, cls._end = os.getpid(), 0, 0
+            if cls._next >= cls._end:
+                cls._next, cls._end = cls._allocate_block()
+            num = cls._next
+            cls._next += 1
+        return num
 
-class UserIdSequence(PostgresBase):
     @classmethod
-    def new(cls):
+    def _allocate_block(cls) -> Tuple[int, int]:
+        """保留新的一段 ID，返回 (起始值, 结束值（不含）)"""
         with pg_conn_context() as conn, conn.cursor() as cursor:
-            get_sequence_query = """SELECT nextval('user_id_seq')"""
-            cursor.execute(get_sequence_query)
+            if cls._increment is None:
+                # 以数据库中序列实际的步长为准，init 之前仍然是 1 时退化为每次 nextval()
+                cursor.execute("SELECT increment_by FROM pg_sequences "
+                               "WHERE schemaname = current_schema() AND sequencename = 'user_id_seq'")
+                cls._increment = cursor.fetchone()[0]
+            cursor.execute("SELECT nextval('user_id_seq')")
             num = cursor.fetchone()[0]
-
-        return num
+        if cls._increment == 1:
+            return num, num + 1
+        return num + 1, num + cls._increment
 
     @classmethod
     def init(cls) -> None:
@@ -582,6 +853,7 @@ class UserIdSequence(PostgresBase):
             CREATE SEQUENCE IF NOT EXISTS user_id_seq START WITH 10000000;
             """
             cursor.execute(create_table_query)
+            cursor.execute("ALTER SEQUENCE user_id_seq INCREMENT BY %s", (get_config().USER_ID_BLOCK_SIZE,))
             conn.commit()
 
 
@@ -590,34 +862,158 @@ class VisitTrack(PostgresBase):
     访客记录
 
     目前只考虑了学生互访的情况，如果将来老师支持注册，这里需要改动
+
+    访问记录不在请求中同步写入，而是先缓存在进程内（同一对主人、访客只保留最新的时间），由后台线程每隔
+    `VISIT_TRACK_FLUSH_INTERVAL` 秒用一条多行 upsert 写入数据库，进程正常退出时也会写入。所以访客列表最多会晚这么久更新。
     """
+    migration = Migration(name="visit_tracks",
+                          collection="visitor_track",
+                          table="visit_tracks",
+                          columns=("host_id", "visitor_id", "last_visit_time"),
+                          transform=lambda each: (each['host'], each['visitor'], each['last_time']))
+
+    _buffer: Dict[Tuple[str, str], datetime.datetime] = {}  # (主人, 访客) -> 最后访问时间
+    _buffer_lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _flusher_pid = None
+    _app = None
+    _stats = {"flushes": 0, "rows": 0, "failures": 0, "dropped": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0}
 
     @classmethod
     def update_track(cls, host: str, visitor: StudentSession) -> None:
+        """记录一次访问（需要在 app context 中调用）"""
+        from flask import current_app
+
+        config = get_config()
+        now = datetime.datetime.now()
+        with cls._buffer_lock:
+            if cls._flusher_pid != os.getpid():  # 每个 worker 在第一次记录时启动自己的后台线程
+                cls._buffer.clear()
+                cls._flusher_pid, cls._app = os.getpid(), current_app._get_current_object()
+                threading.Thread(target=cls._flush_periodically, name="visit-track-flusher", daemon=True).start()
+                atexit.register(cls.flush)
+            key = (host, visitor.sid_orig)
+            if key not in cls._buffer or cls._buffer[key] < now:
+                cls._buffer[key] = now
+            buffered = len(cls._buffer)
+        if buffered >= config.VISIT_TRACK_BUFFER_MAX:
+            cls.flush()
 
-        with pg_conn_context() as conn, conn.cursor() as cursor:
-            insert_or_update_query = """
-            INSERT INTO visit_tracks (host_id, visitor_id, last_visit_time) VALUES (%s,%s,%s)
-                ON CONFLICT ON CONSTRAINT unq_host_visitor DO UPDATE SET last_visit_time=EXCLUDED.last_visit_time;
+    @classmethod
+    def _flush_periodically(cls) -> None:
+        while True:
+            time.sleep(get_config().VISIT_TRACK_FLUSH_INTERVAL)
+            cls.flush()
+
+    @classmethod
+    def _write(cls, rows: List[Tuple[str, str, datetime.datetime]]) -> None:
+        with cls._app.app_context(), pg_conn_context() as conn, conn.cursor() as cursor:
+            upsert_query = """
+            INSERT INTO visit_tracks (host_id, visitor_id, last_visit_time) VALUES %s
+                ON CONFLICT ON CONSTRAINT unq_host_visitor DO UPDATE SET last_visit_time=EXCLUDED.last_visit_time
             """
-            cursor.execute(insert_or_update_query, (host, visitor.sid_orig, datetime.datetime.now()))
+            execute_values(cursor, upsert_query, rows)
             conn.commit()
 
     @classmethod
-    def get_visitors(cls, sid_orig: str) -> List[Dict]:
-        """获得访客列表"""
+    def _write_splitting(cls, rows: List[Tuple[str, str, datetime.datetime]]) -> int:
+        """
+        写入一批记录，数据本身有问题时（例如同一主人的两条访问时间相同，违反 idx_host_time）对半拆分后分别写入，
+        最终只丢弃出问题的那几条。返回写入的条数
+        """
+        try:
+            cls._write(rows)
+            return len(rows)
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            if len(rows) == 1:
+                cls._stats["dropped"] += 1
+                logger.error("Dropped invalid visit track", {"row": repr(rows[0]), "error": repr(e)})
+                return 0
+        middle = len(rows) // 2
+        return cls._write_splitting(rows[:middle]) + cls._write_splitting(rows[middle:])
+
+    @classmethod
+    def flush(cls) -> int:
+        """
+        将缓存的访问记录批量写入数据库，返回写入的条数
+
+        连接失败、取连接超时等暂时性的错误时放回缓存，下次再写；违反约束等数据错误重试也不会成功，拆分批次后丢弃出问题的记录；
+        其他错误丢弃整批并记录日志，避免同一批数据每次都失败、缓存越积越多
+        """
+        with cls._flush_lock:
+            with cls._buffer_lock:
+                pending, cls._buffer = cls._buffer, {}
+            if not pending:
+                return 0
+
+            start = time.monotonic()
+            rows = [(host, visitor, last_time) for (host, visitor), last_time in pending.items()]
+            try:
+                written = cls._write_splitting(rows)
+            except (psycopg2.OperationalError, PoolTimeout) as e:
+                with cls._buffer_lock:
+                    for key, last_time in pending.items():
+                        if key not in cls._buffer or cls._buffer[key] < last_time:
+                            cls._buffer[key] = last_time
+                    cls._stats["failures"] += 1
+                logger.warning("Failed to flush visit tracks, will retry", {"rows": len(pending), "error": repr(e)})
+                return 0
+            except Exception as e:
+                cls._stats["failures"] += 1
+                cls._stats["dropped"] += len(pending)
+                logger.error("Failed to flush visit tracks, batch dropped", {"rows": len(pending), "error": repr(e)})
+                return 0
+
+            elapsed_ms = (time.monotonic() - start) * 1000
+            cls._stats["flushes"] += 1
+            cls._stats["rows"] += written
+            cls._stats["last_flush_ms"] = round(elapsed_ms, 1)
+            cls._stats["max_flush_ms"] = round(max(cls._stats["max_flush_ms"], elapsed_ms), 1)
+            return written
+
+    @classmethod
+    def buffer_stats(cls) -> Dict:
+        """当前进程中访问记录缓存的统计信息"""
+        with cls._buffer_lock:
+            return dict(cls._stats, buffered=len(cls._buffer))
+
+    @classmethod
+    def get_visitors(cls, sid_orig: str, limit: int,
+                     before: Optional[datetime.datetime] = None) -> Tuple[List[Dict], Optional[datetime.datetime]]:
+        """
+        按访问时间倒序分页获得访客列表
+
+        使用 keyset 分页：下一页从上一页最后一条的访问时间之前开始查询，走 (host_id, last_visit_time DESC) 上的索引，
+        不需要 OFFSET 跳过前面的行。(host_id, last_visit_time) 是唯一的，所以以时间作为游标不会漏掉或重复记录。
+
+        :param sid_orig: 主人的学号
+        :param limit: 每页条数
+        :param before: 游标，上一页返回的值，第一页为 None
+        :return: (访客列表, 下一页的游标，没有更多时为 None)
+        """
         from everyclass.server.rpc.api_server import APIServer
 
         with pg_conn_context() as conn, conn.cursor() as cursor:
-            select_query = """
-            SELECT visitor_id, last_visit_time FROM visit_tracks where host_id=%s ORDER BY last_visit_time DESC;
-            """
-            cursor.execute(select_query, (sid_orig,))
+            if before:
+                select_query = """
+                SELECT visitor_id, last_visit_time FROM visit_tracks WHERE host_id=%s AND last_visit_time < %s
+                    ORDER BY last_visit_time DESC LIMIT %s;
+                """
+                cursor.execute(select_query, (sid_orig, before, limit + 1))
+            else:
+                select_query = """
+                SELECT visitor_id, last_visit_time FROM visit_tracks WHERE host_id=%s
+                    ORDER BY last_visit_time DESC LIMIT %s;
+                """
+                cursor.execute(select_query, (sid_orig, limit + 1))
             result = cursor.fetchall()
             conn.commit()
 
+        # 多查询一条，用来判断是否还有下一页
+        next_cursor = result[limit - 1][1] if len(result) > limit else None
+
         visitor_list = []
-        for record in result:
+        for record in result[:limit]:
             # query api-server
             search_result = APIServer.search(record[0])
 
@@ -625,7 +1021,36 @@ class VisitTrack(PostgresBase):
                                  "student_id"   : search_result.students[0].student_id_encoded,
                                  "last_semester": search_result.students[0].semesters[-1],
                                  "visit_time"   : record[1]})
-        return visitor_list
+        return visitor_list, next_cursor
+
+    @classmethod
+    def prune(cls, max_per_host: int, batch_size: int) -> int:
+        """
+        每个主人只保留最近的 `max_per_host` 位访客，更早的记录分批删除（每批一个事务），避免长时间持有大量行锁
+
+        :return: 删除的记录数
+        """
+        deleted = 0
+        while True:
+            with pg_conn_context() as conn, conn.cursor() as cursor:
+                delete_query = """
+                DELETE FROM visit_tracks AS v USING (
+                    SELECT host_id, last_visit_time FROM (
+                        SELECT host_id, last_visit_time,
+                               row_number() OVER (PARTITION BY host_id ORDER BY last_visit_time DESC) AS rank
+                            FROM visit_tracks
+                            WHERE host_id IN (SELECT host_id FROM visit_tracks GROUP BY host_id HAVING count(*) > %s)
+                    ) AS ranked
+                    WHERE rank > %s LIMIT %s
+                ) AS old
+                WHERE v.host_id = old.host_id AND v.last_visit_time = old.last_visit_time;
+                """
+                cursor.execute(delete_query, (max_per_host, max_per_host, batch_size))
+                count = cursor.rowcount
+                conn.commit()
+            deleted += count
+            if count < batch_size:
+                return deleted
 
     @classmethod
     def init(cls) -> None:
@@ -651,23 +1076,16 @@ class VisitTrack(PostgresBase):
             cursor.execute(create_index_query)
 
             create_constraint_query = """
-            ALTER TABLE visit_tracks ADD CONSTRAINT unq_host_visitor UNIQUE ("host_id", "visitor_id");
+            DO $$ BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                               WHERE conname = 'unq_host_visitor' AND conrelid = 'visit_tracks'::regclass) THEN
+                    ALTER TABLE visit_tracks ADD CONSTRAINT unq_host_visitor UNIQUE ("host_id", "visitor_id");
+                END IF;
+            END $$;
             """
             cursor.execute(create_constraint_query)
             conn.commit()
 
-    @classmethod
-    def migrate(cls) -> None:
-        """migrate data from mongodb"""
-        mongo = get_mongodb()
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("visitor_track").find()
-            for each in results:
-                insert_query = "INSERT INTO visit_tracks (host_id, visitor_id, last_visit_time) VALUES (%s,%s,%s)"
-                cursor.execute(insert_query, (each['host'], each['visitor'], each['last_time']))
-            pg_conn.commit()
-        print("Migration finished.")
-
 
 class COTeachingClass(MongoDAOBase):
     """
@@ -861,6 +1279,153 @@ class Redis:
         """获得总访问人数计数"""
         return redis.pfcount("{}:visit_cnt:{}".format(cls.prefix, sid_orig))
 
+    @classmethod
+    def set_free_time(cls, key: str, result: str, expire: int) -> None:
+        """缓存多人共同空闲时间的计算结果（JSON 字符串）"""
+        redis.set("{}:free_time:{}".format(cls.prefix, key), result, ex=expire)
+
+    @classmethod
+    def get_free_time(cls, key: str) -> Optional[str]:
+        """获得缓存的多人共同空闲时间，无则返回 None"""
+        res = redis.get("{}:free_time:{}".format(cls.prefix, key))
+        return res.decode() if res else None
+
+    @classmethod
+    def set_ics(cls, token: str, etag: str, body: bytes, expire: int) -> None:
+        """缓存生成好的 ics 文件（gzip 压缩后的内容），并把键记入该令牌的键集合，删除时不需要扫描整个键空间"""
+        key = "{}:ics:{}:{}".format(cls.prefix, token, etag)
+        keys_key = "{}:ics_keys:{}".format(cls.prefix, token)
+        pipe = redis.pipeline(transaction=False)
+        pipe.set(key, body, ex=expire)
+        pipe.sadd(keys_key, key)
+        pipe.expire(keys_key, expire)  # 与最近写入的文件同时过期，不会早于其中任何一个文件；已经过期的成员删除时自然忽略
+        pipe.execute()
+
+    @classmethod
+    def get_ics(cls, token: str, etag: str) -> Optional[bytes]:
+        """获得缓存的 ics 文件（gzip 压缩后的内容），无则返回 None"""
+        return redis.get("{}:ics:{}:{}".format(cls.prefix, token, etag))
+
+    @classmethod
+    def delete_ics(cls, token: str) -> None:
+        """删除某令牌缓存的所有 ics 文件"""
+        keys_key = "{}:ics_keys:{}".format(cls.prefix, token)
+        keys = list(redis.smembers(keys_key))
+        redis.delete(keys_key, *keys)
+
+    @classmethod
+    def set_calendar_token(cls, token: str, doc: Dict) -> None:
+        """缓存日历令牌文档"""
+        redis.set("{}:cal_token:{}".format(cls.prefix, token),
+                  json.dumps({"type"      : doc["type"],
+                              "identifier": doc["identifier"],
+                              "semester"  : doc["semester"],
+                              "token"     : str(doc["token"])}),
+                  ex=86400 * 7)
+
+    @classmethod
+    def get_calendar_token(cls, token: str) -> Optional[Dict]:
+        """获得缓存的日历令牌文档，无则返回 None"""
+        res = redis.get("{}:cal_token:{}".format(cls.prefix, token))
+        return json.loads(res) if res else None
+
+    @classmethod
+    def delete_calendar_tokens(cls, tokens: List[str]) -> None:
+        """删除日历令牌文档的缓存"""
+        if tokens:
+            redis.delete(*["{}:cal_token:{}".format(cls.prefix, token) for token in tokens])
+
+    @classmethod
+    def incr_calendar_poll_count(cls, token: str) -> None:
+        """记录日历令牌当天的轮询次数，同时累加当天的总轮询次数"""
+        day = datetime.date.today().strftime('%Y%m%d')
+        expire = get_config().ICS_POLL_COUNT_DAYS * 86400
+        pipe = redis.pipeline(transaction=False)
+        pipe.hincrby("{}:ics_polls:{}".format(cls.prefix, day), token, 1)
+        pipe.expire("{}:ics_polls:{}".format(cls.prefix, day), expire)
+        pipe.incr("{}:ics_polls_total:{}".format(cls.prefix, day))
+        pipe.expire("{}:ics_polls_total:{}".format(cls.prefix, day), expire)
+        pipe.execute()
+
+    @classmethod
+    def get_calendar_poll_stats(cls, day: datetime.date) -> Dict:
+        """某天的日历轮询统计：总次数、轮询过的令牌数和单个令牌的最多次数"""
+        per_token = redis.hvals("{}:ics_polls:{}".format(cls.prefix, day.strftime('%Y%m%d')))
+        total = redis.get("{}:ics_polls_total:{}".format(cls.prefix, day.strftime('%Y%m%d')))
+        return {"total" : int(total) if total else 0,
+                "tokens": len(per_token),
+                "max"   : max([int(x) for x in per_token] + [0])}
+
+    @classmethod
+    def set_semesters(cls, resource_type: str, identifier: str, version: str, semesters: List[str]) -> None:
+        """缓存学生或老师有课表的学期列表，`version` 为数据版本"""
+        redis.set("{}:semesters:{}:{}:{}".format(cls.prefix, resource_type, identifier, version),
+                  json.dumps(semesters), ex=86400)
+
+    @classmethod
+    def get_semesters(cls, resource_type: str, identifier: str, version: str) -> Optional[List[str]]:
+        """获得缓存的学期列表，无则返回 None"""
+        res = redis.get("{}:semesters:{}:{}:{}".format(cls.prefix, resource_type, identifier, version))
+        return json.loads(res) if res else None
+
+    @classmethod
+    def get_credential_version(cls, sid_orig: str) -> int:
+        """获得用户的凭据版本号，密码或隐私级别变化时增加"""
+        res = redis.get("{}:cred_ver:{}".format(cls.prefix, sid_orig))
+        return int(res) if res else 0
+
+    @classmethod
+    def incr_credential_version(cls, sid_orig: str) -> None:
+        """增加用户的凭据版本号，使各进程中缓存的已验证凭据失效"""
+        redis.incr("{}:cred_ver:{}".format(cls.prefix, sid_orig))
+
+    @classmethod
+    def set_data_version(cls, version: str) -> None:
+        """保存 api-server 报告的数据版本，所有进程共享"""
+        redis.set("{}:data_version".format(cls.prefix), version)
+
+    @classmethod
+    def get_data_version(cls) -> Optional[str]:
+        res = redis.get("{}:data_version".format(cls.prefix))
+        return res.decode() if res else None
+
+    @classmethod
+    def publish_privacy_change(cls, sid_orig: str) -> None:
+        """通知所有进程某个学生的隐私级别发生了变化"""
+        redis.publish("{}:privacy_changed".format(cls.prefix), sid_orig)
+
+    @classmethod
+    def subscribe_privacy_changes(cls):
+        """订阅隐私级别变化的通知，返回 redis-py 的 PubSub 对象"""
+        pubsub = redis.pubsub()
+        pubsub.subscribe("{}:privacy_changed".format(cls.prefix))
+        return pubsub
+
+    @classmethod
+    def record_calendar_token_usage(cls, token: str, time: datetime.datetime) -> None:
+        """记录日历令牌的最后使用时间"""
+        redis.hset("{}:cal_token_usage".format(cls.prefix), token, time.timestamp())
+
+    @classmethod
+    def pop_calendar_token_usage(cls) -> Dict[str, datetime.datetime]:
+        """
+        取出记录的日历令牌最后使用时间。记录被移动到单独的键中，写入数据库后调用 `ack_calendar_token_usage` 删除；
+        如果上次写入失败，这次会重新取出上次的记录
+        """
+        key = "{}:cal_token_usage".format(cls.prefix)
+        flushing_key = key + ":flushing"
+        if not redis.exists(flushing_key):
+            if not redis.exists(key):
+                return {}
+            redis.rename(key, flushing_key)
+        return {k.decode(): datetime.datetime.fromtimestamp(float(v))
+                for k, v in redis.hgetall(flushing_key).items()}
+
+    @classmethod
+    def ack_calendar_token_usage(cls) -> None:
+        """删除已经写入数据库的日历令牌使用记录"""
+        redis.delete("{}:cal_token_usage:flushing".format(cls.prefix))
+
     @classmethod
     def new_cotc_id(cls) -> int:
         """生成新的 ID（自增）"""
@@ -879,16 +1444,23 @@ def init_mongo():
 
 
 def init_postgres():
+    """建立表和索引，然后从 MongoDB 迁移数据（可以重复执行，中断后从检查点继续）"""
     import inspect
     import sys
 
-    for cls_name, cls in inspect.getmembers(sys.modules[__name__], inspect.isclass):
-        if issubclass(cls, PostgresBase) and cls is not PostgresBase:
-            print("[{}] Initializing...".format(cls_name))
-            cls.init()
-            if hasattr(cls, "migrate"):
-                print("[{}] Migrating...".format(cls_name))
-                cls.migrate()
+    classes = [cls for _, cls in inspect.getmembers(sys.modules[__name__], inspect.isclass)
+               if issubclass(cls, PostgresBase) and cls is not PostgresBase]
+    for cls in classes:
+        print("[{}] Initializing...".format(cls.__name__))
+        cls.init()
+
+    config = get_config()
+    migrations = [cls.migration for cls in classes if cls.migration]
+    print("Migrating {} tables...".format(len(migrations)))
+    run_migrations(migrations, batch_size=config.MIGRATION_BATCH_SIZE, parallel=config.MIGRATION_PARALLELISM)
+    for cls in classes:
+        if cls.migration:
+            cls.after_migration()
 
 
 def init_db():
@@ -0,0 +1,164 @@
+"""
+从 MongoDB 批量迁移数据到 Postgres
+
+原先每个表的 migrate() 逐条 INSERT 并且整个集合只在最后提交一次：速度慢，中途失败只能从头再来，重新执行又会因为重复的主键失败。
+这里是通用的批量导入：
+
+- 按 `_id` 顺序读取文档，每批用 `execute_values` 组成一条多行 INSERT 写入；
+- 每批与检查点（`migration_checkpoints` 表中记录的最后一个 `_id`）在同一个事务中提交，中断后重新执行会从检查点继续，
+  不会重复写入也不会遗漏；
+- INSERT 带有 ON CONFLICT，表中已经存在的记录（例如旧的迁移写入的，或迁移期间用户新写入的）不会导致失败；
+- 不同的表在多个线程中并行迁移，每个表使用自己的连接，并打印每秒写入的行数。
+
+没有使用 COPY：COPY 不能处理冲突，需要先导入临时表再 INSERT ... SELECT，而 hstore、枚举类型和 uuid 等字段在 COPY 的文本格式中
+还要自己转义。批量大小合适时多行 INSERT 的吞吐已经足够，迁移的瓶颈在读取 MongoDB。
+"""
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import json_util
+from psycopg2.extras import execute_values
+
+from everyclass.server import logger
+from everyclass.server.db.mongodb import get_connection as get_mongodb
+from everyclass.server.db.postgres import pg_conn_context
+
+
+@dataclass
+class Migration:
+    """一个集合到一个表的迁移"""
+    name: str  # 检查点的名字
+    collection: str  # MongoDB 集合
+    table: str  # Postgres 表
+    columns: Tuple[str, ...]
+    transform: Callable[[Dict], Tuple]  # 文档 -> 与 columns 对应的一行
+    on_conflict: str = "DO NOTHING"  # ON CONFLICT 之后的部分
+    template: Optional[str] = None  # execute_values 的 template，需要类型转换时使用
+
+
+def init_checkpoints() -> None:
+    """建立检查点表"""
+    with pg_conn_context() as conn, conn.cursor() as cursor:
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS migration_checkpoints
+            (
+                name character varying(64) NOT NULL PRIMARY KEY,
+                last_id text NOT NULL,
+                rows bigint NOT NULL,
+                update_time timestamp with time zone NOT NULL
+            )
+            WITH (
+                OIDS = FALSE
+            );
+        """
+        cursor.execute(create_table_query)
+        conn.commit()
+
+
+def reset_checkpoint(name: str) -> None:
+    """删除检查点，下次从头迁移。已经写入的行会因为 ON CONFLICT 被跳过或更新，但没有唯一约束的表会重复写入"""
+    with pg_conn_context() as conn, conn.cursor() as cursor:
+        cursor.execute("DELETE FROM migration_checkpoints WHERE name=%s", (name,))
+        conn.commit()
+
+
+def run_once(cursor, name: str, step: Callable[[Any], None]) -> bool:
+    """
+    执行一次性的数据整理步骤，并在调用者的事务中记录检查点，已经执行过的步骤直接跳过（需要先调用 `init_checkpoints`）
+
+    :param name: 检查点的名字
+    :param step: 传入 cursor 执行整理
+    :return: 这次是否执行了
+    """
+    cursor.execute("SELECT last_id, rows FROM migration_checkpoints WHERE name=%s", (name,))
+    if cursor.fetchone():
+        return False
+    step(cursor)
+    cursor.execute("INSERT INTO migration_checkpoints (name, last_id, rows, update_time) VALUES (%s,%s,%s,%s)",
+                   (name, json_util.dumps(None), 0, datetime.datetime.now()))
+    return True
+
+
+def _get_checkpoint(cursor, name: str) -> Tuple[Optional[Any], int]:
+    """返回 (最后迁移的 _id，没有检查点时为 None；已迁移的行数)"""
+    cursor.execute("SELECT last_id, rows FROM migration_checkpoints WHERE name=%s", (name,))
+    result = cursor.fetchone()
+    if not result:
+        return None, 0
+    return json_util.loads(result[0]), result[1]
+
+
+def _load_batch(conn, cursor, migration: Migration, batch: List[Dict], total: int) -> None:
+    """写入一批文档并更新检查点，在同一个事务中提交"""
+    insert_query = "INSERT INTO {} ({}) VALUES %s ON CONFLICT {}".format(
+            migration.table, ', '.join(migration.columns), migration.on_conflict)
+    execute_values(cursor, insert_query, [migration.transform(doc) for doc in batch],
+                   template=migration.template, page_size=len(batch))
+
+    checkpoint_query = """
+    INSERT INTO migration_checkpoints (name, last_id, rows, update_time) VALUES (%s,%s,%s,%s)
+        ON CONFLICT (name) DO UPDATE SET last_id=EXCLUDED.last_id, rows=EXCLUDED.rows, update_time=EXCLUDED.update_time
+    """
+    cursor.execute(checkpoint_query, (migration.name, json_util.dumps(batch[-1]['_id']), total,
+                                      datetime.datetime.now()))
+    conn.commit()
+
+
+def run(migration: Migration, batch_size: int) -> Dict:
+    """
+    执行一个迁移，从检查点继续（需要先调用 `init_checkpoints`）
+
+    :return: 统计信息
+    """
+    mongo = get_mongodb()
+    start = time.monotonic()
+    migrated = 0
+    with pg_conn_context() as conn, conn.cursor() as cursor:
+        last_id, total = _get_checkpoint(cursor, migration.name)
+        conn.commit()
+        if last_id is not None:
+            print("[{}] Resuming after {} rows".format(migration.name, total))
+
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        batch = []
+        for doc in mongo.get_collection(migration.collection).find(query).sort('_id', 1).batch_size(batch_size):
+            batch.append(doc)
+            if len(batch) < batch_size:
+                continue
+            migrated += len(batch)
+            total += len(batch)
+            _load_batch(conn, cursor, migration, batch, total)
+            batch = []
+            print("[{}] {} rows, {:.0f} rows/s".format(migration.name, total, migrated / (time.monotonic() - start)))
+        if batch:
+            migrated += len(batch)
+            total += len(batch)
+            _load_batch(conn, cursor, migration, batch, total)
+
+    seconds = time.monotonic() - start
+    stats = {"migration"      : migration.name,
+             "rows"           : migrated,
+             "total_rows"     : total,
+             "seconds"        : round(seconds, 1),
+             "rows_per_second": round(migrated / seconds) if seconds else 0}
+    print("[{}] Migration finished: {}".format(migration.name, stats))
+    return stats
+
+
+def run_all(migrations: List[Migration], batch_size: int, parallel: int) -> List[Dict]:
+    """
+    并行执行多个迁移。每个迁移在自己的线程中使用自己的 MongoDB 和 Postgres 连接
+
+    :param migrations: 迁移列表
+    :param batch_size: 每批的文档数（也是每个事务写入的行数）
+    :param parallel: 同时执行的迁移数
+    :return: 每个迁移的统计信息
+    """
+    init_checkpoints()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        results = list(executor.map(lambda migration: run(migration, batch_size), migrations))
+    logger.info("Migrations finished", {"results": results})
+    return results
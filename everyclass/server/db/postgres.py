@@ -1,45 +1,213 @@
+import bisect
+import threading
+import time
+import traceback
 from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List
 
 import psycopg2
 from DBUtils.PooledDB import PooledDB
 from flask import current_app, has_app_context
-from psycopg2.extras import register_hstore, register_uuid
+from psycopg2.extras import HstoreAdapter, register_hstore, register_uuid
 
+from everyclass.server import logger
 from everyclass.server.config import get_config
+from everyclass.server.exceptions import PoolTimeout
 
 _config = get_config()
 _options = f'-c search_path={_config.POSTGRES_SCHEMA}'
 
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)  # 等待时间直方图的桶上界（毫秒），最后一个桶为更长的等待
+
+
+@dataclass
+class _Checkout:
+    """一次取出的连接"""
+    time: float  # 取出时间（monotonic）
+    stack: traceback.StackSummary  # 取出时的调用栈
+    thread: str
+    reported: bool = False  # 是否已经报告过泄漏
+
+
+class ConnectionPool:
+    """
+    PooledDB 的包装
+
+    - 取连接的等待时间有上限，超时抛出 `PoolTimeout`，而不是让线程无限阻塞
+    - 空闲较久的连接在取出时做一次健康检查，断开的连接由 SteadyDB 重连
+    - 连接被占用的时间超过阈值时打出警告以及取出连接时的调用栈：归还时检查，`check_leaks`（`stats` 也会调用）检查仍未归还的连接
+    - 统计连接数、占用数、等待时间直方图、超时次数和泄漏次数
+    """
+
+    def __init__(self, maxconnections: int, checkout_timeout: float, health_check_interval: float,
+                 leak_threshold: float, **kwargs):
+        # 等待由信号量控制，PooledDB 本身不会阻塞
+        self._pool = PooledDB(maxconnections=maxconnections, blocking=True, **kwargs)
+        self._semaphore = threading.BoundedSemaphore(maxconnections)
+        self.maxconnections = maxconnections
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.leak_threshold = leak_threshold
+
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._leaks = 0
+        self._reconnects = 0
+        self._wait_histogram: List[int] = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self._held: Dict[int, _Checkout] = {}  # 取出未归还的连接
+        self._next_checkout_id = 0
+
+    @contextmanager
+    def connection(self):
+        """取出一个连接，离开 with 块时（包括抛出异常时）一定归还"""
+        start = time.monotonic()
+        if not self._semaphore.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout("No Postgres connection available after {}s ({} in use)"
+                              .format(self.checkout_timeout, self.maxconnections))
+        try:
+            conn = self._pool.connection()
+            checkout_time = time.monotonic()
+            # 只记录帧和行号，不读取源码，格式化推迟到真正需要报告的时候
+            stack = traceback.StackSummary.extract(traceback.walk_stack(None), limit=12, lookup_lines=False)
+            with self._lock:
+                self._in_use += 1
+                self._checkouts += 1
+                self._wait_histogram[bisect.bisect_left(WAIT_BUCKETS_MS, (checkout_time - start) * 1000)] += 1
+                checkout_id = self._next_checkout_id
+                self._next_checkout_id += 1
+                self._held[checkout_id] = _Checkout(checkout_time, stack, threading.current_thread().name)
+            try:
+                self._health_check(conn, checkout_time)
+                yield conn
+            finally:
+                self._release(conn, checkout_id)
+        finally:
+            self._semaphore.release()
+
+    def _health_check(self, conn, now: float) -> None:
+        """连接空闲超过 `health_check_interval` 时执行一次 SELECT 1。执行失败时 SteadyDB 会重新建立连接并重试"""
+        steady = conn._con
+        if now - getattr(steady, '_ec_last_used', now) < self.health_check_interval:
+            return
+        raw_before = steady._con
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        if steady._con is not raw_before:
+            with self._lock:
+                self._reconnects += 1
+
+    def _release(self, conn, checkout_id: int) -> None:
+        now = time.monotonic()
+        conn._con._ec_last_used = now
+        try:
+            conn.close()  # 归还给 PooledDB，未提交的事务会被回滚
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                checkout = self._held.pop(checkout_id)
+                leaked = now - checkout.time > self.leak_threshold and not checkout.reported
+                if leaked:
+                    self._leaks += 1
+            if leaked:
+                self._report_leak(checkout, now, returned=True)
+
+    def check_leaks(self) -> int:
+        """报告取出后超过 `leak_threshold` 仍未归还的连接（每个连接只报告一次），返回这次报告的个数"""
+        now = time.monotonic()
+        with self._lock:
+            leaked = [c for c in self._held.values() if now - c.time > self.leak_threshold and not c.reported]
+            for checkout in leaked:
+                checkout.reported = True
+            self._leaks += len(leaked)
+        for checkout in leaked:
+            self._report_leak(checkout, now, returned=False)
+        return len(leaked)
+
+    @staticmethod
+    def _report_leak(checkout: "_Checkout", now: float, returned: bool) -> None:
+        message = "Postgres connection held for {:.1f}s" if returned else "Postgres connection not returned after {:.1f}s"
+        logger.warning(message.format(now - checkout.time),
+                       {"thread": checkout.thread, "stack": ''.join(checkout.stack.format())})
+
+    def stats(self) -> Dict:
+        """当前进程中连接池的统计信息，同时检查未归还的连接"""
+        self.check_leaks()
+        now = time.monotonic()
+        with self._lock:
+            histogram = {"<={}ms".format(bound): count for bound, count in zip(WAIT_BUCKETS_MS, self._wait_histogram)}
+            histogram[">{}ms".format(WAIT_BUCKETS_MS[-1])] = self._wait_histogram[-1]
+            return {"max_connections": self.maxconnections,
+                    "open"           : len(self._pool._idle_cache) + self._in_use,
+                    "in_use"         : self._in_use,
+                    "checkouts"      : self._checkouts,
+                    "timeouts"       : self._timeouts,
+                    "leaks"          : self._leaks,
+                    "held_too_long"  : sum(now - c.time > self.leak_threshold for c in self._held.values()),
+                    "reconnects"     : self._reconnects,
+                    "wait_histogram" : histogram}
+
 
 def init_pool(current_application) -> None:
     """创建连接池，保存在 app 的 postgres 属性中"""
     # more information at https://cito.github.io/DBUtils/UsersGuide.html
-    current_application.postgres = PooledDB(creator=psycopg2,
-                                            mincached=1,
-                                            maxcached=4,
-                                            maxconnections=4,
-                                            blocking=True,
-                                            **_config.POSTGRES_CONNECTION,
-                                            options=_options)
+    current_application.postgres = ConnectionPool(creator=psycopg2,
+                                                  mincached=1,
+                                                  maxcached=4,
+                                                  maxconnections=4,
+                                                  checkout_timeout=_config.POSTGRES_CHECKOUT_TIMEOUT,
+                                                  health_check_interval=_config.POSTGRES_HEALTH_CHECK_INTERVAL,
+                                                  leak_threshold=_config.POSTGRES_LEAK_THRESHOLD,
+                                                  **_config.POSTGRES_CONNECTION,
+                                                  options=_options)
 
 
 @contextmanager
 def pg_conn_context():
     if has_app_context():
-        conn = current_app.postgres.connection()
+        with current_app.postgres.connection() as conn:
+            register_types(conn)
+            yield conn
     else:
         conn = psycopg2.connect(**_config.POSTGRES_CONNECTION,
                                 options=_options)
-    register_types(conn)
-    yield conn
-    conn.close()
+        try:
+            register_types(conn)
+            yield conn
+        finally:
+            conn.close()
+
+
+_types_registered = False
+_types_lock = threading.Lock()
 
 
 def register_types(conn):
-    if has_app_context():
-        real_conn = conn._con._con
-        # conn 是 PooledDB（或PersistentDB）的连接，它的 _con 是 SteadyDB。而 SteadyDB 的 _con 是原始的 psycopg2 连接对象
-    else:
-        real_conn = conn
-    register_uuid(conn_or_curs=real_conn)
-    register_hstore(conn_or_curs=real_conn)
+    """
+    注册 uuid 和 hstore 类型
+
+    hstore 的 OID 需要查询系统表才能得到，如果每次取出连接都注册一次，每个 DAO 调用都会多一次往返。同一进程只连接同一个数据库，
+    OID 不会变化，所以只在进程中第一次取得连接时查询一次 OID，并把类型转换全局注册（只影响客户端，不依赖会话状态，
+    在 PgBouncer 的事务池模式下也可以使用）。
+    """
+    global _types_registered
+    if _types_registered:
+        return
+
+    with _types_lock:
+        if _types_registered:
+            return
+        if has_app_context():
+            real_conn = conn._con._con
+            # conn 是 PooledDB（或PersistentDB）的连接，它的 _con 是 SteadyDB。而 SteadyDB 的 _con 是原始的 psycopg2 连接对象
+        else:
+            real_conn = conn
+        register_uuid()
+        oid, array_oid = HstoreAdapter.get_oids(real_conn)
+        register_hstore(real_conn, globally=True, oid=oid, array_oid=array_oid)
+        _types_registered = True
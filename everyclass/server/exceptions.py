@@ -31,3 +31,8 @@ class RpcServerException(RpcException):
 class RpcServerNotAvailable(RpcServerException):
     """HTTP 503"""
     pass
+
+
+class PoolTimeout(TimeoutError):
+    """no database connection became available within the checkout timeout"""
+    pass
@@ -0,0 +1,140 @@
+"""
+多人共同空闲时间查询
+
+学生组织需要在多名成员之间安排会议时，可以一次提交所有成员的资源标识。服务端并发获取课表，将每个人的课表转换为
+“周次 × 星期 × 节次”的位图，通过按位或得到所有人都空闲的时间，并统计每个时间格空闲的人数。
+"""
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import elasticapm
+from flask import Blueprint, current_app as app, jsonify, request
+
+from everyclass.server.calendar.cache import data_version
+from everyclass.server.db.dao import Redis
+from everyclass.server.models import Semester
+from everyclass.server.rpc import handle_exception_with_message
+from everyclass.server.rpc.api_server import APIServer, CardItem
+from everyclass.server.utils import SLOTS_PER_WEEK, iter_bits, lesson_string_to_tuple, slot_index
+from everyclass.server.utils.access_control import get_blocked_level
+from everyclass.server.utils.decorators import disallow_in_maintenance
+from everyclass.server.utils.resource_identifier_encrypt import decrypt
+
+free_time_bp = Blueprint('free_time', __name__)
+
+
+def cards_to_bitset(cards: List[CardItem]) -> int:
+    """将课表转换为位图，第 `slot_index(week, day, time)` 位为 1 表示该时间格有课"""
+    bits = 0
+    for card in cards:
+        day, time = lesson_string_to_tuple(card.lesson)
+        for week in card.weeks:
+            bits |= 1 << slot_index(week, day, time)
+    return bits
+
+
+def _slot_tuple(slot: int) -> Tuple[int, int, int]:
+    """时间格编号转换回（周次, 星期, 节次）"""
+    week, rest = divmod(slot, SLOTS_PER_WEEK)
+    day, time = divmod(rest, 6)
+    return week + 1, day + 1, time + 1
+
+
+def compute_free_time(busy_bitsets: List[int], min_free: int) -> Dict:
+    """
+    计算共同空闲时间
+
+    :param busy_bitsets: 每个成员的课表位图
+    :param min_free: “大部分人空闲”的最少空闲人数
+    :return: 包含周数、所有人都空闲的时间格和大部分人空闲的时间格（附带空闲人数）的字典
+    """
+    max_bits = max([bits.bit_length() for bits in busy_bitsets] + [1])
+    weeks = (max_bits + SLOTS_PER_WEEK - 1) // SLOTS_PER_WEEK
+    slots = weeks * SLOTS_PER_WEEK
+
+    busy_any = 0
+    free_counts = [len(busy_bitsets)] * slots
+    for bits in busy_bitsets:
+        busy_any |= bits
+        for slot in iter_bits(bits):
+            free_counts[slot] -= 1
+
+    return {"weeks"      : weeks,
+            "free"       : [_slot_tuple(slot) for slot in iter_bits(~busy_any & ((1 << slots) - 1))],
+            "mostly_free": [dict(zip(("week", "day", "time"), _slot_tuple(slot)), free=count)
+                            for slot, count in enumerate(free_counts)
+                            if min_free <= count < len(busy_bitsets)]}
+
+
+def _fetch_timetable(app_obj, resource_type: str, identifier: str, semester: str):
+    with app_obj.app_context():
+        if resource_type == 'student':
+            return APIServer.get_student_timetable(identifier, semester)
+        return APIServer.get_teacher_timetable(identifier, semester)
+
+
+@free_time_bp.route('/freeTime', methods=['POST'])
+@disallow_in_maintenance
+def free_time():
+    """
+    多人共同空闲时间
+
+    请求体为 JSON：{"ids": [加密后的学号或教工号...], "semester": "2018-2019-1", "min_free": 可选}。
+    没有权限查看的学生不参与计算，其标识在返回值的 `hidden` 中列出。
+    """
+    payload = request.get_json(silent=True) or {}
+    ids = payload.get('ids')
+    semester = payload.get('semester')
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, str) for i in ids) or \
+            not isinstance(semester, str) or \
+            Semester(semester).to_tuple() not in app.config['AVAILABLE_SEMESTERS']:
+        return "Bad request", 400
+    if len(ids) > app.config['FREE_TIME_MAX_MEMBERS']:
+        return "Too many members", 400
+
+    members: List[Tuple[str, str]] = []
+    hidden: List[str] = []
+    for encrypted_id in set(ids):
+        try:
+            resource_type, identifier = decrypt(encrypted_id)
+        except ValueError:
+            return "Invalid identifier", 400
+        if resource_type not in ('student', 'teacher'):
+            return "Unknown resource type", 400
+        if resource_type == 'student' and get_blocked_level(identifier):
+            hidden.append(encrypted_id)
+            continue
+        members.append((resource_type, identifier))
+    members.sort()
+    if not members:
+        return jsonify({"weeks": 0, "free": [], "mostly_free": [], "members": [], "hidden": hidden})
+
+    min_free = payload.get('min_free')
+    if not isinstance(min_free, int) or min_free < 1:
+        min_free = max(1, len(members) * 4 // 5)
+
+    # 与日历缓存一样带上共享的数据版本，数据更新后不再返回旧的结果
+    cache_key = hashlib.sha1(json.dumps([data_version(), semester, min_free, members]).encode()).hexdigest()
+    cached = Redis.get_free_time(cache_key)
+    if cached:
+        result = json.loads(cached)
+    else:
+        with elasticapm.capture_span('rpc_get_timetables'):
+            app_obj = app._get_current_object()
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(_fetch_timetable, app_obj, typ, identifier, semester)
+                           for typ, identifier in members]
+                try:
+                    timetables = [f.result() for f in futures]
+                except Exception as e:
+                    return handle_exception_with_message(e)
+
+        with elasticapm.capture_span('compute_free_time'):
+            result = compute_free_time([cards_to_bitset(t.cards) for t in timetables], min_free)
+        result["members"] = [t.name for t in timetables]
+        Redis.set_free_time(cache_key, json.dumps(result), app.config['FREE_TIME_CACHE_EXPIRE'])
+
+    result["hidden"] = hidden
+    return jsonify(result)
@@ -1,9 +1,6 @@
 """
 查询相关函数
 """
-from collections import defaultdict
-from typing import Dict, List, Tuple
-
 import elasticapm
 from flask import Blueprint, current_app as app, escape, flash, redirect, render_template, request, session, url_for
 
@@ -11,10 +8,11 @@ from everyclass.server import logger
 from everyclass.server.consts import MSG_INVALID_IDENTIFIER, SESSION_CURRENT_USER, SESSION_LAST_VIEWED_STUDENT
 from everyclass.server.db.dao import COTeachingClass, CourseReview, Redis
 from everyclass.server.models import StudentSession
-from everyclass.server.rpc import handle_exception_with_error_page
+from everyclass.server.rpc import RpcResourceNotFound, handle_exception_with_error_page
 from everyclass.server.rpc.api_server import APIServer
-from everyclass.server.utils import contains_chinese, get_day_chinese, get_time_chinese, lesson_string_to_tuple, \
-    semester_calculate
+from everyclass.server.search.index import get_index as get_search_index, to_search_result
+from everyclass.server.utils import classify_identifier, contains_chinese, get_day_chinese, get_time_chinese, \
+    lesson_string_to_tuple, semester_calculate
 from everyclass.server.utils.access_control import check_permission
 from everyclass.server.utils.decorators import disallow_in_maintenance, url_semester_check
 from everyclass.server.utils.resource_identifier_encrypt import decrypt
@@ -45,12 +43,43 @@ def query():
         flash('请输入需要查询的姓名、学号、教工号或教室名称，长度不要小于2个字符')
         return redirect(url_for('main.main'))
 
-    # 调用 api-server 搜索
-    with elasticapm.capture_span('rpc_search'):
-        try:
-            rpc_result = APIServer.search(keyword)
-        except Exception as e:
-            return handle_exception_with_error_page(e)
+    # 优先在本地索引中精确查找学工号、教室编号或姓名（不含拼音首字母），找不到再调用 api-server 搜索
+    rpc_result = None
+    local_index = get_search_index()
+    if local_index:
+        with elasticapm.capture_span('local_search'):
+            local_entities = local_index.lookup_identifier(keyword)
+        if local_entities:
+            rpc_result = to_search_result(local_entities)
+
+    # 学号、教工号格式的关键词直接调用代价更低的实体接口，跳转到最新学期，省去搜索
+    if not rpc_result:
+        resource_type = classify_identifier(keyword)
+        if resource_type:
+            with elasticapm.capture_span('rpc_get_{}'.format(resource_type)):
+                try:
+                    if resource_type == 'student':
+                        entity = APIServer.get_student(keyword)
+                    else:
+                        entity = APIServer.get_teacher(keyword)
+                except RpcResourceNotFound:
+                    entity = None  # 格式相符但并不存在，交给搜索处理
+                except Exception as e:
+                    return handle_exception_with_error_page(e)
+
+            if entity and entity.semesters:
+                elasticapm.tag(query_resource_type='single_{}'.format(resource_type))
+                elasticapm.tag(query_type='by_id')
+                if resource_type == 'student':
+                    return redirect('/student/{}/{}'.format(entity.student_id_encoded, sorted(entity.semesters)[-1]))
+                return redirect('/teacher/{}/{}'.format(entity.teacher_id_encoded, entity.semesters[-1]))
+
+    if not rpc_result:
+        with elasticapm.capture_span('rpc_search'):
+            try:
+                rpc_result = APIServer.search(keyword)
+            except Exception as e:
+                return handle_exception_with_error_page(e)
 
     # 不同类型渲染不同模板
     if len(rpc_result.classrooms) >= 1:  # 优先展示教室
@@ -140,13 +169,6 @@ def get_student(url_sid: str, url_semester: str):
         return return_val
 
     with elasticapm.capture_span('process_rpc_result'):
-        cards: Dict[Tuple[int, int], List[Dict[str, str]]] = dict()
-        for card in student.cards:
-            day, time = lesson_string_to_tuple(card.lesson)
-            if (day, time) not in cards:
-                cards[(day, time)] = list()
-            cards[(day, time)].append(card)
-        empty_5, empty_6, empty_sat, empty_sun = _empty_column_check(cards)
         available_semesters = semester_calculate(url_semester, sorted(student.semesters))
 
     # 增加访客记录
@@ -154,11 +176,11 @@ def get_student(url_sid: str, url_semester: str):
 
     return render_template('query/student.html',
                            student=student,
-                           cards=cards,
-                           empty_sat=empty_sat,
-                           empty_sun=empty_sun,
-                           empty_6=empty_6,
-                           empty_5=empty_5,
+                           cards=student.grid,
+                           empty_sat=student.grid.empty_sat,
+                           empty_sun=student.grid.empty_sun,
+                           empty_6=student.grid.empty_6,
+                           empty_5=student.grid.empty_5,
                            available_semesters=available_semesters,
                            current_semester=url_semester)
 
@@ -182,25 +204,15 @@ def get_teacher(url_tid, url_semester):
         except Exception as e:
             return handle_exception_with_error_page(e)
 
-    with elasticapm.capture_span('process_rpc_result'):
-        cards = defaultdict(list)
-        for card in teacher.cards:
-            day, time = lesson_string_to_tuple(card.lesson)
-            if (day, time) not in cards:
-                cards[(day, time)] = list()
-            cards[(day, time)].append(card)
-
-    empty_5, empty_6, empty_sat, empty_sun = _empty_column_check(cards)
-
     available_semesters = semester_calculate(url_semester, teacher.semesters)
 
     return render_template('query/teacher.html',
                            teacher=teacher,
-                           cards=cards,
-                           empty_sat=empty_sat,
-                           empty_sun=empty_sun,
-                           empty_6=empty_6,
-                           empty_5=empty_5,
+                           cards=teacher.grid,
+                           empty_sat=teacher.grid.empty_sat,
+                           empty_sun=teacher.grid.empty_sun,
+                           empty_6=teacher.grid.empty_6,
+                           empty_5=teacher.grid.empty_5,
                            available_semesters=available_semesters,
                            current_semester=url_semester)
 
@@ -223,23 +235,15 @@ def get_classroom(url_rid, url_semester):
         except Exception as e:
             return handle_exception_with_error_page(e)
 
-    with elasticapm.capture_span('process_rpc_result'):
-        cards = defaultdict(list)
-        for card in room.cards:
-            day, time = lesson_string_to_tuple(card.lesson)
-            cards[(day, time)].append(card)
-
-    empty_5, empty_6, empty_sat, empty_sun = _empty_column_check(cards)
-
     available_semesters = semester_calculate(url_semester, room.semesters)
 
     return render_template('query/room.html',
                            room=room,
-                           cards=cards,
-                           empty_sat=empty_sat,
-                           empty_sun=empty_sun,
-                           empty_6=empty_6,
-                           empty_5=empty_5,
+                           cards=room.grid,
+                           empty_sat=room.grid.empty_sat,
+                           empty_sun=room.grid.empty_sun,
+                           empty_6=room.grid.empty_6,
+                           empty_5=room.grid.empty_5,
                            available_semesters=available_semesters,
                            current_semester=url_semester)
 
@@ -280,29 +284,3 @@ def get_card(url_cid: str, url_semester: str):
                            cotc_rating=course_review_doc["avg_rate"],
                            current_semester=url_semester
                            )
-
-
-def _empty_column_check(cards: dict) -> Tuple[bool, bool, bool, bool]:
-    """检查是否周末和晚上有课，返回三个布尔值"""
-    with elasticapm.capture_span('_empty_column_check'):
-        # 空闲周末判断，考虑到大多数人周末都是没有课程的
-        empty_sat = True
-        for cls_time in range(1, 7):
-            if (6, cls_time) in cards:
-                empty_sat = False
-
-        empty_sun = True
-        for cls_time in range(1, 7):
-            if (7, cls_time) in cards:
-                empty_sun = False
-
-        # 空闲课程判断，考虑到大多数人11-12节都是没有课程的
-        empty_6 = True
-        for cls_day in range(1, 8):
-            if (cls_day, 6) in cards:
-                empty_6 = False
-        empty_5 = True
-        for cls_day in range(1, 8):
-            if (cls_day, 5) in cards:
-                empty_5 = False
-    return empty_5, empty_6, empty_sat, empty_sun
@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field, fields
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 
 from flask import current_app as app
 
@@ -7,7 +7,7 @@ from everyclass.server import logger
 from everyclass.server.config import get_config
 from everyclass.server.exceptions import RpcException
 from everyclass.server.rpc.http import HttpRpc
-from everyclass.server.utils import weeks_to_string
+from everyclass.server.utils import lesson_string_to_tuple, weeks_to_string
 from everyclass.server.utils.resource_identifier_encrypt import encrypt
 
 
@@ -151,6 +151,51 @@ class CardItem:
         return cls(**ensure_slots(cls, dct))
 
 
+@dataclass
+class TimetableGrid:
+    """
+    课表网格：按（星期, 节次）将 card 放入固定的 7×6 二维数组，空行、空列标记在构建时一次遍历算出。
+
+    学生、老师、教室页面以及 ics 导出共用此结构，模板中可以继续使用 `cards[(day, time)]` 的写法。
+    """
+    slots: List[List[List[CardItem]]]  # slots[day - 1][time - 1]
+    empty_5: bool  # 第9-10节是否没有课
+    empty_6: bool  # 第11-12节是否没有课
+    empty_sat: bool  # 周六是否没有课
+    empty_sun: bool  # 周日是否没有课
+
+    @classmethod
+    def make(cls, cards: List[CardItem]) -> "TimetableGrid":
+        slots: List[List[List[CardItem]]] = [[[] for _ in range(6)] for _ in range(7)]
+        day_used = [False] * 7
+        time_used = [False] * 6
+        for card in cards:
+            day, time = lesson_string_to_tuple(card.lesson)
+            slots[day - 1][time - 1].append(card)
+            day_used[day - 1] = True
+            time_used[time - 1] = True
+        return cls(slots=slots,
+                   empty_5=not time_used[4],
+                   empty_6=not time_used[5],
+                   empty_sat=not day_used[5],
+                   empty_sun=not day_used[6])
+
+    def __getitem__(self, key: Tuple[int, int]) -> List[CardItem]:
+        day, time = key
+        return self.slots[day - 1][time - 1]
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        day, time = key
+        return 1 <= day <= 7 and 1 <= time <= 6 and len(self.slots[day - 1][time - 1]) > 0
+
+    def items(self) -> Iterator[Tuple[Tuple[int, int], List[CardItem]]]:
+        """按先节次、后星期的顺序遍历有课的格子"""
+        for time in range(1, 7):
+            for day in range(1, 8):
+                if self.slots[day - 1][time - 1]:
+                    yield (day, time), self.slots[day - 1][time - 1]
+
+
 @dataclass
 class ClassroomTimetableResult:
     room_id: str
@@ -161,6 +206,10 @@ class ClassroomTimetableResult:
     semester: str
     semesters: List[str]
     cards: List[CardItem]
+    grid: TimetableGrid = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.grid = TimetableGrid.make(self.cards)
 
     @classmethod
     def make(cls, dct: Dict) -> "ClassroomTimetableResult":
@@ -224,6 +273,24 @@ class StudentResult:
         return cls(**ensure_slots(cls, dct))
 
 
+@dataclass
+class TeacherResult:
+    name: str
+    teacher_id: str
+    teacher_id_encoded: str
+    unit: str
+    title: str
+    semesters: List[str] = field(default_factory=list)  # optional field
+
+    @classmethod
+    def make(cls, dct: Dict) -> "TeacherResult":
+        del dct["status"]
+        dct["teacher_id"] = dct.pop("teacher_code")
+        dct["teacher_id_encoded"] = encrypt("teacher", dct["teacher_id"])
+        dct["semesters"] = sorted(dct.pop('semester_list'))
+        return cls(**ensure_slots(cls, dct))
+
+
 @dataclass
 class StudentTimetableResult:
     name: str  # 姓名
@@ -235,6 +302,10 @@ class StudentTimetableResult:
     cards: List[CardItem]  # card 列表
     semester: str  # 当前学期
     semesters: List[str] = field(default_factory=list)  # 学期列表
+    grid: TimetableGrid = field(init=False, repr=False)  # 课表网格
+
+    def __post_init__(self):
+        self.grid = TimetableGrid.make(self.cards)
 
     @classmethod
     def make(cls, dct: Dict) -> "StudentTimetableResult":
@@ -258,6 +329,10 @@ class TeacherTimetableResult:
     cards: List[CardItem]  # card 列表
     semester: str  # 当前学期
     semesters: List[str] = field(default_factory=list)  # 所有学期
+    grid: TimetableGrid = field(init=False, repr=False)  # 课表网格
+
+    def __post_init__(self):
+        self.grid = TimetableGrid.make(self.cards)
 
     @classmethod
     def make(cls, dct: Dict) -> "TeacherTimetableResult":
@@ -305,6 +380,19 @@ class CardResult:
         return cls(**ensure_slots(cls, dct))
 
 
+@dataclass
+class ClassroomListItem:
+    room_id: str
+    name: str
+    campus: str
+    building: str
+
+    @classmethod
+    def make(cls, dct: Dict) -> "ClassroomListItem":
+        dct['room_id'] = dct.pop("room_code")
+        return cls(**ensure_slots(cls, dct))
+
+
 def teacher_list_to_name_str(teachers: List[CardResultTeacherItem]) -> str:
     """CardResultTeacherItem 列表转换为老师姓名列表字符串"""
     return "、".join([t.name + t.title for t in teachers])
@@ -370,6 +458,24 @@ class APIServer:
         search_result = StudentResult.make(resp)
         return search_result
 
+    @classmethod
+    def get_teacher(cls, teacher_id: str) -> TeacherResult:
+        """
+        根据教工号获得老师基本信息
+
+        :param teacher_id: 教工号
+        :return:
+        """
+        resp = HttpRpc.call(method="GET",
+                            url='{}/teacher/{}'.format(app.config['API_SERVER_BASE_URL'],
+                                                       teacher_id),
+                            retry=True,
+                            headers={'X-Auth-Token': get_config().API_SERVER_TOKEN})
+        if resp["status"] != "success":
+            raise RpcException('API Server returns non-success status')
+        search_result = TeacherResult.make(resp)
+        return search_result
+
     @classmethod
     def get_student_timetable(cls, student_id: str, semester: str):
         """
@@ -429,6 +535,35 @@ class APIServer:
         search_result = ClassroomTimetableResult.make(resp)
         return search_result
 
+    @classmethod
+    def get_classroom_list(cls, semester: str) -> List[ClassroomListItem]:
+        """
+        获得某学期所有有课的教室
+        :param semester: 学期，如 2018-2019-1
+        :return: 教室列表
+        """
+        resp = HttpRpc.call(method="GET",
+                            url='{}/room/list/{}'.format(app.config['API_SERVER_BASE_URL'], semester),
+                            retry=True,
+                            headers={'X-Auth-Token': get_config().API_SERVER_TOKEN})
+        if resp["status"] != "success":
+            raise RpcException('API Server returns non-success status')
+        return [ClassroomListItem.make(x) for x in resp['room_list']]
+
+    @classmethod
+    def get_search_export(cls) -> List[Dict]:
+        """
+        获得全部学生、老师和教室的导出数据，用于构建本地搜索索引。每个元素的字段与搜索接口返回的一致，另有
+        `pinyin` 字段为姓名的拼音首字母
+        """
+        resp = HttpRpc.call(method="GET",
+                            url='{}/search/export'.format(app.config['API_SERVER_BASE_URL']),
+                            retry=True,
+                            headers={'X-Auth-Token': get_config().API_SERVER_TOKEN})
+        if resp["status"] != "success":
+            raise RpcException('API Server returns non-success status')
+        return resp['data']
+
     @classmethod
     def get_card(cls, semester: str, card_id: str) -> CardResult:
         """
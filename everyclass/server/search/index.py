@@ -0,0 +1,194 @@
+"""
+本地搜索索引
+
+定时从 api-server 导出全部学生、老师和教室（姓名、学工号或教室编号、拼音首字母、学期），把所有检索键排序后写入索引文件。
+文件通过 mmap 映射，同一台机器上的所有 worker 共享。精确查找和前缀查找都只需要在有序键表上做二分，不需要远程调用。
+
+文件格式（整数均为 4 字节小端无符号整数）：
+- header：magic `ECSI`、实体数 n、键数 m
+- 实体偏移表（n + 1 个）、键偏移表（m + 1 个）、键对应的实体下标表（m 个）
+- 实体区：每个实体为一段 UTF-8 JSON，字段与搜索接口返回的一致
+- 键区：按 UTF-8 字节序排序的小写检索键
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, List, Optional
+
+from everyclass.server import logger
+from everyclass.server.config import get_config
+from everyclass.server.rpc.api_server import SearchResult, SearchResultClassroomItem, SearchResultStudentItem, \
+    SearchResultTeacherItem
+
+MAGIC = b'ECSI'
+_HEADER = struct.Struct('<4sII')
+_UINT = struct.Struct('<I')
+
+_CODE_FIELDS = {'student': 'student_code', 'teacher': 'teacher_code', 'room': 'room_code'}
+
+
+def index_path() -> str:
+    """搜索索引文件路径"""
+    return os.path.join(get_config().INDEX_FILES_DIR, 'search.idx')
+
+
+def normalize(keyword: str) -> str:
+    """检索键统一为去掉首尾空白的小写形式"""
+    return keyword.strip().lower()
+
+
+def _keys_of(entity: Dict) -> List[str]:
+    keys = {normalize(entity['name']), normalize(entity[_CODE_FIELDS[entity['type']]])}
+    if entity.get('pinyin'):
+        keys.add(normalize(entity['pinyin']))
+    return [k for k in keys if k]
+
+
+def write_index(path: str, entities: List[Dict]) -> None:
+    """
+    写入索引文件。先写临时文件再重命名，正在读取旧文件的 worker 不受影响
+
+    :param path: 文件路径
+    :param entities: 导出的实体列表，每个实体需要包含 type、name 和对应类型的编号字段
+    """
+    entity_blobs = [json.dumps(e, ensure_ascii=False).encode('utf-8') for e in entities]
+    keys = sorted((key.encode('utf-8'), i) for i, e in enumerate(entities) for key in _keys_of(e))
+
+    def offsets(blobs: List[bytes]) -> bytes:
+        result = [0]
+        for blob in blobs:
+            result.append(result[-1] + len(blob))
+        return b''.join(_UINT.pack(x) for x in result)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, len(entities), len(keys)))
+        f.write(offsets(entity_blobs))
+        f.write(offsets([key for key, _ in keys]))
+        f.write(b''.join(_UINT.pack(i) for _, i in keys))
+        f.write(b''.join(entity_blobs))
+        f.write(b''.join(key for key, _ in keys))
+    os.replace(tmp_path, path)
+
+
+def build_index() -> None:
+    """从 api-server 导出数据并生成搜索索引（需要在 app context 中调用）"""
+    from everyclass.server.rpc.api_server import APIServer
+
+    entities = [e for e in APIServer.get_search_export() if e.get('type') in _CODE_FIELDS]
+    write_index(index_path(), entities)
+    logger.info("Search index built", {"entities": len(entities)})
+
+
+class SearchIndex:
+    """只读的本地搜索索引，底层为 mmap 映射的索引文件"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.entity_count, self.key_count = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a search index file: {}".format(path))
+
+        self._entity_offsets = _HEADER.size
+        self._key_offsets = self._entity_offsets + (self.entity_count + 1) * _UINT.size
+        self._key_entities = self._key_offsets + (self.key_count + 1) * _UINT.size
+        self._entity_blob = self._key_entities + self.key_count * _UINT.size
+        self._key_blob = self._entity_blob + self._uint(self._entity_offsets + self.entity_count * _UINT.size)
+
+    def _uint(self, position: int) -> int:
+        return _UINT.unpack_from(self._mm, position)[0]
+
+    def _key(self, i: int) -> bytes:
+        start = self._uint(self._key_offsets + i * _UINT.size)
+        end = self._uint(self._key_offsets + (i + 1) * _UINT.size)
+        return self._mm[self._key_blob + start:self._key_blob + end]
+
+    def _entity(self, i: int) -> Dict:
+        start = self._uint(self._entity_offsets + i * _UINT.size)
+        end = self._uint(self._entity_offsets + (i + 1) * _UINT.size)
+        return json.loads(self._mm[self._entity_blob + start:self._entity_blob + end].decode('utf-8'))
+
+    def _bisect(self, key: bytes) -> int:
+        lo, hi = 0, self.key_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _scan(self, key: bytes, prefix: bool, limit: Optional[int]) -> List[Dict]:
+        seen = set()
+        result = []
+        i = self._bisect(key)
+        while i < self.key_count and (limit is None or len(result) < limit):
+            current = self._key(i)
+            if not (current.startswith(key) if prefix else current == key):
+                break
+            entity_index = self._uint(self._key_entities + i * _UINT.size)
+            if entity_index not in seen:
+                seen.add(entity_index)
+                result.append(self._entity(entity_index))
+            i += 1
+        return result
+
+    def lookup(self, keyword: str) -> List[Dict]:
+        """精确查找学工号、教室编号、姓名或拼音首字母"""
+        return self._scan(normalize(keyword).encode('utf-8'), prefix=False, limit=None)
+
+    def lookup_identifier(self, keyword: str) -> List[Dict]:
+        """
+        精确查找学工号、教室编号或姓名，不匹配拼音首字母
+
+        用于 /query 跳过远程搜索：“zs”这样的短关键词只是碰巧与一些人的拼音首字母相同，不能把它们都当作精确结果
+        """
+        keyword = normalize(keyword)
+        return [e for e in self.lookup(keyword)
+                if keyword in (normalize(e['name']), normalize(e[_CODE_FIELDS[e['type']]]))]
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[Dict]:
+        """前缀查找（包括拼音首字母），用于搜索建议"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        return self._scan(prefix.encode('utf-8'), prefix=True, limit=limit)
+
+
+def to_search_result(entities: List[Dict]) -> SearchResult:
+    """将索引中的实体转换为与 `APIServer.search` 相同的搜索结果对象"""
+    makers = {'student': SearchResultStudentItem.make,
+              'teacher': SearchResultTeacherItem.make,
+              'room'   : SearchResultClassroomItem.make}
+    items: Dict[str, List] = {'student': [], 'teacher': [], 'room': []}
+    for entity in entities:
+        entity.pop('pinyin', None)
+        entity['pattern'] = 'local'
+        items[entity['type']].append(makers[entity['type']](entity))
+    return SearchResult(students=items['student'], teachers=items['teacher'], classrooms=items['room'])
+
+
+_index: Optional[SearchIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> Optional[SearchIndex]:
+    """
+    获得搜索索引。索引文件被定时任务替换后会自动重新映射，文件不存在时返回 None
+
+    旧的映射可能仍在被其他线程读取，因此不主动 close，由垃圾回收释放
+    """
+    global _index
+    try:
+        mtime = os.stat(index_path()).st_mtime
+    except FileNotFoundError:
+        return None
+
+    with _index_lock:
+        if _index is None or _index.mtime != mtime:
+            _index = SearchIndex(index_path())
+        return _index
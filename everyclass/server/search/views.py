@@ -0,0 +1,36 @@
+"""
+搜索建议
+"""
+import elasticapm
+from flask import Blueprint, jsonify, request
+
+from everyclass.server.search.index import get_index, to_search_result
+from everyclass.server.utils.decorators import disallow_in_maintenance
+
+search_bp = Blueprint('search', __name__)
+
+
+@search_bp.route('/query/suggest')
+@disallow_in_maintenance
+def suggest():
+    """输入框搜索建议，只查询本地索引。索引不可用时返回空列表，前端退化为普通搜索"""
+    keyword = request.args.get('q', '')
+    index = get_index()
+    if len(keyword.strip()) < 1 or not index:
+        return jsonify({"students": [], "teachers": [], "classrooms": []})
+
+    with elasticapm.capture_span('local_search_suggest'):
+        result = to_search_result(index.suggest(keyword, limit=10))
+
+    return jsonify({"students"  : [{"name"     : s.name,
+                                    "id"       : s.student_id_encoded,
+                                    "klass"    : s.klass,
+                                    "semesters": s.semesters} for s in result.students],
+                    "teachers"  : [{"name"     : t.name,
+                                    "id"       : t.teacher_id_encoded,
+                                    "unit"     : t.unit,
+                                    "semesters": t.semesters} for t in result.teachers],
+                    "classrooms": [{"name"     : c.name,
+                                    "id"       : c.room_id_encoded,
+                                    "building" : c.building,
+                                    "semesters": c.semesters} for c in result.classrooms]})
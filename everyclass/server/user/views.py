@@ -396,7 +396,9 @@ def js_set_preference():
 @login_required
 def reset_calendar_token():
     """重置日历订阅令牌"""
-    CalendarToken.reset_tokens(session[SESSION_CURRENT_USER].sid_orig)
+    from everyclass.server.calendar.storage import delete_tokens
+
+    delete_tokens(CalendarToken.reset_tokens(session[SESSION_CURRENT_USER].sid_orig))
     flash("日历订阅令牌重置成功")
     return redirect(url_for("user.main"))
 
@@ -404,7 +406,40 @@ def reset_calendar_token():
 @user_bp.route('/visitors')
 @login_required
 def visitors():
-    """我的访客页面"""
-    visitor_list = VisitTrack.get_visitors(session[SESSION_CURRENT_USER].sid_orig)
+    """我的访客页面，只渲染第一页，后面的页面由 `js_get_visitors` 按需加载"""
+    from flask import current_app as app
+
+    visitor_list, next_cursor = VisitTrack.get_visitors(session[SESSION_CURRENT_USER].sid_orig,
+                                                        limit=app.config['VISITORS_PER_PAGE'])
     visitor_count = Redis.get_visitor_count(session[SESSION_CURRENT_USER].sid_orig)
-    return render_template("user/visitors.html", visitor_list=visitor_list, visitor_count=visitor_count)
+    return render_template("user/visitors.html",
+                           visitor_list=visitor_list,
+                           visitor_count=visitor_count,
+                           next_cursor=next_cursor.isoformat() if next_cursor else None,
+                           max_visitors=app.config['VISIT_TRACK_MAX_PER_HOST'])
+
+
+@user_bp.route('/visitors/more')
+@login_required
+def js_get_visitors():
+    """AJAX获得下一页访客，`before` 为上一页返回的游标"""
+    import datetime
+    from flask import current_app as app
+
+    try:
+        before = datetime.datetime.fromisoformat(request.args['before'])
+    except (KeyError, ValueError):
+        return jsonify({"acknowledged": False,
+                        "message"     : "Invalid cursor"}), 400
+
+    visitor_list, next_cursor = VisitTrack.get_visitors(session[SESSION_CURRENT_USER].sid_orig,
+                                                        limit=app.config['VISITORS_PER_PAGE'],
+                                                        before=before)
+    return jsonify({"acknowledged": True,
+                    "visitors"    : [{"name"      : visitor["name"],
+                                      "url"       : url_for('query.get_student',
+                                                            url_sid=visitor["student_id"],
+                                                            url_semester=visitor["last_semester"]),
+                                      "visit_time": visitor["visit_time"].isoformat()}
+                                     for visitor in visitor_list],
+                    "next_cursor" : next_cursor.isoformat() if next_cursor else None})
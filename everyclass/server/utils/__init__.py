@@ -1,6 +1,6 @@
 import os
 import re
-from typing import List, Tuple, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
 import elasticapm
 
@@ -68,6 +68,22 @@ def lesson_string_to_tuple(lesson: str) -> Tuple[int, int]:
     return day, time
 
 
+SLOTS_PER_WEEK = 7 * 6  # 一周 7 天，每天 6 大节
+
+
+def slot_index(week: int, day: int, time: int) -> int:
+    """将（周次, 星期, 节次）映射为从 0 开始的连续时间格编号，用于课表位图"""
+    return ((week - 1) * 7 + (day - 1)) * 6 + (time - 1)
+
+
+def iter_bits(bits: int) -> Iterator[int]:
+    """按从低到高的顺序返回位图中为 1 的位的下标"""
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
 def semester_calculate(current_semester: str, semester_list: List[str]) -> List[Tuple[str, bool]]:
     """生成一个列表，每个元素是一个二元组，分别为学期字符串和是否为当前学期的布尔值"""
     with elasticapm.capture_span('semester_calculate'):
@@ -96,6 +112,20 @@ def contains_chinese(word: str) -> bool:
     return True if match else False
 
 
+def classify_identifier(keyword: str) -> Optional[str]:
+    """
+    根据格式判断关键词是否为学号或教工号
+
+    :param keyword: 搜索关键词
+    :return: "student"、"teacher"，无法识别时返回 None
+    """
+    from everyclass.server.config import get_config
+    for resource_type, pattern in get_config().IDENTIFIER_PATTERNS.items():
+        if re.match(pattern, keyword):
+            return resource_type
+    return None
+
+
 def plugin_available(plugin_name: str) -> bool:
     """
     check if a plugin (Sentry, apm, logstash) is available in the current environment.
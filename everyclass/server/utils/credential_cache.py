@@ -0,0 +1,58 @@
+"""
+最近验证通过的密码缓存
+
+安卓客户端每次同步隐私保护学生的日历时都带着 HTTP Basic 认证，每次都要查询数据库并做一次刻意设计得很慢的 PBKDF2 验证。
+这里在进程内缓存最近验证通过的凭据：只保存以进程内随机密钥计算的 (学号, 密码) 的 HMAC，不保存密码本身，数据库中的哈希
+也不受影响。缓存的有效期很短，并且带有保存在 Redis 中的凭据版本号，密码或隐私级别变化时版本号增加，各进程中的缓存随之失效。
+
+只缓存验证成功的结果，错误的密码每次都需要完整验证，不会加快暴力破解。
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from everyclass.server.config import get_config
+from everyclass.server.db.dao import Redis, User
+
+_secret: Optional[bytes] = None
+_secret_pid: Optional[int] = None
+_cache: Dict[str, Tuple[bytes, float, int]] = {}  # 学号 -> (HMAC, 过期时间, 凭据版本)
+_lock = threading.Lock()
+
+
+def _mac(student_id: str, password: str) -> bytes:
+    global _secret, _secret_pid
+    if _secret_pid != os.getpid():  # 每个 worker 在 fork 之后使用自己的密钥
+        _secret, _secret_pid = os.urandom(32), os.getpid()
+        _cache.clear()
+    return hmac.new(_secret, '{}\0{}'.format(student_id, password).encode('utf-8'), hashlib.sha256).digest()
+
+
+def check_password(student_id: str, password: str) -> bool:
+    """
+    验证密码，语义与 `User.check_password` 相同（学生未注册时抛出 ValueError），近期验证通过的凭据不再重复验证
+    """
+    config = get_config()
+    version = Redis.get_credential_version(student_id)
+    now = time.monotonic()
+
+    with _lock:
+        mac = _mac(student_id, password)
+        entry = _cache.get(student_id)
+    if entry and entry[1] > now and entry[2] == version and hmac.compare_digest(entry[0], mac):
+        return True
+
+    if not User.check_password(student_id, password):
+        return False
+
+    with _lock:
+        if len(_cache) >= config.CREDENTIAL_CACHE_MAX_ENTRIES:
+            for key in [k for k, v in _cache.items() if v[1] <= now]:
+                del _cache[key]
+            if len(_cache) >= config.CREDENTIAL_CACHE_MAX_ENTRIES:
+                _cache.clear()
+        _cache[student_id] = (mac, now + config.CREDENTIAL_CACHE_TTL, version)
+    return True
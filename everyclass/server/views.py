@@ -1,7 +1,7 @@
 import os
 import time
 
-from flask import Blueprint, Response, jsonify, render_template, request
+from flask import Blueprint, Response, current_app, jsonify, render_template, request
 
 from everyclass.server.config import get_config
 from everyclass.server.consts import MSG_404
@@ -52,6 +52,26 @@ def health_check():
     return jsonify({"status": "ok"})
 
 
+@main_blueprint.route('/_poolStats')
+def pool_stats():
+    """当前 worker 进程的数据库连接池和访客记录缓存统计，使用维护账号认证"""
+    config = get_config()
+    auth = request.authorization
+    if auth \
+            and auth.username in config.MAINTENANCE_CREDENTIALS \
+            and config.MAINTENANCE_CREDENTIALS[auth.username] == auth.password:
+        from everyclass.server.db.dao import VisitTrack
+
+        return jsonify({"pid"        : os.getpid(),
+                        "postgres"   : current_app.postgres.stats() if hasattr(current_app, 'postgres') else None,
+                        "visit_track": VisitTrack.buffer_stats()})
+    else:
+        return Response(
+                'Could not verify your access level for that URL.\n'
+                'You have to login with proper credentials', 401,
+                {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+
 @main_blueprint.route("/_maintenance")
 def enter_maintenance():
     config = get_config()
@@ -1,5 +1,7 @@
 import gc
 
+import click
+
 from everyclass.server import create_app
 
 app = create_app()
@@ -17,5 +19,75 @@ def test():
     unittest.TextTestRunner(verbosity=2).run(tests)
 
 
+@app.cli.command()
+def build_indexes():
+    """Build local indexes (classroom occupancy, etc.)."""
+    from everyclass.server import cron_build_indexes
+    cron_build_indexes()
+
+
+@app.cli.command()
+def gc_calendar_files():
+    """Remove generated calendar files of reset or long-unused tokens."""
+    from everyclass.server import cron_gc_calendar_files
+    cron_gc_calendar_files()
+
+
+@app.cli.command()
+@click.option('--days', type=int, default=None, help='Only tokens used within this many days.')
+@click.option('--processes', type=int, default=None, help='Worker processes, defaults to the number of CPUs.')
+@click.option('--rate', type=float, default=None, help='Max requests per second sent to the api-server.')
+def pregenerate_calendars(days, processes, rate):
+    """Pre-generate ICS feeds of recently active calendar tokens."""
+    from everyclass.server import cron_update_remote_manifest
+    from everyclass.server.calendar.pregenerate import pregenerate
+    from everyclass.server.db.postgres import init_pool
+
+    cron_update_remote_manifest()  # 获取最新的数据版本并写入 Redis，web worker 和预生成都使用这个共享的版本计算 ETag
+    if not hasattr(app, 'postgres'):
+        init_pool(app)
+    print(pregenerate(app, days or app.config['ICS_PREGENERATE_DAYS'], processes, rate))
+
+
+@app.cli.command()
+@click.option('--batch-size', type=int, default=None, help='Rows written per batch (and per transaction).')
+@click.option('--parallel', type=int, default=None, help='Number of tables migrated concurrently.')
+@click.option('--reset', is_flag=True, help='Discard checkpoints and start over (existing rows are skipped).')
+def migrate_from_mongo(batch_size, parallel, reset):
+    """Bulk-migrate MongoDB collections into Postgres, resuming from checkpoints."""
+    import inspect
+    from everyclass.server.db import dao, migration
+    from everyclass.server.db.postgres import init_pool
+
+    if not hasattr(app, 'postgres'):
+        init_pool(app)
+    classes = [cls for _, cls in inspect.getmembers(dao, inspect.isclass)
+               if issubclass(cls, dao.PostgresBase) and cls.migration]
+    migrations = [cls.migration for cls in classes]
+    migration.init_checkpoints()
+    if reset:
+        for each in migrations:
+            migration.reset_checkpoint(each.name)
+    for stats in migration.run_all(migrations,
+                                   batch_size=batch_size or app.config['MIGRATION_BATCH_SIZE'],
+                                   parallel=parallel or app.config['MIGRATION_PARALLELISM']):
+        print(stats)
+    for cls in classes:
+        cls.after_migration()
+
+
+@app.cli.command()
+@click.option('--days', type=int, default=7)
+def calendar_poll_stats(days):
+    """Print daily calendar polling volume."""
+    import datetime
+    from everyclass.server.db.dao import Redis
+
+    today = datetime.date.today()
+    for i in range(days):
+        day = today - datetime.timedelta(days=i)
+        print(day, Redis.get_calendar_poll_stats(day))
+
+
 if __name__ == '__main__':
     print("You should not run this file. Instead, run `uwsgi --ini deploy/uwsgi-local.ini` for consistent behaviour.")
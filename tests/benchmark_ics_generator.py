@@ -0,0 +1,158 @@
+"""
+ics 生成性能对比：流式写入 vs. 原先基于 icalendar 对象树的实现
+
+用法：python -m tests.benchmark_ics_generator
+"""
+import datetime
+import hashlib
+import time
+import tracemalloc
+from typing import Tuple
+
+import pytz
+from icalendar import Alarm, Calendar, Event, Timezone, TimezoneStandard
+
+from everyclass.server.calendar import ics_generator
+from everyclass.server.config import get_config
+from everyclass.server.models import Semester
+from everyclass.server.rpc.api_server import CardItem, TeacherItem, TimetableGrid, teacher_list_to_name_str
+from everyclass.server.utils import get_time
+
+# 以下是改为流式写入之前 ics_generator 的实现（原样复制，只改了名字），作为对比的基准。
+# 不调用新模块中的任何函数，新模块的改动不会影响基准的结果
+
+_legacy_tzc = Timezone()
+_legacy_tzc.add('tzid', 'Asia/Shanghai')
+_legacy_tzc.add('x-lic-location', 'Asia/Shanghai')
+_legacy_tzs = TimezoneStandard()
+_legacy_tzs.add('tzname', 'CST')
+_legacy_tzs.add('dtstart', datetime.datetime(1970, 1, 1, 0, 0, 0))
+_legacy_tzs.add('TZOFFSETFROM', datetime.timedelta(hours=8))
+_legacy_tzs.add('TZOFFSETTO', datetime.timedelta(hours=8))
+_legacy_tzc.add_component(_legacy_tzs)
+
+
+def legacy_generate(name: str, cards: TimetableGrid, semester: Semester, last_modified: datetime.datetime) -> bytes:
+    """原先的实现：为每次上课构建 Event、Alarm 对象，最后整体序列化"""
+    semester_string = semester.to_str(simplify=True)
+    semester = semester.to_tuple()
+
+    cal = Calendar()
+    cal.add('prodid', '-//Admirable//EveryClass//EN')
+    cal.add('version', '2.0')
+    cal.add('calscale', 'GREGORIAN')
+    cal.add('method', 'PUBLISH')
+    cal.add('X-WR-CALNAME', name + '的' + semester_string + '课表')
+    cal.add('X-WR-TIMEZONE', 'Asia/Shanghai')
+    cal.add_component(_legacy_tzc)
+
+    for (day, time_), cards_in_slot in cards.items():
+        for card in cards_in_slot:
+            teacher = teacher_list_to_name_str(card.teachers)
+            for week in card.weeks:
+                dtstart = _legacy_get_datetime(week, day, get_time(time_)[0], semester)
+                dtend = _legacy_get_datetime(week, day, get_time(time_)[1], semester)
+
+                if dtstart.year == 1984:
+                    continue
+
+                cal.add_component(_legacy_build_event(card_name=card.name,
+                                                      times=(dtstart, dtend),
+                                                      classroom=card.room,
+                                                      teacher=teacher,
+                                                      week_string=card.week_string,
+                                                      current_week=week,
+                                                      cid=card.card_id_encoded,
+                                                      last_modified=last_modified))
+
+    return cal.to_ical()
+
+
+def _legacy_get_datetime(week: int, day: int, time_: Tuple[int, int],
+                         semester: Tuple[int, int, int]) -> datetime.datetime:
+    config = get_config()
+    tz = pytz.timezone("Asia/Shanghai")
+    dt = datetime.datetime(*(config.AVAILABLE_SEMESTERS[semester]['start'] + time_), tzinfo=tz)  # noqa: T484
+    dt += datetime.timedelta(days=(week - 1) * 7 + (day - 1))  # 调整到当前周
+
+    if 'adjustments' in config.AVAILABLE_SEMESTERS[semester]:
+        ymd = (dt.year, dt.month, dt.day)
+        adjustments = config.AVAILABLE_SEMESTERS[semester]['adjustments']
+        if ymd in adjustments:
+            if adjustments[ymd]['to']:
+                # 调课
+                dt = dt.replace(year=adjustments[ymd]['to'][0],
+                                month=adjustments[ymd]['to'][1],
+                                day=adjustments[ymd]['to'][2])
+            else:
+                # 冲掉的课年份设置为1984，返回之后被抹去
+                dt = dt.replace(year=1984)
+
+    return dt
+
+
+def _legacy_build_event(card_name: str, times: Tuple[datetime.datetime, datetime.datetime], classroom: str,
+                        teacher: str, current_week: int, week_string: str, cid: str,
+                        last_modified: datetime.datetime) -> Event:
+    event = Event()
+    event.add('transp', 'TRANSPARENT')
+    summary = card_name
+    if classroom != 'None':
+        summary = card_name + '@' + classroom
+        event.add('location', classroom)
+
+    description = week_string
+    if teacher != 'None':
+        description += '\n教师：' + teacher
+    description += '\n由 EveryClass 每课 (https://everyclass.xyz) 导入'
+
+    event.add('summary', summary)
+    event.add('description', description)
+    event.add('dtstart', times[0])
+    event.add('dtend', times[1])
+    event.add('last-modified', last_modified)
+
+    # 使用"cid-当前周"作为事件的超码
+    event_sk = cid + '-' + str(current_week)
+    event['uid'] = hashlib.md5(event_sk.encode('utf-8')).hexdigest() + '@everyclass.xyz'
+    alarm = Alarm()
+    alarm.add('action', 'none')
+    alarm.add('trigger', datetime.datetime(1980, 1, 1, 3, 5, 0))
+    event.add_component(alarm)
+    return event
+
+
+def busy_teacher_grid() -> TimetableGrid:
+    """一个排满了课的老师：每个时间格 3 门课，每门课 18 周"""
+    teacher = TeacherItem(teacher_id="0201130", teacher_id_encoded="", name="张四", title="讲师")
+    cards = []
+    for day in range(1, 8):
+        for time_ in range(1, 7):
+            lesson = '{}{:02d}{:02d}'.format(day, time_ * 2 - 1, time_ * 2)
+            for i in range(3):
+                cid = '{}-{}'.format(lesson, i)
+                cards.append(CardItem(name="软件工程基础（{}）".format(i), card_id=cid, card_id_encoded=cid,
+                                      room="世B10{}".format(i), room_id=cid, room_id_encoded="",
+                                      weeks=list(range(1, 19)), week_string="1-18/周", lesson=lesson,
+                                      teachers=[teacher], course_id=cid))
+    return TimetableGrid.make(cards)
+
+
+def measure(func, rounds: int = 5):
+    args = ("张四", busy_teacher_grid(), Semester("2018-2019-1"), datetime.datetime(2018, 9, 7))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(*args)
+    elapsed = (time.perf_counter() - start) / rounds
+
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    for label, func in (('icalendar', legacy_generate), ('streaming', ics_generator.generate)):
+        elapsed, peak = measure(func)
+        print('{:<10} {:8.1f} ms/call  peak {:8.1f} KiB'.format(label, elapsed * 1000, peak / 1024))
@@ -0,0 +1,50 @@
+"""
+高频 DAO 查询性能对比：服务端预备语句 vs. 每次 cursor.execute(sql, params)
+
+需要可以连接的 Postgres（使用配置中的 POSTGRES_CONNECTION），只执行只读查询。
+
+用法：python -m tests.benchmark_prepared_statements [次数]
+"""
+import sys
+import time
+import uuid
+
+import psycopg2
+from psycopg2.extras import register_uuid
+
+from everyclass.server.config import get_config
+from everyclass.server.db import dao
+
+
+def bench(conn, label: str, run, n: int) -> float:
+    with conn.cursor() as cursor:
+        run(cursor)  # 预热，包括 PREPARE
+        conn.rollback()
+        start = time.perf_counter()
+        for _ in range(n):
+            run(cursor)
+            if cursor.description:
+                cursor.fetchall()
+            conn.rollback()
+        elapsed = time.perf_counter() - start
+    print("{:<40}{:>10.1f} us/query".format(label, elapsed / n * 1e6))
+    return elapsed
+
+
+def main(n: int) -> None:
+    config = get_config()
+    conn = psycopg2.connect(**config.POSTGRES_CONNECTION, options=f'-c search_path={config.POSTGRES_SCHEMA}')
+    register_uuid()
+
+    cases = [(dao._STMT_PRIVACY_LEVEL, ("3901160101",)),
+             (dao._STMT_CALENDAR_TOKEN, (uuid.uuid4(),)),
+             (dao._STMT_USER_EXIST, ("3901160101",))]
+    for stmt, params in cases:
+        plain = bench(conn, stmt.name + " (execute)", lambda cursor: cursor.execute(stmt.sql, params), n)
+        prepared = bench(conn, stmt.name + " (prepared)", lambda cursor: stmt.execute(conn, cursor, params), n)
+        print("{:<40}{:>10.2f}x\n".format("speedup", plain / prepared))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
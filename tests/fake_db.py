@@ -0,0 +1,78 @@
+"""测试用的 Postgres 连接替身"""
+from contextlib import contextmanager
+from unittest import mock
+
+import psycopg2
+
+
+class InvalidStatementName(psycopg2.Error):
+    pgcode = '26000'
+
+
+class FakeDatabase:
+    """
+    替换模块中的 `pg_conn_context`，每次取出一个新的 FakeConnection
+
+    :param respond: respond(sql, params) 返回这次查询结果的行列表，为 None 时所有查询都没有结果
+    """
+
+    def __init__(self, respond=None):
+        self.respond = respond
+        self.queries = []  # 执行过的 (sql, params)
+        self.commits = 0
+
+    @contextmanager
+    def conn_context(self):
+        yield FakeConnection(self)
+
+    def patch(self, module):
+        return mock.patch.object(module, 'pg_conn_context', self.conn_context)
+
+
+class FakeConnection:
+    def __init__(self, db: FakeDatabase = None):
+        self.db = db
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(db=self.db)
+
+    def commit(self):
+        if self.db:
+            self.db.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeCursor:
+    def __init__(self, fail_on=None, db: FakeDatabase = None):
+        self.executed = []  # 执行过的语句的第一个词
+        self.fail_on = fail_on
+        self.db = db
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql.split()[0])
+        if self.fail_on and sql.startswith(self.fail_on):
+            self.fail_on = None
+            raise InvalidStatementName()
+        if self.db:
+            self.db.queries.append((sql, params))
+            self.result = self.db.respond(sql, params) if self.db.respond else []
+
+    @property
+    def rowcount(self):
+        return len(self.result)
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
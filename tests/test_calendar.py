@@ -0,0 +1,257 @@
+import datetime
+import os
+import unittest
+
+GOLDEN_ICS = os.path.join(os.path.dirname(__file__), 'data', 'golden.ics')
+
+
+def _grid():
+    from everyclass.server.rpc.api_server import CardItem, TeacherItem, TimetableGrid
+    teacher = TeacherItem(teacher_id="0201130", teacher_id_encoded="", name="张四", title="讲师")
+    cards = [CardItem(name="软件工程基础", card_id="1", card_id_encoded="c1", room="世B101", room_id="1",
+                      room_id_encoded="", weeks=[1, 2, 3, 5, 18], week_string="1-3, 5, 18/周", lesson="10102",
+                      teachers=[teacher], course_id="1"),
+             CardItem(name="线性代数", card_id="2", card_id_encoded="c2", room="None", room_id="2",
+                      room_id_encoded="", weeks=[2, 4, 6], week_string="2-6/双周", lesson="30506",
+                      teachers=[], course_id="2")]
+    return TimetableGrid.make(cards)
+
+
+class ICSGeneratorTest(unittest.TestCase):
+    """everyclass/server/calendar"""
+
+    def test_deterministic_output(self):
+        from everyclass.server.calendar import ics_generator
+        from everyclass.server.calendar.cache import gzip_compress
+        from everyclass.server.models import Semester
+
+        semester = Semester("2018-2019-1")
+        last_modified = datetime.datetime(2018, 9, 7)
+        first = ics_generator.generate("张三", _grid(), semester, last_modified)
+        second = ics_generator.generate("张三", _grid(), semester, last_modified)
+        self.assertTrue(first == second)
+        self.assertTrue(first.count(b'BEGIN:VEVENT') == 8)
+        self.assertTrue(first.count(b'BEGIN:STANDARD') == 1)
+        self.assertTrue(gzip_compress(first) == gzip_compress(second))
+
+    def test_golden_file(self):
+        """与旧版基于 icalendar 对象树的实现生成的文件比较，展开折行后内容应完全一致"""
+        from everyclass.server.calendar import ics_generator
+        from everyclass.server.models import Semester
+
+        output = ics_generator.generate("张三", _grid(), Semester("2018-2019-1"), datetime.datetime(2018, 9, 7))
+        with open(GOLDEN_ICS, 'rb') as f:
+            golden = f.read()
+        self.assertTrue(output.replace(b'\r\n ', b'') == golden.replace(b'\r\n ', b''))
+        self.assertTrue(all(len(line) <= 75 for line in output.split(b'\r\n')))
+
+    def test_escape_text(self):
+        from everyclass.server.calendar.ics_generator import escape_text
+
+        self.assertTrue(escape_text('a,b;c\\d\ne') == 'a\\,b\\;c\\\\d\\ne')
+        self.assertTrue(escape_text('第一行\r\n第二行\r第三行') == '第一行\\n第二行\\n第三行')
+
+    def test_fold_line(self):
+        from everyclass.server.calendar.ics_generator import fold_line
+
+        folded = fold_line('DESCRIPTION:' + '课' * 40)
+        lines = folded.split(b'\r\n')
+        self.assertTrue(all(len(line) <= 75 for line in lines))
+        self.assertTrue(all(line.startswith(b' ') for line in lines[1:-1]))
+        self.assertTrue(b''.join(line[1:] if i else line for i, line in enumerate(lines)).decode('utf-8') ==
+                        'DESCRIPTION:' + '课' * 40)
+
+    def test_refresh_interval(self):
+        from everyclass.server.calendar import ics_generator
+        from everyclass.server.models import Semester
+
+        output = ics_generator.generate("张三", _grid(), Semester("2018-2019-1"), datetime.datetime(2018, 9, 7),
+                                        refresh_interval=6 * 3600)
+        self.assertTrue(b'REFRESH-INTERVAL;VALUE=DURATION:PT360M\r\nX-PUBLISHED-TTL:PT360M\r\n' in output)
+
+    def test_week_runs(self):
+        from everyclass.server.calendar.ics_generator import week_runs
+
+        self.assertTrue(week_runs([1, 2, 3, 5, 18]) == [(1, 1, 3), (5, 1, 1), (18, 1, 1)])
+        self.assertTrue(week_runs([2, 4, 6, 7]) == [(2, 2, 3), (7, 1, 1)])
+        self.assertTrue(week_runs([1, 5, 9]) == [(1, 1, 1), (5, 1, 1), (9, 1, 1)])
+        self.assertTrue(week_runs([]) == [])
+
+    def test_compact_output(self):
+        """紧凑模式使用 RRULE，调课的日期用 EXDATE + RDATE 表示，UID 与逐周模式下第一周的事件相同"""
+        from everyclass.server.calendar import ics_generator
+        from everyclass.server.models import Semester
+
+        semester = Semester("2018-2019-1")
+        last_modified = datetime.datetime(2018, 9, 7)
+        full = ics_generator.generate("张三", _grid(), semester, last_modified)
+        compact = ics_generator.generate("张三", _grid(), semester, last_modified, compact=True)
+
+        self.assertTrue(compact.count(b'BEGIN:VEVENT') == 4)
+        self.assertTrue(b'RRULE:FREQ=WEEKLY;INTERVAL=1;COUNT=3\r\n' in compact)
+        self.assertTrue(b'RRULE:FREQ=WEEKLY;INTERVAL=2;COUNT=3\r\n' in compact)
+        self.assertTrue(b'DTSTART;TZID=Asia/Shanghai:20181229T080000\r\n' in compact)  # 第18周周一调到周六
+
+        def uids(ics):
+            return {line for line in ics.split(b'\r\n') if line.startswith(b'UID:')}
+
+        self.assertTrue(uids(compact) <= uids(full))
+
+    def test_recurrence_adjustments(self):
+        from everyclass.server.calendar.ics_generator import _build_recurrence
+
+        dtstart, lines = _build_recurrence(16, 1, 3, 1, (8, 0), (2018, 2019, 1))
+        self.assertTrue(dtstart == datetime.datetime(2018, 12, 17, 8, 0))
+        self.assertTrue(lines == [b'RRULE:FREQ=WEEKLY;INTERVAL=1;COUNT=3\r\n',
+                                  b'EXDATE;TZID=Asia/Shanghai:20181231T080000\r\n',
+                                  b'RDATE;TZID=Asia/Shanghai:20181229T080000\r\n'])
+
+
+class LocalDiskStorageTest(unittest.TestCase):
+    """everyclass/server/calendar/storage.py"""
+
+    def test_put_get_delete(self):
+        import tempfile
+        from everyclass.server.calendar.storage import LocalDiskStorage
+
+        with tempfile.TemporaryDirectory() as tmp:
+            version = ["v1"]
+            storage = LocalDiskStorage(tmp, lambda: version[0])
+            storage.put("t1", "compact", b"compact")
+            storage.put("t1", "full", b"full")
+            # 同一数据版本下的不同格式同时有效
+            self.assertTrue(storage.get("t1", "compact") == b"compact")
+            self.assertTrue(storage.get("t1", "full") == b"full")
+
+            version[0] = "v2"
+            storage.put("t1", "new", b"new")
+            self.assertTrue(len(os.listdir(tmp)) == 1)  # 旧数据版本的文件被删除
+            self.assertTrue(storage.get("t1", "new") == b"new")
+            self.assertTrue(not [f for f in os.listdir(tmp) if f.endswith('.tmp')])
+
+            storage.delete("t1")
+            self.assertTrue(storage.get("t1", "new") is None)
+
+    def test_gc(self):
+        import tempfile
+        import time
+        from everyclass.server.calendar.storage import LocalDiskStorage
+
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = LocalDiskStorage(tmp)
+            for token in ("active", "reset", "old", "big"):
+                storage.put(token, "e", b"x" * 10)
+            now = time.time()
+            os.utime(storage._path("old", "e"), (now - 100, now - 100))
+            os.utime(storage._path("big", "e"), (now - 10, now - 10))
+            with open(os.path.join(tmp, "legacy.ics"), "w") as f:
+                f.write("BEGIN:VCALENDAR")
+            os.utime(os.path.join(tmp, "legacy.ics"), (now - 7200, now - 7200))
+
+            with open(os.path.join(tmp, "active.e.ics.gz"), "w") as f:  # 旧格式的文件名
+                f.write("x")
+
+            removed = storage.gc(lambda tokens: tokens - {"reset"}, max_age=50, max_bytes=15)
+            # reset 已被重置，old 过期，legacy.ics 和 active.e.ics.gz 是旧版本的文件，big 超出总大小
+            self.assertTrue(removed == 5)
+            self.assertTrue(os.listdir(tmp) == [os.path.basename(storage._path("active", "e"))])
+
+    def test_file_response(self):
+        import tempfile
+        from flask import Flask
+        from everyclass.server.calendar.storage import LocalDiskStorage, file_response
+
+        app = Flask(__name__)
+        app.config['ICS_ACCEL_REDIRECT_PREFIX'] = '/_calendar_files/'
+        with tempfile.TemporaryDirectory() as tmp, app.test_request_context():
+            storage = LocalDiskStorage(tmp)
+            self.assertTrue(storage.file_path("t1", "e1") is None)
+            storage.put("t1", "e1", b"body")
+            path = storage.file_path("t1", "e1")
+
+            response = file_response(path, 'x-accel')
+            self.assertTrue(response.headers['X-Accel-Redirect'] == '/_calendar_files/' + os.path.basename(path))
+            self.assertTrue(os.path.basename(path).startswith('t1.') and path.endswith('.e1.ics.gz'))
+            self.assertTrue(file_response(path, 'x-sendfile').headers['X-Sendfile'] == path)
+
+            response = file_response(path, 'sendfile')
+            self.assertTrue(response.content_length == 4)
+            self.assertTrue(b''.join(response.response) == b'body')
+            response.close()
+
+
+class CacheHeadersTest(unittest.TestCase):
+    """everyclass/server/calendar/cache.py"""
+
+    def test_cache_max_age(self):
+        from flask import Flask
+        from everyclass.server.calendar.cache import cache_max_age, client_refresh_interval, client_type
+        from everyclass.server.config import get_config
+
+        app = Flask(__name__)
+        app.config.from_object(get_config())
+        app.config['DATA_REFRESH_TIME'] = (0, 30)
+        with app.app_context():
+            self.assertTrue(client_type('Google-Calendar-Importer') == 'google')
+            self.assertTrue(client_type('iOS/12.1 (16B92) dataaccessd/1.0') == 'ios')
+            self.assertTrue(client_type('curl/7.58.0') == 'default')
+            self.assertTrue(client_refresh_interval('unknown') == app.config['ICS_REFRESH_INTERVALS']['default'])
+
+            self.assertTrue(cache_max_age(6 * 3600, datetime.datetime(2018, 9, 7, 12, 0)) == 6 * 3600)
+            self.assertTrue(cache_max_age(6 * 3600, datetime.datetime(2018, 9, 7, 23, 0)) == 90 * 60)
+            self.assertTrue(cache_max_age(6 * 3600, datetime.datetime(2018, 9, 7, 0, 10)) == 20 * 60)
+
+    def test_shared_data_version(self):
+        from unittest import mock
+        from flask import Flask
+        from everyclass.server.calendar.cache import data_version, make_etag
+        from everyclass.server.config import get_config
+
+        app = Flask(__name__)
+        app.config.from_object(get_config())
+        app.config['DATA_LAST_UPDATE_TIME'] = 'local'
+        with app.app_context(), mock.patch('everyclass.server.db.dao.Redis.get_data_version') as get_version:
+            # 以 Redis 中共享的版本为准，与本进程的配置无关
+            get_version.return_value = '2018-09-08'
+            self.assertTrue(data_version(fresh=True) == '2018-09-08')
+            etag = make_etag('token')
+
+            get_version.return_value = '2018-09-09'
+            self.assertTrue(data_version() == '2018-09-08')  # 进程内短暂缓存
+            self.assertTrue(data_version(fresh=True) == '2018-09-09')
+            self.assertTrue(make_etag('token') != etag)
+
+            get_version.return_value = None
+            self.assertTrue(data_version(fresh=True) == 'local')
+
+    def test_etag_per_content_coding(self):
+        """gzip 和未压缩的响应使用不同的强校验值"""
+        import gzip
+        from unittest import mock
+        from flask import Flask
+        from everyclass.server.calendar.views import _serve_ics
+        from everyclass.server.config import get_config
+
+        app = Flask(__name__)
+        app.config.from_object(get_config())
+        app.config['ICS_DELIVERY'] = 'python'
+        storage = mock.Mock()
+        storage.get.return_value = gzip.compress(b'BEGIN:VCALENDAR')
+        with mock.patch('everyclass.server.calendar.cache.make_etag', return_value='abc'), \
+                mock.patch('everyclass.server.calendar.storage.get_storage', return_value=storage), \
+                mock.patch('everyclass.server.db.dao.CalendarToken.update_last_used_time'), \
+                mock.patch('everyclass.server.db.dao.Redis.incr_calendar_poll_count'):
+            with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+                response = _serve_ics('token', {})
+                self.assertTrue(response.get_etag() == ('abc-gzip', False))
+                self.assertTrue(response.headers['Content-Encoding'] == 'gzip')
+
+            with app.test_request_context():
+                response = _serve_ics('token', {})
+                self.assertTrue(response.get_etag() == ('abc', False))
+                self.assertTrue(response.get_data() == b'BEGIN:VCALENDAR')
+
+            with app.test_request_context(headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"abc-gzip"'}):
+                self.assertTrue(_serve_ics('token', {}).status_code == 304)
+            with app.test_request_context(headers={'If-None-Match': '"abc-gzip"'}):
+                self.assertTrue(_serve_ics('token', {}).status_code == 200)  # 另一种编码的校验值不匹配
@@ -0,0 +1,29 @@
+import os
+import tempfile
+import unittest
+
+
+class OccupancyIndexTest(unittest.TestCase):
+    """everyclass/server/classroom/occupancy.py"""
+
+    def test_free_rooms(self):
+        from everyclass.server.classroom.occupancy import OccupancyIndex, write_index
+        from everyclass.server.utils import SLOTS_PER_WEEK, slot_index
+
+        rooms = [{"room_id": str(i), "name": "A10{}".format(i), "campus": "本部", "building": "A座"} for i in range(3)]
+        rooms.append({"room_id": "9", "name": "B101", "campus": "南校区", "building": "B座"})
+        rows = [0] * (2 * SLOTS_PER_WEEK)
+        rows[slot_index(1, 1, 1)] = 0b0011  # A100、A101 第一周周一第1-2节有课
+        rows[slot_index(1, 1, 2)] = 0b0100  # A102 第一周周一第3-4节有课
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.idx')
+            write_index(path, "2018-2019-1", rooms, rows)
+            index = OccupancyIndex(path)
+
+            self.assertTrue(index.weeks == 2)
+            self.assertTrue([r['name'] for r in index.free_rooms(1, 1, [1])] == ["A102", "B101"])
+            self.assertTrue([r['name'] for r in index.free_rooms(1, 1, [1, 2])] == ["B101"])
+            self.assertTrue([r['name'] for r in index.free_rooms(1, 1, [1], building="A座")] == ["A102"])
+            self.assertTrue(len(index.free_rooms(2, 1, [1])) == 4)
+            self.assertTrue(len(index.free_rooms(10, 1, [1])) == 4)  # 超出索引范围的周没有课
@@ -0,0 +1,274 @@
+import unittest
+
+import psycopg2
+
+from tests.fake_db import FakeConnection, FakeCursor, FakeDatabase
+
+
+class PreparedStatementTest(unittest.TestCase):
+    """everyclass/server/db/dao.py PreparedStatement"""
+
+    def test_prepare_once_per_connection(self):
+        from everyclass.server.db.dao import PreparedStatement
+
+        stmt = PreparedStatement("test_prepare_once", "SELECT a FROM t WHERE b=%s AND c=%s")
+        self.assertTrue(stmt.prepare_sql == "PREPARE test_prepare_once AS SELECT a FROM t WHERE b=$1 AND c=$2")
+        self.assertTrue(stmt.execute_sql == "EXECUTE test_prepare_once(%s,%s)")
+
+        conn, cursor = FakeConnection(), FakeCursor()
+        stmt.execute(conn, cursor, (1, 2))
+        stmt.execute(conn, cursor, (1, 2))
+        self.assertTrue(cursor.executed == ['PREPARE', 'EXECUTE', 'EXECUTE'])
+
+        other_cursor = FakeCursor()
+        stmt.execute(FakeConnection(), other_cursor, (1, 2))
+        self.assertTrue(other_cursor.executed == ['PREPARE', 'EXECUTE'])
+
+    def test_fallback(self):
+        from everyclass.server.db.dao import PreparedStatement
+
+        stmt = PreparedStatement("test_fallback", "SELECT a FROM t WHERE b=%s")
+        conn, cursor = FakeConnection(), FakeCursor()
+        stmt.execute(conn, cursor, (1,))
+
+        # 后端连接换了（例如经过 PgBouncer），语句不存在：回滚后普通执行，下次重新 PREPARE
+        cursor.fail_on = 'EXECUTE'
+        stmt.execute(conn, cursor, (1,))
+        self.assertTrue(conn.rollbacks == 1)
+        self.assertTrue(cursor.executed == ['PREPARE', 'EXECUTE', 'EXECUTE', 'SELECT'])
+        stmt.execute(conn, cursor, (1,))
+        self.assertTrue(cursor.executed[-2:] == ['PREPARE', 'EXECUTE'])
+        PreparedStatement._failures = 0
+
+
+class PrivacySettingsCacheTest(unittest.TestCase):
+    """everyclass/server/db/dao.py PrivacySettings 的进程内缓存"""
+
+    def setUp(self):
+        from unittest import mock
+        from everyclass.server.db import dao
+
+        self.levels = {"3901160101": 1}
+        self.queries = []
+        levels, queries = self.levels, self.queries
+
+        def respond(sql, params):
+            queries.append(params[0])
+            if isinstance(params[0], list):
+                return [(student_id, levels[student_id]) for student_id in params[0] if student_id in levels]
+            return [(levels[params[0]],)] if params[0] in levels else []
+
+        patches = [FakeDatabase(respond).patch(dao),
+                   mock.patch.object(dao.PreparedStatement, '_failures', dao.PreparedStatement._MAX_FAILURES),
+                   mock.patch.object(dao.PrivacySettings, '_listening', True)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(dao.PrivacySettings.invalidate)
+        dao.PrivacySettings.invalidate()
+
+    def test_cache_and_invalidate(self):
+        from everyclass.server.db.dao import PrivacySettings, get_config
+
+        self.assertTrue(PrivacySettings.get_level("3901160101") == 1)
+        self.assertTrue(PrivacySettings.get_level("3901160101") == 1)
+        self.assertTrue(len(self.queries) == 1)
+
+        # 未设置隐私级别的情况也缓存
+        default = get_config().DEFAULT_PRIVACY_LEVEL
+        self.assertTrue(PrivacySettings.get_level("3901160102") == default)
+        self.assertTrue(PrivacySettings.get_level("3901160102") == default)
+        self.assertTrue(len(self.queries) == 2)
+
+        self.levels["3901160101"] = 2
+        PrivacySettings.invalidate("3901160101")  # 收到变化通知
+        self.assertTrue(PrivacySettings.get_level("3901160101") == 2)
+        self.assertTrue(len(self.queries) == 3)
+
+    def test_get_levels(self):
+        from everyclass.server.db.dao import PrivacySettings, get_config
+
+        default = get_config().DEFAULT_PRIVACY_LEVEL
+        self.levels["3901160103"] = 2
+        PrivacySettings.get_level("3901160101")
+
+        levels = PrivacySettings.get_levels(["3901160101", "3901160102", "3901160103", "3901160102"])
+        self.assertTrue(levels == {"3901160101": 1, "3901160102": default, "3901160103": 2})
+        self.assertTrue(len(self.queries) == 2)  # 一次 get_level，一次批量查询（只查询未缓存的）
+        self.assertTrue(sorted(self.queries[1]) == ["3901160102", "3901160103"])
+
+        PrivacySettings.get_levels(["3901160101", "3901160102", "3901160103"])
+        self.assertTrue(len(self.queries) == 2)
+
+
+class UserIdSequenceTest(unittest.TestCase):
+    """everyclass/server/db/dao.py UserIdSequence 的 hi/lo 分配"""
+
+    def test_block_allocation(self):
+        from unittest import mock
+        from everyclass.server.db import dao
+
+        sequence = {"value": 10000000 - 100}
+
+        def respond(sql, params):
+            if 'nextval' in sql:
+                sequence["value"] += 100
+                return [(sequence["value"],)]
+            return [(100,)]
+
+        db = FakeDatabase(respond)
+        with db.patch(dao), \
+                mock.patch.object(dao.UserIdSequence, '_pid', None), \
+                mock.patch.object(dao.UserIdSequence, '_increment', None):
+            ids = [dao.UserIdSequence.new() for _ in range(250)]
+
+        self.assertTrue(ids == list(range(10000001, 10000100)) + list(range(10000101, 10000200)) +
+                        list(range(10000201, 10000253)))
+        self.assertTrue(len([sql for sql, _ in db.queries if 'nextval' in sql]) == 3)
+
+
+class CalendarTokenTest(unittest.TestCase):
+    """everyclass/server/db/dao.py CalendarToken"""
+
+    def test_get_or_set_single_statement(self):
+        import uuid
+        from everyclass.server.db import dao
+
+        existing = uuid.uuid4()
+        results = [[(existing,)]]
+        db = FakeDatabase(lambda sql, params: results.pop(0))
+        with db.patch(dao):
+            self.assertTrue(dao.CalendarToken.get_or_set_calendar_token("student", "3901160101",
+                                                                        "2018-2019-1") == str(existing))
+            self.assertTrue(len(db.queries) == 1)  # 插入和查询已有的令牌在同一条语句中
+            self.assertTrue("ON CONFLICT" in db.queries[0][0] and "UNION ALL" in db.queries[0][0])
+
+            # 并发创建的令牌不在语句的快照中时没有返回行，再执行一次
+            results.extend([[], [(existing,)]])
+            self.assertTrue(dao.CalendarToken.get_or_set_calendar_token("student", "3901160101",
+                                                                        "2018-2019-1") == str(existing))
+            self.assertTrue(len(db.queries) == 3)
+
+
+class RedisICSTest(unittest.TestCase):
+    """everyclass/server/db/dao.py Redis 中缓存的 ics 文件"""
+
+    def test_delete_uses_token_key_set(self):
+        from unittest import mock
+        from everyclass.server.db import dao
+
+        with mock.patch.object(dao, 'redis') as redis:
+            pipe = redis.pipeline.return_value
+            dao.Redis.set_ics("t1", "e1", b"body", 60)
+            pipe.sadd.assert_called_once_with("ec_sv:ics_keys:t1", "ec_sv:ics:t1:e1")
+            pipe.expire.assert_called_once_with("ec_sv:ics_keys:t1", 60)
+
+            redis.smembers.return_value = {b"ec_sv:ics:t1:e1"}
+            dao.Redis.delete_ics("t1")
+            redis.delete.assert_called_once_with("ec_sv:ics_keys:t1", b"ec_sv:ics:t1:e1")
+            self.assertFalse(redis.scan_iter.called)  # 不扫描整个键空间
+
+
+class VisitTrackTest(unittest.TestCase):
+    """everyclass/server/db/dao.py VisitTrack"""
+
+    def setUp(self):
+        from unittest import mock
+        from everyclass.server.db import dao
+
+        # 不启动真正的后台线程、不注册退出时的写入，测试中直接调用 flush，避免测试结束后它们仍在使用替换掉的连接
+        self.thread = mock.patch.object(dao.threading, 'Thread').start()
+        self.register = mock.patch.object(dao.atexit, 'register').start()
+        for patch in (mock.patch.object(dao.VisitTrack, '_flusher_pid', None),
+                      mock.patch.object(dao.VisitTrack, '_app', None),
+                      mock.patch.object(dao.VisitTrack, '_buffer', {})):
+            patch.start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_dedupe_and_flush(self):
+        from unittest import mock
+        from flask import Flask
+        from everyclass.server.db import dao
+        from everyclass.server.models import StudentSession
+
+        batches = []
+        visitor_1 = StudentSession(sid_orig="3901160101", sid="encoded", name="1")
+        visitor_2 = StudentSession(sid_orig="3901160102", sid="encoded", name="2")
+        with FakeDatabase().patch(dao), \
+                mock.patch.object(dao, 'execute_values', lambda cursor, sql, rows: batches.append(rows)), \
+                Flask(__name__).app_context():
+            dao.VisitTrack.flush()
+            dao.VisitTrack.update_track("3901160103", visitor_1)
+            self.thread.return_value.start.assert_called_once_with()
+            self.register.assert_called_once_with(dao.VisitTrack.flush)
+            dao.VisitTrack.update_track("3901160103", visitor_2)
+            dao.VisitTrack.update_track("3901160103", visitor_1)
+            self.assertTrue(dao.VisitTrack.buffer_stats()["buffered"] == 2)
+
+            self.assertTrue(dao.VisitTrack.flush() == 2)
+            self.assertTrue(len(batches) == 1)
+            self.assertTrue(sorted(row[:2] for row in batches[0]) == [("3901160103", "3901160101"),
+                                                                      ("3901160103", "3901160102")])
+            self.assertTrue(dao.VisitTrack.buffer_stats()["buffered"] == 0)
+            self.assertTrue(dao.VisitTrack.flush() == 0)
+
+    def test_flush_errors(self):
+        """暂时性的错误放回缓存重试，数据错误拆分批次后只丢弃出问题的记录"""
+        from unittest import mock
+        from flask import Flask
+        from everyclass.server.db import dao
+        from everyclass.server.exceptions import PoolTimeout
+        from everyclass.server.models import StudentSession
+
+        written = []
+
+        def write(rows):
+            if any(visitor == "3901160102" for _, visitor, _ in rows):
+                raise psycopg2.IntegrityError("duplicate key value violates unique constraint \"idx_host_time\"")
+            written.extend(rows)
+
+        with mock.patch.object(dao.VisitTrack, '_write', side_effect=PoolTimeout("no connection")), \
+                Flask(__name__).app_context():
+            dao.VisitTrack.flush()
+            for i in range(1, 5):
+                visitor = StudentSession(sid_orig="390116010{}".format(i), sid="encoded", name=str(i))
+                dao.VisitTrack.update_track("3901160199", visitor)
+            self.assertTrue(dao.VisitTrack.flush() == 0)
+            self.assertTrue(dao.VisitTrack.buffer_stats()["buffered"] == 4)
+
+        dropped = dao.VisitTrack.buffer_stats()["dropped"]
+        with mock.patch.object(dao.VisitTrack, '_write', side_effect=write):
+            self.assertTrue(dao.VisitTrack.flush() == 3)
+        self.assertTrue(sorted(row[1] for row in written) == ["3901160101", "3901160103", "3901160104"])
+        self.assertTrue(dao.VisitTrack.buffer_stats()["buffered"] == 0)
+        self.assertTrue(dao.VisitTrack.buffer_stats()["dropped"] == dropped + 1)
+
+    def test_get_visitors_keyset(self):
+        import datetime
+        from unittest import mock
+        from everyclass.server.db import dao
+
+        start = datetime.datetime(2019, 3, 1)
+        rows = [("39011601{:02}".format(i), start - datetime.timedelta(minutes=i)) for i in range(5)]
+
+        def respond(sql, params):
+            before = params[1] if len(params) == 3 else None
+            return [row for row in rows if before is None or row[1] < before][:params[-1]]
+
+        student = mock.Mock(student_id_encoded="encoded", semesters=["2018-2019-2"])
+        student.name = "name"
+        with FakeDatabase(respond).patch(dao), \
+                mock.patch('everyclass.server.rpc.api_server.APIServer.search') as search:
+            search.return_value.students = [student]
+
+            page, cursor = dao.VisitTrack.get_visitors("3901160199", limit=2)
+            self.assertTrue([v["visit_time"] for v in page] == [rows[0][1], rows[1][1]])
+            self.assertTrue(cursor == rows[1][1])
+
+            page, cursor = dao.VisitTrack.get_visitors("3901160199", limit=2, before=cursor)
+            self.assertTrue([v["visit_time"] for v in page] == [rows[2][1], rows[3][1]])
+
+            page, cursor = dao.VisitTrack.get_visitors("3901160199", limit=2, before=cursor)
+            self.assertTrue([v["visit_time"] for v in page] == [rows[4][1]])
+            self.assertTrue(cursor is None)
+            self.assertTrue(search.call_count == 5)  # 只为当前页的访客调用 api-server
@@ -0,0 +1,80 @@
+import unittest
+
+
+class FreeTimeTest(unittest.TestCase):
+    """everyclass/server/free_time/views.py"""
+
+    def test_compute_free_time(self):
+        from everyclass.server.free_time.views import compute_free_time
+        from everyclass.server.utils import SLOTS_PER_WEEK, slot_index
+
+        everyone_busy = (1 << slot_index(1, 1, 1))
+        one_busy = (1 << slot_index(1, 1, 2))
+        result = compute_free_time([everyone_busy | one_busy, everyone_busy, everyone_busy], min_free=2)
+
+        self.assertTrue(result["weeks"] == 1)
+        self.assertTrue(len(result["free"]) == SLOTS_PER_WEEK - 2)
+        self.assertTrue((1, 1, 1) not in result["free"])
+        self.assertTrue(result["mostly_free"] == [{"week": 1, "day": 1, "time": 2, "free": 2}])
+
+    def _app(self):
+        from flask import Flask
+        from everyclass.server.config import get_config
+        from everyclass.server.free_time.views import free_time_bp
+
+        app = Flask(__name__)
+        app.config.from_object(get_config())
+        app.config['MAINTENANCE'] = False
+        app.register_blueprint(free_time_bp)
+        return app
+
+    def test_view(self):
+        """隐私设置不允许查看的学生不参与计算，在 hidden 中列出；缓存键包含共享的数据版本"""
+        from unittest import mock
+        from everyclass.server.free_time import views
+        from everyclass.server.rpc.api_server import CardItem
+        from everyclass.server.utils.resource_identifier_encrypt import encrypt
+
+        app = self._app()
+        card = CardItem(name="软件工程基础", card_id="1", card_id_encoded="c1", room="世B101", room_id="1",
+                        room_id_encoded="", weeks=[1], week_string="1/周", lesson="10102", teachers=[],
+                        course_id="1")
+        with app.app_context():
+            visible, blocked = encrypt('student', '3901160101'), encrypt('student', '3901160102')
+
+        with mock.patch.object(views, 'get_blocked_level', side_effect=lambda sid: 2 if sid == '3901160102' else 0), \
+                mock.patch.object(views, 'data_version', return_value='2018-09-08') as version, \
+                mock.patch.object(views.Redis, 'get_free_time', return_value=None), \
+                mock.patch.object(views.Redis, 'set_free_time') as set_free_time, \
+                mock.patch.object(views.APIServer, 'get_student_timetable') as get_timetable:
+            get_timetable.return_value = mock.Mock(cards=[card])
+            get_timetable.return_value.name = "张三"
+            response = app.test_client().post('/freeTime', json={"ids": [visible, blocked], "semester": "2018-2019-1"})
+            key = set_free_time.call_args[0][0]
+
+            self.assertTrue(response.status_code == 200)
+            self.assertTrue(response.get_json()["hidden"] == [blocked])
+            self.assertTrue(response.get_json()["members"] == ["张三"])
+            get_timetable.assert_called_once_with('3901160101', '2018-2019-1')
+
+            version.return_value = '2018-09-09'  # 数据更新后使用新的缓存键
+            app.test_client().post('/freeTime', json={"ids": [visible, blocked], "semester": "2018-2019-1"})
+            self.assertTrue(set_free_time.call_args[0][0] != key)
+
+    def test_view_bad_request(self):
+        app = self._app()
+        client = app.test_client()
+        for body in ({"ids": [], "semester": "2018-2019-1"},
+                     {"ids": "abc", "semester": "2018-2019-1"},
+                     {"ids": [["nested"]], "semester": "2018-2019-1"},
+                     {"ids": [{"a": 1}], "semester": "2018-2019-1"},
+                     {"ids": ["abc"], "semester": "1999-2000-1"},
+                     {"ids": ["abc"]}):
+            self.assertTrue(client.post('/freeTime', json=body).status_code == 400)
+        self.assertTrue(client.post('/freeTime', data="not json").status_code == 400)
+        self.assertTrue(client.post('/freeTime', json={"ids": ["not-encrypted"],
+                                                       "semester": "2018-2019-1"}).status_code == 400)
+
+        too_many = {"ids": [str(i) for i in range(app.config['FREE_TIME_MAX_MEMBERS'] + 1)],
+                    "semester": "2018-2019-1"}
+        self.assertTrue(client.post('/freeTime', json=too_many).status_code == 400)
@@ -0,0 +1,126 @@
+import unittest
+from unittest import mock
+
+from tests.fake_db import FakeDatabase
+
+
+class BulkMigrationTest(unittest.TestCase):
+    """everyclass/server/db/migration.py"""
+
+    def test_batches_and_resume(self):
+        from everyclass.server.db import migration
+
+        docs = [{"_id": i, "sid_orig": str(i), "level": i % 3} for i in range(1, 12)]
+        checkpoints = {}
+        batches = []
+
+        def respond(sql, params):
+            if sql.startswith("SELECT"):
+                return [checkpoints[params[0]]] if params[0] in checkpoints else []
+            if "migration_checkpoints" in sql:
+                checkpoints[params[0]] = (params[1], params[2])
+            return []
+
+        class Collection:
+            def find(self, query):
+                after = query['_id']['$gt'] if query else 0
+                self.result = [doc for doc in docs if doc["_id"] > after]
+                return self
+
+            def sort(self, key, direction):
+                return self
+
+            def batch_size(self, size):
+                return iter(self.result)
+
+        mongo = mock.Mock()
+        mongo.get_collection.return_value = Collection()
+        m = migration.Migration(name="privacy_settings",
+                                collection="privacy_settings",
+                                table="privacy_settings",
+                                columns=("student_id", "level"),
+                                transform=lambda each: (each['sid_orig'], each['level']))
+
+        with FakeDatabase(respond).patch(migration), \
+                mock.patch.object(migration, 'get_mongodb', return_value=mongo), \
+                mock.patch.object(migration, 'execute_values',
+                                  lambda cursor, sql, rows, **kwargs: batches.append((sql, rows))):
+            stats = migration.run(m, batch_size=4)
+            self.assertTrue(stats["rows"] == 11)
+            self.assertTrue([len(rows) for _, rows in batches] == [4, 4, 3])
+            self.assertTrue("ON CONFLICT DO NOTHING" in batches[0][0])
+            self.assertTrue(checkpoints["privacy_settings"] == ("11", 11))
+
+            # 中断后重新执行从检查点继续
+            docs.append({"_id": 12, "sid_orig": "12", "level": 0})
+            stats = migration.run(m, batch_size=4)
+            self.assertTrue(stats["rows"] == 1 and stats["total_rows"] == 12)
+            self.assertTrue(batches[-1][1] == [("12", 0)])
+
+    def test_calendar_token_duplicates(self):
+        """MongoDB 中重复的令牌先写成自己的别名，不会被 (type, identifier, semester) 上的唯一索引挡掉"""
+        from everyclass.server.db import dao
+        from everyclass.server.db.dao import CalendarToken
+
+        m = CalendarToken.migration
+        row = m.transform({"type": "student", "identifier": "3901160407", "semester": "2018-2019-1",
+                           "token": "d4f3a9d6-3f5b-4c1e-9a55-0f0b3d8f3c11", "create_time": None})
+        self.assertTrue(dict(zip(m.columns, row))["alias_of"] == row[m.columns.index("token")])
+        self.assertTrue(m.on_conflict == "(token) DO NOTHING")
+
+        db = FakeDatabase()
+        with db.patch(dao), mock.patch.object(CalendarToken, '_resolve_aliases') as resolve_aliases:
+            CalendarToken.after_migration()
+            resolve_aliases.assert_called_once_with(mock.ANY, pending_only=True)  # 只处理迁移写入的令牌所在的组
+            self.assertTrue(db.commits == 1)
+
+    def test_run_once(self):
+        from everyclass.server.db import migration
+
+        checkpoints = {}
+
+        def respond(sql, params):
+            if sql.startswith("SELECT"):
+                return [checkpoints[params[0]]] if params[0] in checkpoints else []
+            if sql.startswith("INSERT"):
+                checkpoints[params[0]] = (params[1], params[2])
+            return []
+
+        db = FakeDatabase(respond)
+        step = mock.Mock()
+        with db.conn_context() as conn, conn.cursor() as cursor:
+            self.assertTrue(migration.run_once(cursor, "calendar_tokens_aliases", step))
+            self.assertFalse(migration.run_once(cursor, "calendar_tokens_aliases", step))
+        step.assert_called_once_with(cursor)
+
+    def test_init_postgres_twice(self):
+        """init_postgres 可以重复执行：第二次执行时表、索引、约束都已经存在"""
+        import re
+        import psycopg2.errors
+        from everyclass.server.db import dao, migration
+
+        executed = set()
+        checkpoints = {}
+
+        def respond(sql, params):
+            statement = ' '.join(sql.split())
+            # 创建具名对象的语句，已经存在时会失败
+            creates = re.match(r'(CREATE (UNIQUE )?(TABLE|INDEX|SEQUENCE|TYPE)|ALTER TABLE \S+ ADD) ', statement)
+            if creates and "IF NOT EXISTS" not in statement:
+                if statement in executed:
+                    raise psycopg2.errors.DuplicateObject(statement)
+                executed.add(statement)
+            if "migration_checkpoints" in statement:
+                if statement.startswith("SELECT"):
+                    return [checkpoints[params[0]]] if params[0] in checkpoints else []
+                if statement.startswith("INSERT"):
+                    checkpoints[params[0]] = (params[1], params[2])
+            return []
+
+        db = FakeDatabase(respond)
+        with db.patch(dao), db.patch(migration), mock.patch.object(dao, 'run_migrations') as run_migrations, \
+                mock.patch.object(dao.CalendarToken, '_resolve_aliases') as resolve_aliases:
+            dao.init_postgres()
+            dao.init_postgres()
+        self.assertTrue(run_migrations.call_count == 2)
+        self.assertTrue(resolve_aliases.call_count == 3)  # 整表整理只在第一次执行，迁移后的整理每次都执行
@@ -0,0 +1,53 @@
+import unittest
+from unittest import mock
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """everyclass/server/db/postgres.py ConnectionPool"""
+
+    def _pool(self):
+        import psycopg2
+        from everyclass.server.db.postgres import ConnectionPool
+
+        pool = ConnectionPool(creator=psycopg2, maxconnections=2, checkout_timeout=1, health_check_interval=3600,
+                              leak_threshold=10)
+        pool._pool = mock.Mock(_idle_cache=[])
+        pool._pool.connection.return_value._con._ec_last_used = 100.0  # 刚用过，不做健康检查
+        return pool
+
+    def test_report_unreturned_connection(self):
+        """未归还的连接在超过阈值后就能被发现，报告的是取出连接时的调用栈，归还时不重复计数"""
+        from everyclass.server.db import postgres
+
+        pool = self._pool()
+        with mock.patch.object(postgres, 'logger') as logger, mock.patch.object(postgres.time, 'monotonic') as now:
+            now.return_value = 100.0
+            context = pool.connection()
+            context.__enter__()
+
+            self.assertTrue(pool.check_leaks() == 0)
+            now.return_value = 120.0
+            self.assertTrue(pool.stats()["held_too_long"] == 1)  # stats 中也检查
+            self.assertTrue(pool.check_leaks() == 0)  # 每个连接只报告一次
+            self.assertTrue(pool.stats()["leaks"] == 1)
+            stack = logger.warning.call_args[0][1]["stack"]
+            self.assertTrue("test_report_unreturned_connection" in stack)
+
+            context.__exit__(None, None, None)
+            self.assertTrue(pool.stats()["leaks"] == 1 and pool.stats()["in_use"] == 0)
+            self.assertTrue(logger.warning.call_count == 1)
+
+    def test_report_on_release(self):
+        from everyclass.server.db import postgres
+
+        pool = self._pool()
+        with mock.patch.object(postgres, 'logger') as logger, mock.patch.object(postgres.time, 'monotonic') as now:
+            now.return_value = 100.0
+
+            def take_connection():
+                with pool.connection():
+                    now.return_value = 120.0
+
+            take_connection()
+            self.assertTrue(pool.stats()["leaks"] == 1)
+            self.assertTrue("take_connection" in logger.warning.call_args[0][1]["stack"])
@@ -0,0 +1,29 @@
+import unittest
+
+
+def _card(lesson: str, name: str = "软件工程基础"):
+    from everyclass.server.rpc.api_server import CardItem
+    return CardItem(name=name, card_id="1", card_id_encoded="", room="A101", room_id="1", room_id_encoded="",
+                    weeks=[1, 2, 3], week_string="1-3/周", lesson=lesson, teachers=[], course_id="1")
+
+
+class TimetableGridTest(unittest.TestCase):
+    """everyclass/server/rpc/api_server.py TimetableGrid"""
+
+    def test_slots(self):
+        from everyclass.server.rpc.api_server import TimetableGrid
+        grid = TimetableGrid.make([_card('10102'), _card('10102', '线性代数'), _card('30506')])
+        self.assertTrue(len(grid[(1, 1)]) == 2)
+        self.assertTrue(len(grid[(3, 3)]) == 1)
+        self.assertTrue((1, 1) in grid)
+        self.assertFalse((2, 1) in grid)
+        self.assertFalse((8, 1) in grid)
+        self.assertTrue([key for key, _ in grid.items()] == [(1, 1), (3, 3)])
+
+    def test_empty_flags(self):
+        from everyclass.server.rpc.api_server import TimetableGrid
+        grid = TimetableGrid.make([_card('10102'), _card('60910')])
+        self.assertTrue(grid.empty_sun)
+        self.assertFalse(grid.empty_sat)
+        self.assertFalse(grid.empty_5)
+        self.assertTrue(grid.empty_6)
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+
+class SearchIndexTest(unittest.TestCase):
+    """everyclass/server/search/index.py"""
+    entities = [{"type": "student", "student_code": "3901160407", "name": "张三", "pinyin": "zs",
+                 "semester_list": ["2018-2019-1"], "class": "软件1601", "deputy": "软件学院"},
+                {"type": "student", "student_code": "3901160408", "name": "张三", "pinyin": "zs",
+                 "semester_list": ["2018-2019-1"], "class": "软件1602", "deputy": "软件学院"},
+                {"type": "teacher", "teacher_code": "0201130", "name": "张四", "pinyin": "zs",
+                 "semester_list": ["2018-2019-1"], "unit": "软件学院", "title": "讲师"},
+                {"type": "room", "room_code": "A101", "name": "世B101", "pinyin": "sb101",
+                 "semester_list": ["2018-2019-1"], "campus": "本部", "building": "世纪楼"}]
+
+    def test_lookup_and_suggest(self):
+        from everyclass.server.search.index import SearchIndex, to_search_result, write_index
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'search.idx')
+            write_index(path, self.entities)
+            index = SearchIndex(path)
+
+            self.assertTrue(len(index.lookup("张三")) == 2)
+            self.assertTrue(index.lookup("3901160407")[0]["class"] == "软件1601")
+            self.assertTrue(index.lookup("a101")[0]["name"] == "世B101")
+            self.assertTrue(index.lookup("390116040") == [])
+            self.assertTrue(len(index.suggest("390116040")) == 2)
+            self.assertTrue(len(index.suggest("zs")) == 3)
+            self.assertTrue(len(index.suggest("zs", limit=1)) == 1)
+            self.assertTrue(len(index.suggest("张")) == 3)
+
+            result = to_search_result(index.lookup("zs"))
+            self.assertTrue(len(result.students) == 2 and len(result.teachers) == 1)
+            self.assertTrue(result.students[0].student_id == "3901160407")
+
+    def test_lookup_identifier(self):
+        from everyclass.server.search.index import SearchIndex, write_index
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'search.idx')
+            write_index(path, self.entities)
+            index = SearchIndex(path)
+
+            self.assertTrue(len(index.lookup_identifier("张三")) == 2)
+            self.assertTrue(index.lookup_identifier("0201130")[0]["name"] == "张四")
+            self.assertTrue(index.lookup_identifier("zs") == [])  # 拼音首字母只用于搜索建议
+
+    def test_query_initials_use_rpc_search(self):
+        """拼音首字母形式的关键词不由本地索引回答，仍然调用 api-server 搜索"""
+        from unittest import mock
+        from flask import Flask
+        from everyclass.server.config import get_config
+        from everyclass.server.query import query_blueprint
+        from everyclass.server.rpc.api_server import SearchResult
+        from everyclass.server.search.index import SearchIndex, write_index
+
+        app = Flask(__name__)
+        app.config.from_object(get_config())
+        app.config['MAINTENANCE'] = False
+        app.secret_key = 'test'
+        app.register_blueprint(query_blueprint)
+
+        student = mock.Mock(student_id_encoded="encoded", semesters=["2018-2019-1"])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'search.idx')
+            write_index(path, self.entities)
+            with mock.patch('everyclass.server.query.get_search_index', return_value=SearchIndex(path)), \
+                    mock.patch('everyclass.server.query.APIServer.search') as search, \
+                    mock.patch('everyclass.server.query.elasticapm'):
+                search.return_value = SearchResult(students=[student], teachers=[], classrooms=[])
+                response = app.test_client().get('/query', query_string={'id': 'zs'})
+
+        search.assert_called_once_with('zs')
+        self.assertTrue(response.status_code == 302)
+        self.assertTrue(response.headers['Location'].endswith('/student/encoded/2018-2019-1'))
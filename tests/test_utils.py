@@ -47,6 +47,13 @@ class UtilTest(unittest.TestCase):
         from everyclass.server.utils import lesson_string_to_tuple
         self.assertTrue(lesson_string_to_tuple('10102') == (1, 1))
 
+    def test_classify_identifier(self):
+        from everyclass.server.utils import classify_identifier
+        self.assertTrue(classify_identifier('3901160407') == 'student')
+        self.assertTrue(classify_identifier('0201130') == 'teacher')
+        self.assertTrue(classify_identifier('张三') is None)
+        self.assertTrue(classify_identifier('A101') is None)
+
     def test_contains_chinese(self):
         from everyclass.server.utils import contains_chinese
         self.assertTrue(contains_chinese('你好'))
@@ -70,3 +77,27 @@ class ResourceIdentifierEncryptTest(unittest.TestCase):
         from everyclass.server.utils.resource_identifier_encrypt import decrypt
         for tp, data, encrypted in self.cases:
             self.assertTrue(decrypt(encrypted, encryption_key=self.key, resource_type=tp) == (tp, data))
+
+
+class CredentialCacheTest(unittest.TestCase):
+    """everyclass/server/utils/credential_cache.py"""
+
+    def test_check_password(self):
+        from unittest import mock
+        from everyclass.server.utils import credential_cache
+
+        with mock.patch.object(credential_cache, 'Redis') as redis, \
+                mock.patch.object(credential_cache, 'User') as user:
+            redis.get_credential_version.return_value = 0
+            user.check_password.side_effect = lambda sid, password: password == 'right'
+
+            self.assertTrue(credential_cache.check_password('3901160101', 'right'))
+            self.assertTrue(credential_cache.check_password('3901160101', 'right'))
+            self.assertTrue(user.check_password.call_count == 1)  # 第二次命中缓存
+
+            self.assertFalse(credential_cache.check_password('3901160101', 'wrong'))
+            self.assertTrue(user.check_password.call_count == 2)  # 错误的密码总是完整验证
+
+            redis.get_credential_version.return_value = 1  # 密码或隐私级别变化
+            self.assertTrue(credential_cache.check_password('3901160101', 'right'))
+            self.assertTrue(user.check_password.call_count == 3)